@@ -0,0 +1,478 @@
+import asyncio
+import copy
+import itertools
+import json
+import random
+import re
+import threading
+from collections import Counter
+from typing import Any, Optional
+
+from aiohttp import web
+from pymongo import ReturnDocument
+from pymongo.errors import OperationFailure
+
+bot_user = {
+    'id': '100000000000000001',
+    'username': 'Benchmark',
+    'discriminator': '0',
+    'avatar': None,
+    'bot': True
+}
+
+
+def matches(document: dict, query: dict) -> bool:
+    for key, expected in query.items():
+        value = get_path(document, key)
+        if isinstance(expected, dict) and any(
+            k.startswith('$') for k in expected
+        ):
+            for operator, operand in expected.items():
+                if operator == '$in' and value not in operand:
+                    return False
+                if operator == '$lte' and not (
+                    value is not None and value <= operand
+                ):
+                    return False
+                if operator == '$gt' and not (
+                    value is not None and value > operand
+                ):
+                    return False
+                if operator == '$exists' and (value is not None) != operand:
+                    return False
+        elif value != expected:
+            return False
+    return True
+
+
+def get_path(document: dict, path: str) -> Any:
+    value = document
+    for part in path.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def set_path(document: dict, path: str, value: Any) -> None:
+    *parents, last = path.split('.')
+    for part in parents:
+        document = document.setdefault(part, {})
+    document[last] = value
+
+
+def apply_update(document: dict, update: dict, inserting: bool) -> None:
+    for operator, fields in update.items():
+        for path, value in fields.items():
+            if operator == '$set':
+                set_path(document, path, copy.deepcopy(value))
+            elif operator == '$setOnInsert' and inserting:
+                set_path(document, path, copy.deepcopy(value))
+            elif operator == '$inc':
+                current = get_path(document, path) or 0
+                set_path(document, path, current + value)
+            elif operator == '$unset':
+                *parents, last = path.split('.')
+                parent = get_path(document, '.'.join(parents)) \
+                    if parents else document
+                if isinstance(parent, dict):
+                    parent.pop(last, None)
+
+
+def is_operator(value: Any) -> bool:
+    return isinstance(value, dict) and any(k.startswith('$') for k in value)
+
+
+def id_key(value: Any) -> Any:
+    # Compound ids like {'guild': 1, 'user': 2} are not hashable
+    if isinstance(value, dict):
+        return tuple((k, id_key(v)) for k, v in value.items())
+    return value
+
+
+class FakeBulkWriteResult:
+    def __init__(self) -> None:
+        self.matched_count = 0
+        self.modified_count = 0
+        self.upserted_ids: dict[int, Any] = {}
+
+    @property
+    def upserted_count(self) -> int:
+        return len(self.upserted_ids)
+
+
+class FakeCursor:
+    def __init__(self, documents: list[dict]) -> None:
+        self.documents = documents
+
+    def batch_size(self, size: int) -> 'FakeCursor':
+        return self
+
+    def sort(self, key: str, direction: int = 1) -> 'FakeCursor':
+        self.documents.sort(
+            key=lambda d: get_path(d, key) or 0, reverse=direction < 0
+        )
+        return self
+
+    def limit(self, count: int) -> 'FakeCursor':
+        if count:
+            self.documents = self.documents[:count]
+        return self
+
+    def __aiter__(self):
+        return self.iterate()
+
+    async def iterate(self):
+        for document in self.documents:
+            yield copy.deepcopy(document)
+
+    async def to_list(self, length: Optional[int] = None) -> list[dict]:
+        documents = self.documents[:length] if length else self.documents
+        return copy.deepcopy(documents)
+
+
+class FakeCollection:
+    """The subset of the Motor collection API used by the cogs"""
+
+    def __init__(self, calls: Counter) -> None:
+        self.documents: dict[Any, dict] = {}
+        self.calls = calls
+        self.ids = itertools.count(1)
+
+    def select(self, query: dict) -> list[dict]:
+        if set(query) == {'_id'} and not is_operator(query['_id']):
+            document = self.documents.get(id_key(query['_id']))
+            return [document] if document is not None else []
+        return [d for d in self.documents.values() if matches(d, query)]
+
+    async def find_one(self, query: dict, *args, **kwargs) -> Optional[dict]:
+        self.calls['find_one'] += 1
+        found = self.select(query)
+        return copy.deepcopy(found[0]) if found else None
+
+    def find(self, query: Optional[dict] = None, *args, **kwargs):
+        self.calls['find'] += 1
+        return FakeCursor(self.select(query or {}))
+
+    async def insert_one(self, document: dict) -> None:
+        self.calls['insert_one'] += 1
+        document = copy.deepcopy(document)
+        document.setdefault('_id', next(self.ids))
+        self.documents[id_key(document['_id'])] = document
+
+    def upsert(self, query: dict, update: dict, upsert: bool) -> tuple:
+        found = self.select(query)
+        if found:
+            document = found[0]
+            before = copy.deepcopy(document)
+            apply_update(document, update, inserting=False)
+            return before, document, False
+        if not upsert:
+            return None, None, False
+
+        document = {
+            key: copy.deepcopy(value) for key, value in query.items()
+            if not is_operator(value)
+        }
+        document.setdefault('_id', next(self.ids))
+        apply_update(document, update, inserting=True)
+        self.documents[id_key(document['_id'])] = document
+        return None, document, True
+
+    async def update_one(
+        self, query: dict, update: dict, upsert: bool = False
+    ) -> None:
+        self.calls['update_one'] += 1
+        self.upsert(query, update, upsert)
+
+    async def update_many(self, query: dict, update: dict) -> None:
+        self.calls['update_many'] += 1
+        for document in self.select(query):
+            apply_update(document, update, inserting=False)
+
+    async def find_one_and_update(
+        self,
+        query: dict,
+        update: dict,
+        upsert: bool = False,
+        return_document: bool = ReturnDocument.BEFORE,
+        **kwargs
+    ) -> Optional[dict]:
+        self.calls['find_one_and_update'] += 1
+        before, after, _ = self.upsert(query, update, upsert)
+        if return_document == ReturnDocument.AFTER:
+            return copy.deepcopy(after)
+        return before
+
+    async def delete_one(self, query: dict) -> None:
+        self.calls['delete_one'] += 1
+        for document in self.select(query)[:1]:
+            del self.documents[id_key(document['_id'])]
+
+    async def bulk_write(
+        self, requests: list, ordered: bool = True
+    ) -> FakeBulkWriteResult:
+        self.calls['bulk_write'] += 1
+        result = FakeBulkWriteResult()
+        for index, request in enumerate(requests):
+            # Only UpdateOne is used by the cogs
+            _, document, inserted = self.upsert(
+                request._filter, request._doc, request._upsert
+            )
+            if inserted:
+                result.upserted_ids[index] = document['_id']
+            elif document is not None:
+                result.matched_count += 1
+                result.modified_count += 1
+        return result
+
+    def aggregate(self, pipeline: list[dict]) -> FakeCursor:
+        """Supports the $match and $group stages with $sum"""
+        self.calls['aggregate'] += 1
+        documents = list(self.documents.values())
+        for stage in pipeline:
+            if '$match' in stage:
+                documents = [
+                    d for d in documents if matches(d, stage['$match'])
+                ]
+            elif '$group' in stage:
+                documents = self.group(documents, stage['$group'])
+        return FakeCursor(documents)
+
+    def group(self, documents: list[dict], spec: dict) -> list[dict]:
+        groups: dict[Any, dict] = {}
+        key = spec['_id']
+        for document in documents:
+            value = get_path(document, key[1:]) if key else None
+            group = groups.setdefault(id_key(value), {'_id': value})
+            for field, accumulator in spec.items():
+                if field == '_id':
+                    continue
+                amount = accumulator['$sum']
+                if isinstance(amount, str):
+                    amount = get_path(document, amount[1:]) or 0
+                group[field] = group.get(field, 0) + amount
+        return list(groups.values())
+
+    async def create_index(self, *args, **kwargs) -> None:
+        self.calls['create_index'] += 1
+
+    def watch(self, *args, **kwargs):
+        raise OperationFailure(
+            'The $changeStream stage is only supported on replica sets',
+            code=40573
+        )
+
+
+class FakeDatabase:
+    def __init__(self) -> None:
+        self.calls: Counter = Counter()
+        self.collections: dict[str, FakeCollection] = {}
+
+    def __getitem__(self, name: str) -> FakeCollection:
+        if name not in self.collections:
+            self.collections[name] = FakeCollection(self.calls)
+        return self.collections[name]
+
+
+def json_response(
+    data: Any, status: int = 200, headers: Optional[dict] = None
+) -> web.Response:
+    # discord.py only decodes bodies typed exactly as application/json
+    headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+    return web.Response(
+        body=json.dumps(data).encode(), status=status, headers=headers
+    )
+
+
+class FakeDiscord:
+    """A local stand in for the Discord REST API.
+
+    Every request waits for `latency` seconds, plus up to `jitter`, and a
+    `ratelimit_ratio` share of message sends is answered with a 429.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.05,
+        jitter: float = 0.02,
+        ratelimit_ratio: float = 0.0,
+        retry_after: float = 0.25
+    ) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.ratelimit_ratio = ratelimit_ratio
+        self.retry_after = retry_after
+        self.requests: Counter = Counter()
+        self.ratelimited = 0
+        self.snowflakes = itertools.count(900000000000000000)
+        self.runner: Optional[web.AppRunner] = None
+        self.base = ''
+        self.routes = [
+            ('GET', r'/users/@me', self.user),
+            ('GET', r'/oauth2/applications/@me', self.application),
+            ('GET', r'/channels/(\d+)', self.channel),
+            ('POST', r'/channels/(\d+)/messages', self.send_message),
+            ('GET', r'/channels/(\d+)/messages/(\d+)', self.message),
+            ('POST', r'/channels/(\d+)/webhooks', self.create_webhook),
+            ('POST', r'/webhooks/(\d+)/([^/]+)', self.execute_webhook)
+        ]
+
+    def reset(self) -> None:
+        self.requests.clear()
+        self.ratelimited = 0
+
+    @property
+    def total(self) -> int:
+        return sum(self.requests.values())
+
+    def start(self) -> None:
+        """Serve from a thread of its own, away from the bot's event loop"""
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name='fake-discord', daemon=True
+        )
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.serve(), self.loop).result()
+
+    def close(self) -> None:
+        if self.runner is not None:
+            future = asyncio.run_coroutine_threadsafe(
+                self.runner.cleanup(), self.loop
+            )
+            future.result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    async def serve(self) -> None:
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_route('*', '/api/v10/{path:.*}', self.dispatch)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base = f'http://127.0.0.1:{port}/api/v10'
+
+    async def dispatch(self, request: web.Request) -> web.Response:
+        path = '/' + request.match_info['path']
+        await asyncio.sleep(self.latency + random.random() * self.jitter)
+        for method, pattern, handler in self.routes:
+            match = re.fullmatch(pattern, path)
+            if request.method == method and match:
+                self.requests[f'{method} {pattern}'] += 1
+                return await handler(request, *match.groups())
+
+        self.requests[f'{request.method} unknown'] += 1
+        return json_response(
+            {'message': 'Unknown route', 'code': 0}, status=404
+        )
+
+    def ratelimit(self) -> Optional[web.Response]:
+        if random.random() >= self.ratelimit_ratio:
+            return None
+        self.ratelimited += 1
+        headers = {
+            'X-RateLimit-Limit': '5',
+            'X-RateLimit-Remaining': '0',
+            'X-RateLimit-Reset-After': str(self.retry_after),
+            'X-RateLimit-Bucket': 'benchmark',
+            'X-RateLimit-Scope': 'user',
+            # Without Via discord.py treats a 429 as a Cloudflare ban
+            'Via': '1.1 google'
+        }
+        body = {
+            'message': 'You are being rate limited.',
+            'retry_after': self.retry_after,
+            'global': False
+        }
+        return json_response(body, status=429, headers=headers)
+
+    async def user(self, request: web.Request) -> web.Response:
+        return json_response(bot_user)
+
+    async def application(self, request: web.Request) -> web.Response:
+        return json_response({
+            'id': bot_user['id'],
+            'name': 'Benchmark',
+            'description': '',
+            'icon': None,
+            'bot_public': False,
+            'bot_require_code_grant': False,
+            'owner': dict(bot_user, id='100000000000000002', bot=False),
+            'verify_key': '',
+            'flags': 0
+        })
+
+    async def channel(
+        self, request: web.Request, channel_id: str
+    ) -> web.Response:
+        return json_response({
+            'id': channel_id,
+            'type': 0,
+            'name': 'logs',
+            'position': 0,
+            'permission_overwrites': [],
+            'nsfw': False,
+            'parent_id': None
+        })
+
+    def message_payload(self, channel_id: str, message_id: str, **fields):
+        payload = {
+            'id': message_id,
+            'channel_id': channel_id,
+            'author': bot_user,
+            'content': '',
+            'timestamp': '2023-01-01T00:00:00+00:00',
+            'edited_timestamp': None,
+            'tts': False,
+            'mention_everyone': False,
+            'mentions': [],
+            'mention_roles': [],
+            'attachments': [],
+            'embeds': [],
+            'pinned': False,
+            'type': 0
+        }
+        payload.update(fields)
+        return payload
+
+    async def send_message(
+        self, request: web.Request, channel_id: str
+    ) -> web.Response:
+        limited = self.ratelimit()
+        if limited is not None:
+            return limited
+        await request.read()
+        payload = self.message_payload(channel_id, str(next(self.snowflakes)))
+        return json_response(payload)
+
+    async def message(
+        self, request: web.Request, channel_id: str, message_id: str
+    ) -> web.Response:
+        author = dict(bot_user, id='100000000000000003', bot=False)
+        payload = self.message_payload(
+            channel_id, message_id, author=author, content='Fetched content'
+        )
+        return json_response(payload)
+
+    async def create_webhook(
+        self, request: web.Request, channel_id: str
+    ) -> web.Response:
+        return json_response({
+            'id': str(next(self.snowflakes)),
+            'type': 1,
+            'token': 'benchmark-token',
+            'channel_id': channel_id,
+            'name': 'Logs'
+        })
+
+    async def execute_webhook(
+        self, request: web.Request, webhook_id: str, token: str
+    ) -> web.Response:
+        limited = self.ratelimit()
+        if limited is not None:
+            return limited
+        await request.read()
+        return web.Response(status=204)
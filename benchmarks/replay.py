@@ -0,0 +1,329 @@
+"""Replay gateway dispatches into a bot with its cogs loaded.
+
+MongoDB is replaced by an in-memory database and the Discord REST API by a
+local server with configurable latency and 429s. Nothing leaves the
+machine, so the numbers only measure the bot itself.
+
+    python -m benchmarks.replay --generate events.jsonl --events 20000
+    python -m benchmarks.replay events.jsonl --latency 0.05 --ratelimit 0.01
+
+Run it from the repository root, next to config.py. Files written by the
+gateway tap can be replayed as they are.
+"""
+
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import random
+import statistics
+import time
+from typing import Iterator
+
+import discord
+
+from benchmarks.fakes import FakeDatabase, FakeDiscord
+
+event_types = (
+    'MESSAGE_CREATE',
+    'MESSAGE_UPDATE',
+    'MESSAGE_DELETE',
+    'GUILD_MEMBER_ADD',
+    'GUILD_MEMBER_REMOVE'
+)
+
+
+def generate(
+    events: int, guilds: int, seed: int = 0
+) -> Iterator[dict]:
+    """Synthetic dispatches with realistic ids and payload shapes"""
+    rng = random.Random(seed)
+    snowflakes = itertools.count(200000000000000000)
+    now = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+    timestamp = now.isoformat()
+
+    def user() -> dict:
+        return {
+            'id': str(rng.randrange(300000000000000000, 300000000000100000)),
+            'username': f'user{rng.randrange(100000)}',
+            'discriminator': '0',
+            'avatar': None
+        }
+
+    layouts = []
+    for _ in range(guilds):
+        guild_id = str(next(snowflakes))
+        channels = [str(next(snowflakes)) for _ in range(5)]
+        logs_channel = str(next(snowflakes))
+        layouts.append((guild_id, channels, logs_channel))
+        yield {'t': 'GUILD_CREATE', 'd': {
+            'id': guild_id,
+            'name': f'Guild {guild_id}',
+            'icon': None,
+            'owner_id': str(next(snowflakes)),
+            'member_count': 1000,
+            'features': [],
+            'emojis': [],
+            'stickers': [],
+            'members': [],
+            'threads': [],
+            'roles': [{
+                'id': guild_id, 'name': '@everyone', 'permissions': '0',
+                'position': 0, 'color': 0, 'hoist': False,
+                'managed': False, 'mentionable': False
+            }],
+            'channels': [
+                {
+                    'id': channel_id, 'type': 0, 'name': f'channel-{index}',
+                    'position': index, 'permission_overwrites': [],
+                    'nsfw': False, 'parent_id': None
+                }
+                for index, channel_id in enumerate(channels + [logs_channel])
+            ],
+            'logs_channel': logs_channel
+        }}
+
+    live: list[tuple[str, str, str, dict]] = []
+    weights = (40, 30, 20, 5, 5)
+    for _ in range(events):
+        guild_id, channels, _ = rng.choice(layouts)
+        kind = rng.choices(event_types, weights)[0]
+        if kind in ('MESSAGE_UPDATE', 'MESSAGE_DELETE') and not live:
+            kind = 'MESSAGE_CREATE'
+
+        if kind == 'MESSAGE_CREATE':
+            message_id = str(next(snowflakes))
+            channel_id = rng.choice(channels)
+            author = user()
+            live.append((guild_id, channel_id, message_id, author))
+            if len(live) > 5000:
+                live.pop(rng.randrange(len(live)))
+            words = rng.randrange(1, 40)
+            yield {'t': kind, 'd': {
+                'id': message_id, 'channel_id': channel_id,
+                'guild_id': guild_id, 'author': author,
+                'content': ' '.join('word' for _ in range(words)),
+                'timestamp': timestamp, 'edited_timestamp': None,
+                'tts': False, 'mention_everyone': False, 'mentions': [],
+                'mention_roles': [], 'attachments': [], 'embeds': [],
+                'pinned': False, 'type': 0
+            }}
+        elif kind == 'MESSAGE_UPDATE':
+            guild_id, channel_id, message_id, author = rng.choice(live)
+            yield {'t': kind, 'd': {
+                'id': message_id, 'channel_id': channel_id,
+                'guild_id': guild_id, 'author': author,
+                'content': f'edited {rng.random()}',
+                'timestamp': timestamp, 'edited_timestamp': timestamp,
+                'tts': False, 'mention_everyone': False, 'mentions': [],
+                'mention_roles': [], 'attachments': [], 'embeds': [],
+                'pinned': False, 'type': 0
+            }}
+        elif kind == 'MESSAGE_DELETE':
+            index = rng.randrange(len(live))
+            guild_id, channel_id, message_id, _ = live.pop(index)
+            yield {'t': kind, 'd': {
+                'id': message_id, 'channel_id': channel_id,
+                'guild_id': guild_id
+            }}
+        elif kind == 'GUILD_MEMBER_ADD':
+            yield {'t': kind, 'd': {
+                'guild_id': guild_id, 'user': user(), 'roles': [],
+                'joined_at': timestamp, 'deaf': False, 'mute': False,
+                'flags': 0
+            }}
+        else:
+            yield {'t': kind, 'd': {'guild_id': guild_id, 'user': user()}}
+
+
+def read_events(path: str) -> list[dict]:
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(samples: list[float], quantile: float) -> float:
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    index = min(int(quantile * len(samples)), len(samples) - 1)
+    return samples[index]
+
+
+async def drain(baseline: set, digests=None) -> None:
+    """Wait for every task started by the replayed events to finish"""
+    while True:
+        if digests is not None:
+            # Sends what is left instead of waiting for the next digest,
+            # again each round since listeners still running can start one
+            await digests.close()
+        pending = asyncio.all_tasks() - baseline - {asyncio.current_task()}
+        if not pending:
+            return
+        await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+
+async def replay(events: list[dict], args: argparse.Namespace) -> dict:
+    import config
+    from bot import Bot
+    from cogs.utils import metrics, mongo
+
+    server = FakeDiscord(
+        latency=args.latency,
+        jitter=args.jitter,
+        ratelimit_ratio=args.ratelimit
+    )
+    server.start()
+    discord.http.Route.BASE = server.base
+
+    # mongo.connect keeps a database that is already set
+    database = FakeDatabase()
+    mongo.db = database
+
+    latencies: list[float] = []
+
+    class Recorder(metrics.Histogram):
+        def observe(self, value: float, **labels: str) -> None:
+            latencies.append(value)
+            super().observe(value, **labels)
+
+    metrics.listener_latency = Recorder(
+        'bot_listener_latency_seconds', 'Time spent in cog listeners'
+    )
+
+    # Digests are off unless asked for, so joins and leaves are logged one
+    # by one however fast the events are replayed
+    config.logs_digest_enter = args.digest_enter or len(events) + 1
+    config.logs_digest_interval = args.digest_interval
+
+    bot = Bot()
+    try:
+        async with bot:
+            await bot.login('benchmark')
+            state = bot._connection
+
+            dispatches = []
+            for event in events:
+                if event['t'] != 'GUILD_CREATE':
+                    dispatches.append(event)
+                    continue
+                data = event['d']
+                state._add_guild_from_data(data)
+                logs_channel = int(
+                    data.get('logs_channel') or data['channels'][0]['id']
+                )
+                await database['guilds'].insert_one({
+                    '_id': int(data['id']),
+                    'joined': logs_channel,
+                    'left': logs_channel,
+                    'edited': logs_channel,
+                    'deleted': logs_channel
+                })
+
+            database.calls.clear()
+            server.reset()
+            baseline = asyncio.all_tasks()
+            started = time.perf_counter()
+            for index, event in enumerate(dispatches):
+                parser = state.parsers.get(event['t'])
+                if parser is not None:
+                    parser(event['d'])
+                if index % args.batch == 0:
+                    await asyncio.sleep(0)
+            dispatched = time.perf_counter() - started
+            logs = bot.get_cog('Logs')
+            await drain(baseline, logs.digests if logs else None)
+            elapsed = time.perf_counter() - started
+    finally:
+        server.close()
+
+    count = len(dispatches) or 1
+    return {
+        'events': len(dispatches),
+        'dispatch_seconds': dispatched,
+        'total_seconds': elapsed,
+        'events_per_second': len(dispatches) / elapsed if elapsed else 0,
+        'handler_calls': len(latencies),
+        'handler_p50_ms': percentile(latencies, 0.50) * 1000,
+        'handler_p99_ms': percentile(latencies, 0.99) * 1000,
+        'handler_mean_ms': (
+            statistics.fmean(latencies) * 1000 if latencies else 0
+        ),
+        'db_calls': sum(database.calls.values()),
+        'db_calls_per_event': sum(database.calls.values()) / count,
+        'db_calls_by_operation': dict(database.calls),
+        'http_calls': server.total,
+        'http_calls_per_event': server.total / count,
+        'http_calls_by_route': dict(server.requests),
+        'http_ratelimited': server.ratelimited
+    }
+
+
+def print_report(report: dict) -> None:
+    print(f'Events               {report["events"]}')
+    print(f'Total time           {report["total_seconds"]:.3f} s')
+    print(f'Throughput           {report["events_per_second"]:.0f} events/s')
+    print(f'Handler calls        {report["handler_calls"]}')
+    print(f'Handler p50          {report["handler_p50_ms"]:.3f} ms')
+    print(f'Handler p99          {report["handler_p99_ms"]:.3f} ms')
+    print(f'DB calls per event   {report["db_calls_per_event"]:.3f}')
+    print(f'HTTP calls per event {report["http_calls_per_event"]:.3f}')
+    print(f'HTTP 429 responses   {report["http_ratelimited"]}')
+    for route, calls in sorted(report['http_calls_by_route'].items()):
+        print(f'  {route}: {calls}')
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('events', nargs='?', help='JSONL file to replay')
+    parser.add_argument(
+        '--generate', metavar='PATH', help='write synthetic events and exit'
+    )
+    parser.add_argument('--events', type=int, default=10_000, dest='count')
+    parser.add_argument('--guilds', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument(
+        '--ratelimit', type=float, default=0.0,
+        help='share of message sends answered with a 429'
+    )
+    parser.add_argument(
+        '--batch', type=int, default=100,
+        help='events dispatched before yielding to the loop'
+    )
+    parser.add_argument(
+        '--digest-enter', type=int, default=0,
+        help='joins or leaves per window that switch a guild to digests, '
+        'off by default'
+    )
+    parser.add_argument(
+        '--digest-interval', type=float, default=1.0,
+        help='seconds between digests'
+    )
+    parser.add_argument('--json', action='store_true', help='print JSON')
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    if args.generate:
+        with open(args.generate, 'w', encoding='utf-8') as f:
+            for event in generate(args.count, args.guilds, args.seed):
+                f.write(json.dumps(event) + '\n')
+        return
+
+    if args.events:
+        events = read_events(args.events)
+    else:
+        events = list(generate(args.count, args.guilds, args.seed))
+
+    report = asyncio.run(replay(events, args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
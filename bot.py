@@ -1,10 +1,16 @@
+import asyncio
 import logging
+import time
+from multiprocessing.connection import Connection
+from typing import Optional
 
 import discord
 from discord.ext import commands
 
 import config
-from cogs.utils import files
+from cogs.utils import (
+    cluster, files, logger, metrics, mongo, reloader, runtime, tap
+)
 
 description = """
 This is the template used by Bitacora.gg to develop Discord bots.
@@ -14,28 +20,262 @@ log = logging.getLogger(__name__)
 
 initial_extensions = files.get_initial_extensions()
 
+# Rough per object costs used to estimate what the cache profile saves
+member_bytes = 1500
+presence_bytes = 600
+message_bytes = 2500
+default_max_messages = 1000
 
-class Bot(commands.Bot):
-    def __init__(self):
+
+class CacheProfile:
+    """Intents and cache settings needed by the loaded extensions.
+
+    Every extension can declare a module level `requirements` dict with
+    `intents` and `member_cache` flag names, `max_messages` and
+    `chunk_guilds`. Anything not requested by any of them is disabled.
+    """
+
+    def __init__(self, requirements: dict[str, dict]) -> None:
+        self.intents = discord.Intents.none()
+        self.intents.guilds = True
+        self.member_cache_flags = discord.MemberCacheFlags.none()
+        self.max_messages = 0
+        self.chunk_guilds_at_startup = False
+
+        for requirement in requirements.values():
+            for name in requirement.get('intents', []):
+                setattr(self.intents, name, True)
+            for name in requirement.get('member_cache', []):
+                setattr(self.member_cache_flags, name, True)
+            self.max_messages = max(
+                self.max_messages, requirement.get('max_messages', 0)
+            )
+            self.chunk_guilds_at_startup |= requirement.get(
+                'chunk_guilds', False
+            )
+
+    def options(self) -> dict:
+        return {
+            'intents': self.intents,
+            'member_cache_flags': self.member_cache_flags,
+            'max_messages': self.max_messages or None,
+            'chunk_guilds_at_startup': self.chunk_guilds_at_startup
+        }
+
+    def describe(self) -> str:
+        intents = [name for name, value in self.intents if value]
+        member_cache = [
+            name for name, value in self.member_cache_flags if value
+        ]
+        return (
+            f'intents={",".join(intents)} '
+            f'member_cache={",".join(member_cache) or "none"} '
+            f'max_messages={self.max_messages} '
+            f'chunk_guilds={self.chunk_guilds_at_startup}'
+        )
+
+    def estimated_savings(self, members: int) -> int:
+        saved = 0
+        caches_members = self.chunk_guilds_at_startup and any(
+            value for _, value in self.member_cache_flags
+        )
+        if not caches_members:
+            saved += members * member_bytes
+        if not self.intents.presences:
+            saved += members * presence_bytes
+        saved += max(default_max_messages - self.max_messages, 0) *\
+            message_bytes
+        return saved
+
+
+class Bot(commands.AutoShardedBot):
+    def __init__(
+        self,
+        cluster_id: Optional[int] = None,
+        shard_ids: Optional[list[int]] = None,
+        shard_count: Optional[int] = None,
+        connection: Optional[Connection] = None
+    ):
         allowed_mentions = discord.AllowedMentions.all()
-        intents = discord.Intents.all()
+        self.requirements = files.get_extension_requirements(
+            initial_extensions
+        )
+        self.cache_profile = CacheProfile(self.requirements)
+        log.info(f'Cache profile: {self.cache_profile.describe()}')
         super().__init__(
             command_prefix=config.prefix,
             allowed_mentions=allowed_mentions,
-            intents=intents,
-            enable_debug_events=True,
+            shard_ids=shard_ids,
+            shard_count=shard_count,
+            http_trace=metrics.http_trace(),
+            **self.cache_profile.options()
+        )
+        self.cluster = cluster.ClusterClient(cluster_id, connection)
+        self.reloader = reloader.Reloader(self)
+        self.extension_timings: dict[str, float] = {}
+        self.metrics_server = None
+        tap_file = 'gateway-tap.jsonl'
+        if cluster_id is not None:
+            tap_file = f'gateway-tap-cluster-{cluster_id}.jsonl'
+        self.gateway_tap = tap.GatewayTap(self._connection, tap_file)
+        self.loop_monitor = runtime.LoopMonitor(
+            threshold=getattr(config, 'loop_lag_threshold', 0.25)
         )
+        metrics.registry.register_collector('bot', self.collect_metrics)
+        self.tree.on_error = self.on_app_command_error
+
+    async def on_app_command_error(
+        self,
+        interaction: discord.Interaction,
+        error: discord.app_commands.AppCommandError
+    ) -> None:
+        if not isinstance(error, discord.app_commands.CheckFailure):
+            command = interaction.command
+            name = command.qualified_name if command else 'unknown'
+            log.error(
+                f'Ignoring exception in command {name}', exc_info=error
+            )
+            return
+
+        content = str(error) or 'You cannot use this command here'
+        if interaction.response.is_done():
+            await interaction.followup.send(content, ephemeral=True)
+        else:
+            await interaction.response.send_message(content, ephemeral=True)
 
     async def setup_hook(self) -> None:
-        self.bot_app_info = await self.application_info()
+        self.loop_monitor.start()
+        self.db = mongo.connect()
+        self.cluster.start()
+        await self.start_metrics_server()
+        self.settings_tasks = [
+            asyncio.create_task(self.preload_settings()),
+            asyncio.create_task(mongo.watch())
+        ]
+
+        self.reloader.snapshot()
+        if getattr(config, 'reload_watch', False):
+            self.reloader.watch()
+
+        started = time.perf_counter()
+        self.bot_app_info, _ = await asyncio.gather(
+            self.application_info(), self.load_extensions()
+        )
+        elapsed = time.perf_counter() - started
+        log.info(
+            f'Loaded {len(self.extensions)} extensions in {elapsed:.2f}s'
+        )
+
+    def load_order(self) -> dict[str, set[str]]:
+        """Extensions each extension has to wait for before loading.
+
+        Extensions list them under `after` in their `requirements`, and
+        constraints that form a cycle are ignored.
+        """
+        order = {
+            extension: set(
+                self.requirements.get(extension, {}).get('after', [])
+            ) & set(initial_extensions)
+            for extension in initial_extensions
+        }
+
+        resolved = set()
+        pending = dict(order)
+        while pending:
+            ready = [e for e, after in pending.items() if after <= resolved]
+            if not ready:
+                log.error(
+                    'Extension load order has a cycle between '
+                    f'{", ".join(sorted(pending))}, ignoring it'
+                )
+                for extension in pending:
+                    order[extension] = order[extension] & resolved
+                break
+            for extension in ready:
+                resolved.add(extension)
+                del pending[extension]
+        return order
 
-        for extension in initial_extensions:
+    async def load_extensions(self) -> None:
+        order = self.load_order()
+        loaded = {extension: asyncio.Event() for extension in order}
+
+        async def load(extension: str) -> None:
+            for dependency in order[extension]:
+                await loaded[dependency].wait()
             try:
-                await self.load_extension(extension)
-            except Exception:
-                log.exception(f'Failed to load extension {extension}')
-            else:
-                log.info(f'Successfully loaded extension {extension}')
+                await self.load_timed(extension)
+            finally:
+                loaded[extension].set()
+
+        await asyncio.gather(*(load(extension) for extension in order))
+
+    async def load_timed(self, extension: str) -> None:
+        budget = getattr(config, 'extension_load_budget', 2.0)
+        started = time.perf_counter()
+        try:
+            await self.load_extension(extension)
+        except Exception:
+            log.exception(f'Failed to load extension {extension}')
+            return
+
+        elapsed = time.perf_counter() - started
+        self.extension_timings[extension] = elapsed
+        log.info(f'Successfully loaded extension {extension} ({elapsed:.3f}s)')
+        if elapsed > budget:
+            log.warning(
+                f'Extension {extension} took {elapsed:.2f}s to load, '
+                f'over the {budget:.2f}s budget'
+            )
+
+    async def start_metrics_server(self) -> None:
+        port = getattr(config, 'metrics_port', None)
+        if port is None:
+            return
+
+        # Every cluster on a host serves on its own port
+        port += self.cluster.cluster_id
+        host = getattr(config, 'metrics_host', '127.0.0.1')
+        self.metrics_server = metrics.MetricsServer(host, port)
+        try:
+            await self.metrics_server.start()
+        except OSError:
+            log.exception(f'Failed to serve metrics on {host}:{port}')
+            self.metrics_server = None
+        else:
+            log.info(f'Serving metrics on http://{host}:{port}/metrics')
+
+    def collect_metrics(self) -> list[metrics.Sample]:
+        samples = [
+            ('bot_guilds', {}, len(self.guilds)),
+            ('bot_latency_seconds', {}, self.latency)
+        ]
+        samples.extend(
+            ('bot_extension_load_seconds', {'extension': name}, elapsed)
+            for name, elapsed in self.extension_timings.items()
+        )
+        samples.extend(
+            ('bot_gateway_tap_seen', {'event': event}, count)
+            for event, count in self.gateway_tap.seen.items()
+        )
+        samples.extend(
+            ('bot_gateway_tap_captured', {'event': event}, count)
+            for event, count in self.gateway_tap.captured.items()
+        )
+        handler = logger.find_queue_handler()
+        if handler is not None:
+            samples.append(('bot_log_queue_depth', {}, handler.queue.qsize()))
+            samples.append(('bot_log_records_dropped', {}, handler.dropped))
+        return samples
+
+    async def preload_settings(self) -> None:
+        await self.wait_until_ready()
+        try:
+            loaded = await mongo.preload(guild.id for guild in self.guilds)
+        except Exception:
+            log.exception('Failed to preload guild settings')
+        else:
+            log.info(f'Preloaded settings for {loaded} guilds')
 
     @property
     def owner(self) -> discord.User:
@@ -44,8 +284,27 @@ class Bot(commands.Bot):
     async def on_ready(self) -> None:
         if not hasattr(self, 'uptime'):
             self.uptime = discord.utils.utcnow()
+            members = sum(guild.member_count or 0 for guild in self.guilds)
+            saved = self.cache_profile.estimated_savings(members)
+            log.info(
+                f'Cache profile saves an estimated {saved / 2**20:.1f} MiB '
+                f'across {len(self.guilds)} guilds and {members} members'
+            )
 
         log.info(f'Ready: {self.user} (ID: {self.user.id})')
 
+    async def close(self) -> None:
+        for task in getattr(self, 'settings_tasks', []):
+            task.cancel()
+        self.cluster.close()
+        self.reloader.stop_watching()
+        self.loop_monitor.stop()
+        self.gateway_tap.stop()
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
+        await super().close()
+        # Cogs may still write while they unload
+        mongo.close()
+
     async def start(self) -> None:
         await super().start(config.token, reconnect=True)
@@ -1,11 +1,258 @@
+import asyncio
+import logging
+import re
+from typing import Optional
+
+import discord
+from discord import Interaction, app_commands
 from discord.ext import commands
 
+import config
 from bot import Bot
+from cogs.utils import cluster, metrics
+from cogs.utils.jobs import Executor, Job
+
+log = logging.getLogger(__name__)
+
+user_id = re.compile(r'\d{15,21}')
+max_targets = 10_000
+max_file_size = 1024 * 1024
+
+
+def parse_targets(text: str) -> list[int]:
+    """IDs and mentions in the order given, without duplicates"""
+    return list(dict.fromkeys(int(i) for i in user_id.findall(text)))
+
+
+# Permission each action needs, checked again when a job is cancelled
+# or resumed by someone else
+required_permissions = {
+    'ban': 'ban_members',
+    'kick': 'kick_members',
+    'purge': 'manage_messages'
+}
 
 
+def can_moderate(interaction: Interaction) -> bool:
+    permissions = interaction.permissions
+    if any(getattr(permissions, p) for p in required_permissions.values()):
+        return True
+    raise app_commands.MissingPermissions(list(required_permissions.values()))
+
+
+# Only a default for the whole group, each command checks its own
+@app_commands.guild_only()
+@app_commands.default_permissions(ban_members=True)
 class Admin(commands.GroupCog, group_name='admin'):
     def __init__(self, bot: Bot) -> None:
         self.bot = bot
+        self.executor = Executor(
+            bot,
+            workers=getattr(config, 'admin_workers', 4),
+            progress_interval=getattr(config, 'admin_progress_interval', 3.0)
+        )
+        self.load_task: Optional[asyncio.Task] = None
+
+    async def cog_load(self) -> None:
+        await self.executor.collection.create_index('status')
+        self.load_task = asyncio.create_task(self.resume_running())
+        metrics.registry.register_collector('admin', self.collect_metrics)
+
+    async def cog_unload(self) -> None:
+        metrics.registry.unregister_collector('admin')
+        if self.load_task is not None:
+            self.load_task.cancel()
+        await self.executor.close()
+
+    def collect_metrics(self) -> list[metrics.Sample]:
+        return [('bot_admin_jobs_running', {}, len(self.executor.jobs))]
+
+    async def resume_running(self) -> None:
+        await self.bot.wait_until_ready()
+        cursor = self.executor.collection.find({'status': 'running'})
+        resumed = 0
+        # Other clusters resume the jobs of their own guilds
+        async for document in cluster.owned(self.bot, cursor):
+            await self.executor.resume(document['_id'], document['guild'])
+            resumed += 1
+        log.info(f'Resumed {resumed} admin jobs')
+
+    async def interaction_response(
+        self, interaction: Interaction, content: str
+    ) -> None:
+        await interaction.response.send_message(content, ephemeral=True)
+
+    async def read_targets(
+        self,
+        interaction: Interaction,
+        users: Optional[str],
+        file: Optional[discord.Attachment]
+    ) -> Optional[list[int]]:
+        text = users or ''
+        if file is not None:
+            if file.size > max_file_size:
+                await self.interaction_response(
+                    interaction, 'The file can be up to 1 MB'
+                )
+                return None
+            text += '\n' + (await file.read()).decode(errors='ignore')
+
+        targets = parse_targets(text)
+        if not targets:
+            await self.interaction_response(
+                interaction, 'Give some user IDs or mentions, or a file'
+            )
+            return None
+        if len(targets) > max_targets:
+            await self.interaction_response(
+                interaction, f'A job can target up to {max_targets} users'
+            )
+            return None
+        return targets
+
+    async def submit(
+        self, interaction: Interaction, document: dict
+    ) -> None:
+        document.update({
+            '_id': interaction.id,
+            'guild': interaction.guild_id,
+            'channel': interaction.channel_id,
+            'started_by': interaction.user.id
+        })
+        job = await self.executor.submit(document)
+        await self.interaction_response(
+            interaction,
+            f'Job `{job.id}` has started, progress is posted in this channel'
+        )
+
+    @app_commands.command()
+    @app_commands.checks.has_permissions(ban_members=True)
+    async def ban(
+        self,
+        interaction: Interaction,
+        users: Optional[str] = None,
+        file: Optional[discord.Attachment] = None,
+        reason: Optional[str] = None
+    ) -> None:
+        """Ban many users at once, from IDs, mentions or a file of IDs"""
+        targets = await self.read_targets(interaction, users, file)
+        if targets is None:
+            return
+        document = {'action': 'ban', 'targets': targets, 'reason': reason}
+        await self.submit(interaction, document)
+
+    @app_commands.command()
+    @app_commands.checks.has_permissions(kick_members=True)
+    async def kick(
+        self,
+        interaction: Interaction,
+        users: Optional[str] = None,
+        file: Optional[discord.Attachment] = None,
+        reason: Optional[str] = None
+    ) -> None:
+        """Kick many members at once, from IDs, mentions or a file of IDs"""
+        targets = await self.read_targets(interaction, users, file)
+        if targets is None:
+            return
+        document = {'action': 'kick', 'targets': targets, 'reason': reason}
+        await self.submit(interaction, document)
+
+    @app_commands.command()
+    @app_commands.checks.has_permissions(manage_messages=True)
+    async def purge(
+        self,
+        interaction: Interaction,
+        count: app_commands.Range[int, 1, max_targets],
+        member: Optional[discord.Member] = None,
+        channel: Optional[discord.TextChannel] = None,
+        reason: Optional[str] = None
+    ) -> None:
+        """Delete recent messages, optionally only those of a member"""
+        channel = channel or interaction.channel
+        if not channel.permissions_for(interaction.user).manage_messages:
+            return await self.interaction_response(
+                interaction, f'You cannot manage messages in {channel.mention}'
+            )
+        document = {
+            'action': 'purge',
+            'target_channel': channel.id,
+            'user': member.id if member else None,
+            'limit': count,
+            'reason': reason
+        }
+        await self.submit(interaction, document)
+
+    def parse_job(self, job: str) -> Optional[int]:
+        return int(job) if job.isdigit() else None
+
+    def allowed(self, interaction: Interaction, action: str) -> bool:
+        return getattr(interaction.permissions, required_permissions[action])
+
+    async def missing_permission(
+        self, interaction: Interaction, action: str
+    ) -> None:
+        name = required_permissions[action].replace('_', ' ').title()
+        await self.interaction_response(
+            interaction, f'This job needs the {name} permission'
+        )
+
+    @app_commands.command()
+    @app_commands.check(can_moderate)
+    async def cancel(self, interaction: Interaction, job: str) -> None:
+        """Stop a running job, it can be resumed later"""
+        job_id = self.parse_job(job)
+        running = self.executor.jobs.get(job_id)
+        if running is None or running.guild_id != interaction.guild_id:
+            return await self.interaction_response(
+                interaction, 'There is no running job with that ID'
+            )
+        if not self.allowed(interaction, running.action):
+            return await self.missing_permission(interaction, running.action)
+        await self.executor.cancel(job_id)
+        await self.interaction_response(
+            interaction, f'Job `{job_id}` has been cancelled'
+        )
+
+    @app_commands.command()
+    @app_commands.check(can_moderate)
+    async def resume(self, interaction: Interaction, job: str) -> None:
+        """Continue a cancelled or interrupted job where it stopped"""
+        job_id = self.parse_job(job)
+        resumed = None
+        if job_id is not None:
+            document = await self.executor.collection.find_one(
+                {'_id': job_id, 'guild': interaction.guild_id},
+                {'action': True}
+            )
+            if document and not self.allowed(interaction, document['action']):
+                return await self.missing_permission(
+                    interaction, document['action']
+                )
+            resumed = await self.executor.resume(job_id, interaction.guild_id)
+        if resumed is None:
+            return await self.interaction_response(
+                interaction, 'There is no unfinished job with that ID'
+            )
+        await self.interaction_response(
+            interaction, f'Job `{job_id}` has been resumed'
+        )
+
+    @app_commands.command()
+    @app_commands.check(can_moderate)
+    async def jobs(self, interaction: Interaction) -> None:
+        """Get the unfinished jobs of this server"""
+        query = {
+            'guild': interaction.guild_id,
+            'status': {'$in': ['running', 'cancelled']}
+        }
+        documents = await self.executor.collection.find(query).to_list(20)
+        lines = []
+        for document in documents:
+            # Running jobs have newer progress than their saved document
+            job = self.executor.jobs.get(document['_id']) or Job(document)
+            lines.append(job.describe().split('\n')[0])
+        content = '\n'.join(lines) or 'There are no unfinished jobs'
+        await self.interaction_response(interaction, content)
 
 
 async def setup(bot: Bot) -> None:
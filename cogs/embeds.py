@@ -1,12 +1,159 @@
+import json
+import re
+
+import discord
+from discord import Interaction, app_commands
 from discord.ext import commands
 
 from bot import Bot
+from cogs.utils import mongo, templates
+
+max_templates = 25
+template_name = re.compile(r'[a-z0-9_]{1,32}')
+
 
+def sample_values(interaction: Interaction) -> dict[str, str]:
+    user = interaction.user
+    now = f'<t:{int(discord.utils.utcnow().timestamp())}:f>'
+    return {
+        'name': user.name,
+        'mention': user.mention,
+        'user': user.name,
+        'avatar': user.display_avatar.url,
+        'created': now,
+        'joined': now,
+        'before': 'Message before the edit',
+        'after': 'Message after the edit',
+        'content': 'Deleted message',
+        'author': user.mention,
+        'url': interaction.channel.jump_url,
+        'channel': interaction.channel.mention,
+        'server': interaction.guild.name,
+        'total': '10',
+        'uncached': '2'
+    }
 
+
+@app_commands.guild_only()
+@app_commands.default_permissions(manage_guild=True)
 class Embeds(commands.GroupCog, group_name='embeds'):
     def __init__(self, bot: Bot) -> None:
         self.bot = bot
 
+    async def interaction_response(
+        self, interaction: Interaction, content: str
+    ) -> None:
+        await interaction.response.send_message(content, ephemeral=True)
+
+    @app_commands.command()
+    @app_commands.checks.has_permissions(manage_guild=True)
+    async def set(
+        self, interaction: Interaction, name: str, definition: str
+    ) -> None:
+        """Create or replace a template from its JSON definition"""
+        name = name.lower()
+        if not template_name.fullmatch(name):
+            return await self.interaction_response(
+                interaction, 'Names use up to 32 letters, digits or _'
+            )
+
+        guild = mongo.Guild(interaction.guild_id)
+        guild_settings = await guild.check()
+        stored = guild_settings.get('templates', {})
+        if name not in stored and len(stored) >= max_templates:
+            content = f'A server can have up to {max_templates} templates'
+            return await self.interaction_response(interaction, content)
+
+        try:
+            parsed = json.loads(definition)
+            # Checked against every Discord limit before it is stored
+            templates.Template(templates.kind_of(name), parsed)
+        except json.JSONDecodeError as e:
+            return await self.interaction_response(
+                interaction, f'The definition is not valid JSON: {e}'
+            )
+        except templates.TemplateError as e:
+            return await self.interaction_response(interaction, str(e))
+
+        await guild.update({'$set': {f'templates.{name}': parsed}})
+        await self.interaction_response(
+            interaction, f'Template `{name}` has been saved'
+        )
+
+    @app_commands.command()
+    @app_commands.checks.has_permissions(manage_guild=True)
+    async def reset(self, interaction: Interaction, name: str) -> None:
+        """Delete a template, log templates go back to the default"""
+        name = name.lower()
+        if not template_name.fullmatch(name):
+            return await self.interaction_response(
+                interaction, 'Names use up to 32 letters, digits or _'
+            )
+
+        guild = mongo.Guild(interaction.guild_id)
+        await guild.update({'$unset': {f'templates.{name}': ''}})
+        await self.interaction_response(
+            interaction, f'Template `{name}` has been reset'
+        )
+
+    @app_commands.command()
+    async def show(self, interaction: Interaction, name: str) -> None:
+        """Get the JSON definition of a template"""
+        guild_settings = await mongo.Guild(interaction.guild_id).check()
+        try:
+            template = templates.get(guild_settings, name.lower())
+        except templates.TemplateError as e:
+            return await self.interaction_response(interaction, str(e))
+
+        definition = json.dumps(template.definition, indent=2)
+        await self.interaction_response(
+            interaction, f'```json\n{definition[:1900]}\n```'
+        )
+
+    @app_commands.command()
+    async def preview(self, interaction: Interaction, name: str) -> None:
+        """Render a template with sample values"""
+        guild_settings = await mongo.Guild(interaction.guild_id).check()
+        try:
+            embed = templates.render(
+                guild_settings, name.lower(), **sample_values(interaction)
+            )
+        except templates.TemplateError as e:
+            return await self.interaction_response(interaction, str(e))
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+    @app_commands.command()
+    @app_commands.checks.has_permissions(manage_guild=True)
+    async def send(
+        self,
+        interaction: Interaction,
+        name: str,
+        channel: discord.TextChannel
+    ) -> None:
+        """Send a custom template to a channel"""
+        permissions = channel.permissions_for(interaction.user)
+        if not (permissions.send_messages and permissions.embed_links):
+            return await self.interaction_response(
+                interaction, f'You cannot send embeds in {channel.mention}'
+            )
+
+        guild_settings = await mongo.Guild(interaction.guild_id).check()
+        try:
+            embed = templates.render(
+                guild_settings,
+                name.lower(),
+                server=interaction.guild.name,
+                channel=channel.mention,
+                user=interaction.user.name
+            )
+        except templates.TemplateError as e:
+            return await self.interaction_response(interaction, str(e))
+
+        await channel.send(embed=embed)
+        await self.interaction_response(
+            interaction, f'Template sent to {channel.mention}'
+        )
+
 
 async def setup(bot: Bot) -> None:
     await bot.add_cog(Embeds(bot))
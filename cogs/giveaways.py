@@ -1,11 +1,266 @@
+import asyncio
+import datetime
+import logging
+import random
+from typing import Any, AsyncIterator, Optional
+
+import discord
+from discord import Interaction, app_commands
 from discord.ext import commands
 
+import config
 from bot import Bot
+from cogs.utils import cluster, metrics, mongo
+from cogs.utils.scheduler import Scheduler
+
+log = logging.getLogger(__name__)
+
+emoji = '\N{PARTY POPPER}'
+
+
+async def reservoir_sample(
+    iterator: AsyncIterator[Any], k: int, rng: random.Random = random
+) -> list[Any]:
+    """Pick `k` items uniformly while holding no more than `k` in memory"""
+    reservoir = []
+    seen = 0
+    async for item in iterator:
+        seen += 1
+        if len(reservoir) < k:
+            reservoir.append(item)
+            continue
+        index = rng.randrange(seen)
+        if index < k:
+            reservoir[index] = item
+    return reservoir
+
+
+def giveaway_embed(
+    prize: str, winners: int, ends_at: datetime.datetime, host_id: int
+) -> discord.Embed:
+    title = prize
+    color = discord.Color.blurple()
+    description = f'React with {emoji} to enter!'
+    embed = discord.Embed(title=title, description=description, color=color)
+
+    timestamp = int(ends_at.timestamp())
+    embed.add_field(name='Ends', value=f'<t:{timestamp}:R>', inline=False)
+    embed.add_field(name='Winners', value=str(winners), inline=False)
+    embed.add_field(name='Hosted by', value=f'<@{host_id}>', inline=False)
+
+    return embed
 
 
+def ended_embed(prize: str, winner_ids: list[int]) -> discord.Embed:
+    title = prize
+    color = discord.Color.dark_grey()
+    description = 'Giveaway ended'
+    embed = discord.Embed(title=title, description=description, color=color)
+
+    value = ', '.join(f'<@{w}>' for w in winner_ids) or 'No valid entries'
+    embed.add_field(name='Winners', value=value, inline=False)
+
+    return embed
+
+
+@app_commands.guild_only()
+@app_commands.default_permissions(manage_guild=True)
 class Giveaways(commands.GroupCog, group_name='giveaways'):
     def __init__(self, bot: Bot) -> None:
         self.bot = bot
+        self.scheduler = Scheduler(
+            self.fire,
+            batch_size=getattr(config, 'giveaways_batch_size', 50)
+        )
+        self.load_task: Optional[asyncio.Task] = None
+
+    @property
+    def giveaways(self):
+        return mongo.db['giveaways']
+
+    async def cog_load(self) -> None:
+        await self.giveaways.create_index([('ended', 1), ('ends_at', 1)])
+        self.scheduler.start()
+        self.load_task = asyncio.create_task(self.load_pending())
+        metrics.registry.register_collector('giveaways', self.collect_metrics)
+
+    async def cog_unload(self) -> None:
+        metrics.registry.unregister_collector('giveaways')
+        if self.load_task is not None:
+            self.load_task.cancel()
+        self.scheduler.stop()
+
+    def collect_metrics(self) -> list[metrics.Sample]:
+        return [
+            (f'bot_giveaways_{key}', {}, value)
+            for key, value in self.scheduler.stats().items()
+        ]
+
+    async def load_pending(self) -> None:
+        await self.bot.wait_until_ready()
+        projection = {'ends_at': True, 'guild': True}
+        cursor = self.giveaways.find({'ended': False}, projection)
+        # Other clusters load the giveaways of their own guilds
+        loaded = await self.scheduler.load(cluster.owned(self.bot, cursor))
+        log.info(f'Scheduled {loaded} pending giveaways')
+
+    async def fire(self, message_ids: list[int]) -> None:
+        query = {'_id': {'$in': message_ids}, 'ended': False}
+        documents = await self.giveaways.find(query).to_list(None)
+        results = await asyncio.gather(
+            *(self.finish(document) for document in documents),
+            return_exceptions=True
+        )
+        errors = [r for r in results if isinstance(r, Exception)]
+        if errors:
+            # Giveaways that did end are skipped when the batch is retried
+            raise errors[0]
+
+    async def draw(self, document: dict) -> list[int]:
+        channel = self.bot.get_channel(document['channel'])
+        if channel is None:
+            channel = await self.bot.fetch_channel(document['channel'])
+        message = await channel.fetch_message(document['_id'])
+
+        reaction = discord.utils.get(message.reactions, emoji=emoji)
+        if reaction is None:
+            return []
+        # Pages of entries are fetched as they are sampled
+        entries = (
+            user.id async for user in reaction.users() if not user.bot
+        )
+        return await reservoir_sample(entries, document['winners'])
+
+    async def finish(self, document: dict) -> None:
+        try:
+            winner_ids = await self.draw(document)
+        except (discord.NotFound, discord.Forbidden):
+            winner_ids = None
+
+        # Claiming the giveaway first makes sure it is announced only once
+        query = {'_id': document['_id'], 'ended': False}
+        update = {'$set': {'ended': True, 'winner_ids': winner_ids or []}}
+        claimed = await self.giveaways.find_one_and_update(query, update)
+        if claimed is None or winner_ids is None:
+            return
+
+        await self.announce(document, winner_ids)
+
+    async def announce(self, document: dict, winner_ids: list[int]) -> None:
+        channel = self.bot.get_channel(document['channel'])
+        if channel is None:
+            return
+
+        message = channel.get_partial_message(document['_id'])
+        embed = ended_embed(document['prize'], winner_ids)
+        await message.edit(embed=embed)
+        if winner_ids:
+            mentions = ', '.join(f'<@{w}>' for w in winner_ids)
+            prize = document['prize']
+            content = f'Congratulations {mentions}! You won **{prize}**'
+        else:
+            content = 'Nobody entered the giveaway'
+        await message.reply(content)
+
+    async def interaction_response(
+        self, interaction: Interaction, content: str
+    ) -> None:
+        await interaction.response.send_message(content, ephemeral=True)
+
+    @app_commands.command()
+    @app_commands.checks.has_permissions(manage_guild=True)
+    async def start(
+        self,
+        interaction: Interaction,
+        prize: str,
+        minutes: app_commands.Range[int, 1, 60 * 24 * 30],
+        winners: app_commands.Range[int, 1, 20] = 1,
+        channel: Optional[discord.TextChannel] = None
+    ) -> None:
+        """Start a giveaway that ends after the given minutes"""
+        channel = channel or interaction.channel
+        ends_at = discord.utils.utcnow() + datetime.timedelta(minutes=minutes)
+        embed = giveaway_embed(prize, winners, ends_at, interaction.user.id)
+        message = await channel.send(embed=embed)
+        await message.add_reaction(emoji)
+
+        await self.giveaways.insert_one({
+            '_id': message.id,
+            'guild': interaction.guild_id,
+            'channel': channel.id,
+            'prize': prize,
+            'winners': winners,
+            'host': interaction.user.id,
+            'ends_at': ends_at,
+            'ended': False
+        })
+        self.scheduler.schedule(message.id, ends_at)
+        await self.interaction_response(
+            interaction, f'Giveaway started in {channel.mention}'
+        )
+
+    @app_commands.command()
+    @app_commands.checks.has_permissions(manage_guild=True)
+    async def end(self, interaction: Interaction, message_id: str) -> None:
+        """End a running giveaway now"""
+        if not message_id.isdigit():
+            return await self.interaction_response(
+                interaction, 'The message ID must be a number'
+            )
+
+        query = {
+            '_id': int(message_id),
+            'guild': interaction.guild_id,
+            'ended': False
+        }
+        now = discord.utils.utcnow()
+        update = {'$set': {'ends_at': now}}
+        if await self.giveaways.find_one_and_update(query, update) is None:
+            return await self.interaction_response(
+                interaction, 'There is no running giveaway with that ID'
+            )
+
+        self.scheduler.schedule(int(message_id), now)
+        await self.interaction_response(interaction, 'Ending the giveaway')
+
+    @app_commands.command()
+    @app_commands.checks.has_permissions(manage_guild=True)
+    async def reroll(self, interaction: Interaction, message_id: str) -> None:
+        """Draw new winners for an ended giveaway"""
+        if not message_id.isdigit():
+            return await self.interaction_response(
+                interaction, 'The message ID must be a number'
+            )
+
+        query = {
+            '_id': int(message_id),
+            'guild': interaction.guild_id,
+            'ended': True
+        }
+        document = await self.giveaways.find_one(query)
+        if document is None:
+            return await self.interaction_response(
+                interaction, 'There is no ended giveaway with that ID'
+            )
+
+        await interaction.response.defer(ephemeral=True)
+        try:
+            winner_ids = await self.draw(document)
+        except (discord.NotFound, discord.Forbidden):
+            return await interaction.followup.send(
+                'The giveaway message can no longer be read', ephemeral=True
+            )
+        await self.giveaways.update_one(
+            {'_id': document['_id']}, {'$set': {'winner_ids': winner_ids}}
+        )
+        try:
+            await self.announce(document, winner_ids)
+        except (discord.NotFound, discord.Forbidden):
+            return await interaction.followup.send(
+                'New winners drawn, but they could not be announced',
+                ephemeral=True
+            )
+        await interaction.followup.send('New winners drawn', ephemeral=True)
 
 
 async def setup(bot: Bot) -> None:
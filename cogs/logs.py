@@ -1,13 +1,24 @@
-from importlib import reload
-from typing import Optional
+import datetime
+import io
+import logging
+from typing import Any, Mapping, Optional, Union
 
 import discord
 from discord import ButtonStyle, Interaction, app_commands
 from discord.ext import commands
 from discord.ui import Button, View
 
+import config
 from bot import Bot
-from cogs.utils import mongo
+from cogs.utils import delivery, digest, metrics, mongo, templates, webhooks
+from cogs.utils.cache import SingleFlight, TTLCache
+from cogs.utils.messages import CachedMessage, MessageCache
+
+log = logging.getLogger(__name__)
+
+requirements = {
+    'intents': ['members', 'guild_messages', 'message_content']
+}
 
 logs_options = [
     'Joined',
@@ -35,6 +46,48 @@ def logs_embed(options: list[str], settings: dict[str, str]) -> discord.Embed:
     return embed
 
 
+def digest_embed(
+    kind: str, rows: list[digest.Row], total: int, since: int, last: bool
+) -> discord.Embed:
+    verb = 'joined' if kind == 'joined' else 'left'
+    if total:
+        title = f'{total} users {verb} the server'
+    else:
+        title = f'{kind.title()} logs are back to normal'
+    if kind == 'joined':
+        color = discord.Color.brand_green()
+    else:
+        color = discord.Color.brand_red()
+    description = (
+        f'Too many users {verb} to log one by one, they are summarised '
+        f'here since <t:{since}:f>.'
+    )
+    if rows:
+        description += ' The attached file lists every account.'
+    embed = discord.Embed(title=title, description=description, color=color)
+
+    if rows:
+        first, last_row = rows[0][3], rows[-1][3]
+        embed.add_field(
+            name='Between',
+            value=(
+                f'<t:{int(first.timestamp())}:T> and '
+                f'<t:{int(last_row.timestamp())}:T>'
+            )
+        )
+        week_ago = discord.utils.utcnow() - datetime.timedelta(days=7)
+        recent = sum(1 for row in rows if row[2] > week_ago)
+        embed.add_field(name='Accounts under a week old', value=str(recent))
+    if total > len(rows):
+        embed.add_field(
+            name='Not listed', value=f'{total - len(rows)} over the limit'
+        )
+    if last:
+        embed.set_footer(text='Activity is back to normal, logging resumes')
+
+    return embed
+
+
 class ResetLogsButton(Button):
     def __init__(self, option: str, has_value: bool) -> None:
         style = ButtonStyle.danger
@@ -44,8 +97,7 @@ class ResetLogsButton(Button):
     async def callback(self, interaction: Interaction) -> None:
         guild = mongo.Guild(interaction.guild_id)
         query = {'$set': {self.label.lower(): None}}
-        await guild.update(query)
-        guild_settings = await guild.check()
+        guild_settings = await guild.update(query, return_document=True)
 
         embed = logs_embed(logs_options, guild_settings)
         view = ResetLogsView(logs_options, guild_settings)
@@ -63,9 +115,68 @@ class ResetLogsView(View):
 class Logs(commands.GroupCog, group_name='logs'):
     def __init__(self, bot: Bot) -> None:
         self.bot = bot
+        self.webhooks = None
+        sender = delivery.channel_send
+        if getattr(config, 'logs_webhooks', False):
+            self.webhooks = webhooks.WebhookSender(bot)
+            sender = self.webhooks
+        self.dispatcher = delivery.Dispatcher(
+            sender=sender,
+            max_size=getattr(config, 'logs_queue_size', 250),
+            flush_window=getattr(config, 'logs_flush_window', 1.0)
+        )
+        self.messages = MessageCache(
+            per_guild=getattr(config, 'message_cache_per_guild', 1000),
+            max_bytes=getattr(config, 'message_cache_bytes', 64 * 1024 * 1024)
+        )
+        # Guilds and channels that could not be fetched, skipped until the
+        # entry expires instead of failing a request on every event
+        self.lookups = SingleFlight()
+        self.missing = TTLCache(
+            max_size=10_000, ttl=getattr(config, 'logs_missing_ttl', 600)
+        )
+        # Joins and leaves are summarised while a guild is being raided
+        self.digests = digest.DigestManager(
+            self.send_digest,
+            window=getattr(config, 'logs_digest_window', 10.0),
+            enter=getattr(config, 'logs_digest_enter', 10),
+            leave=getattr(config, 'logs_digest_leave', 3),
+            interval=getattr(config, 'logs_digest_interval', 30.0),
+            max_rows=getattr(config, 'logs_digest_max_rows', 10_000)
+        )
 
     async def cog_load(self) -> None:
-        reload(mongo)
+        if self.webhooks is not None:
+            await self.webhooks.start()
+        metrics.registry.register_collector('logs', self.collect_metrics)
+
+    async def cog_unload(self) -> None:
+        metrics.registry.unregister_collector('logs')
+        await self.digests.close()
+        await self.dispatcher.close()
+        if self.webhooks is not None:
+            await self.webhooks.close()
+
+    def collect_metrics(self) -> list[metrics.Sample]:
+        stats = self.dispatcher.stats()
+        samples = [
+            (f'bot_logs_delivery_{key}', {}, stats[key])
+            for key in (
+                'channels', 'depth', 'max_depth', 'messages', 'delivered',
+                'dropped', 'failed', 'average_latency', 'max_latency'
+            )
+        ]
+        samples.extend(
+            (f'bot_logs_message_cache_{key}', {}, value)
+            for key, value in self.messages.stats().items()
+        )
+        samples.append(('bot_logs_missing_channels', {}, len(self.missing)))
+        samples.append(('bot_logs_lookups_in_flight', {}, len(self.lookups)))
+        samples.extend(
+            (f'bot_logs_digests_{key}', {}, value)
+            for key, value in self.digests.stats().items()
+        )
+        return samples
 
     async def update_guild(
         self, guild_id: int, channel_id: int, option: str
@@ -73,6 +184,7 @@ class Logs(commands.GroupCog, group_name='logs'):
         guild = mongo.Guild(guild_id)
         query = {'$set': {option: channel_id}}
         await guild.update(query)
+        self.missing.pop(('channel', channel_id))
 
     async def interaction_response(self, interaction: Interaction) -> None:
         content = 'Logs settings have been updated successfully'
@@ -110,176 +222,396 @@ class Logs(commands.GroupCog, group_name='logs'):
         await self.update_guild(interaction.guild_id, channel.id, 'deleted')
         await self.interaction_response(interaction)
 
+    async def guild_settings(self, guild_id: int) -> Mapping[str, Any]:
+        return await mongo.Guild(guild_id).check()
+
     async def get_logs_channel(
         self, guild_id: int, option: str
     ) -> Optional[str]:
-        guild = mongo.Guild(guild_id)
-        guild_settings = await guild.check()
+        guild_settings = await self.guild_settings(guild_id)
         return guild_settings.get(option, None)
 
-    async def find_guild(self, guild_id: int) -> discord.Guild:
+    async def find_guild(self, guild_id: int) -> Optional[discord.Guild]:
         guild = self.bot.get_guild(guild_id)
-        if not guild:
-            guild = await self.bot.fetch_guild(guild_id)
-        return guild
+        if guild is not None:
+            return guild
+
+        key = ('guild', guild_id)
+        if key in self.missing:
+            return None
+        return await self.lookups.do(key, self.fetch_guild, guild_id)
+
+    async def fetch_guild(self, guild_id: int) -> Optional[discord.Guild]:
+        try:
+            return await self.bot.fetch_guild(guild_id)
+        except (discord.NotFound, discord.Forbidden):
+            self.missing.set(('guild', guild_id), True)
+            return None
 
     async def find_channel(
         self, guild_id: int, channel_id: int
-    ) -> discord.TextChannel:
+    ) -> Optional[discord.TextChannel]:
         guild = await self.find_guild(guild_id)
+        if guild is None:
+            return None
+
         channel = guild.get_channel(channel_id)
-        if not channel:
-            channel = await guild.fetch_channel(channel_id)
-        return channel
+        if channel is not None:
+            return channel
+
+        key = ('channel', channel_id)
+        if key in self.missing:
+            return None
+        return await self.lookups.do(
+            key, self.fetch_channel, guild, channel_id
+        )
 
-    def joined_embed(self, member: discord.Member) -> discord.Embed:
-        title = 'A user has joined the server!'
-        color = discord.Color.brand_green()
-        embed = discord.Embed(title=title, color=color)
+    async def fetch_channel(
+        self, guild: discord.Guild, channel_id: int
+    ) -> Optional[discord.TextChannel]:
+        try:
+            return await guild.fetch_channel(channel_id)
+        except (discord.NotFound, discord.InvalidData):
+            # Deleted, or moved out of the guild
+            self.missing.set(('channel', channel_id), True)
+            await self.forget_channel(guild.id, channel_id)
+        except discord.Forbidden:
+            self.missing.set(('channel', channel_id), True)
+        return None
+
+    async def forget_channel(self, guild_id: int, channel_id: int) -> None:
+        """Reset every option that still points at a deleted channel"""
+        guild = mongo.Guild(guild_id)
+        guild_settings = await guild.check()
+        options = [
+            option.lower() for option in logs_options
+            if guild_settings.get(option.lower()) == channel_id
+        ]
+        if not options:
+            return
 
-        timestamp = int(member.created_at.timestamp())
-        formatted_timestamp = f'<t:{timestamp}:f>'
+        query = {
+            '$set': {option: None for option in options},
+            '$unset': {f'webhooks.{channel_id}': ''}
+        }
+        await guild.update(query)
+        if self.webhooks is not None:
+            self.webhooks.webhooks.pop(channel_id, None)
+        log.info(
+            f'Reset logs {", ".join(options)} in guild {guild_id}, '
+            f'channel {channel_id} no longer exists'
+        )
 
-        embed.add_field(name='Account Name', value=member.name, inline=False)
-        embed.add_field(
-            name='Account Creation', value=formatted_timestamp, inline=False
+    def joined_embed(
+        self, guild_settings: Mapping[str, Any], member: discord.Member
+    ) -> discord.Embed:
+        timestamp = int(member.created_at.timestamp())
+        return templates.render(
+            guild_settings,
+            'joined',
+            name=member.name,
+            mention=member.mention,
+            created=f'<t:{timestamp}:f>',
+            avatar=member.display_avatar.url
         )
-        embed.set_thumbnail(url=member.avatar.url)
 
-        return embed
+    async def send_digest(
+        self,
+        entry: digest.Digest,
+        rows: list[digest.Row],
+        total: int,
+        last: bool
+    ) -> None:
+        channel_id = await self.get_logs_channel(entry.guild_id, entry.kind)
+        if not channel_id:
+            return
+
+        channel = await self.find_channel(entry.guild_id, channel_id)
+        if channel is None:
+            return
+
+        since = int(entry.started.timestamp())
+        embed = digest_embed(entry.kind, rows, total, since, last)
+        if not rows:
+            return await channel.send(embed=embed)
+        file = discord.File(
+            io.BytesIO(digest.rows_csv(rows)),
+            filename=f'{entry.kind}-{since}.csv'
+        )
+        await channel.send(embed=embed, file=file)
 
     @commands.Cog.listener()
+    @metrics.instrument('logs')
     async def on_member_join(self, member: discord.Member) -> None:
         guild_id = member.guild.id
-        channel_id = await self.get_logs_channel(guild_id, 'joined')
+        guild_settings = await self.guild_settings(guild_id)
+        channel_id = guild_settings.get('joined')
 
         if not channel_id:
             return
 
-        channel = await self.find_channel(guild_id, channel_id)
-        embed = self.joined_embed(member)
-        await channel.send(embed=embed)
+        joined_at = member.joined_at or discord.utils.utcnow()
+        row = (member.id, member.name, member.created_at, joined_at)
+        if self.digests.record(guild_id, 'joined', row):
+            return
 
-    def left_embed(self, member: discord.Member) -> discord.Embed:
-        title = 'A user has left the server'
-        color = discord.Color.brand_red()
-        embed = discord.Embed(title=title, color=color)
+        channel = await self.find_channel(guild_id, channel_id)
+        if channel is None:
+            return
 
-        timestamp = int(member.joined_at.timestamp())
-        formatted_timestamp = f'<t:{timestamp}:f>'
+        embed = self.joined_embed(guild_settings, member)
+        self.dispatcher.push(channel, embed)
 
-        embed.add_field(name='Account Name', value=member.name, inline=False)
-        embed.add_field(
-            name='Joined Server', value=formatted_timestamp, inline=False
+    def left_embed(
+        self,
+        guild_settings: Mapping[str, Any],
+        member: Union[discord.Member, discord.User]
+    ) -> discord.Embed:
+        # Members are not cached, so the join date is not always known
+        joined_at = getattr(member, 'joined_at', None)
+        if joined_at:
+            formatted_timestamp = f'<t:{int(joined_at.timestamp())}:f>'
+        else:
+            formatted_timestamp = '`Unknown`'
+
+        return templates.render(
+            guild_settings,
+            'left',
+            name=member.name,
+            mention=member.mention,
+            joined=formatted_timestamp,
+            avatar=member.display_avatar.url
         )
-        embed.set_thumbnail(url=member.avatar.url)
-
-        return embed
 
     @commands.Cog.listener()
+    @metrics.instrument('logs')
     async def on_raw_member_remove(
         self, payload: discord.RawMemberRemoveEvent
     ) -> None:
         guild_id = payload.guild_id
-        channel_id = await self.get_logs_channel(guild_id, 'joined')
+        guild_settings = await self.guild_settings(guild_id)
+        channel_id = guild_settings.get('left')
 
         if not channel_id:
             return
 
+        user = payload.user
+        row = (user.id, user.name, user.created_at, discord.utils.utcnow())
+        if self.digests.record(guild_id, 'left', row):
+            return
+
         channel = await self.find_channel(guild_id, channel_id)
-        embed = self.left_embed(payload.user)
-        await channel.send(embed=embed)
+        if channel is None:
+            return
+
+        embed = self.left_embed(guild_settings, payload.user)
+        self.dispatcher.push(channel, embed)
 
     async def find_message(
         self, guild_id: int, channel_id: int, message_id: int
-    ) -> discord.Message:
+    ) -> Optional[discord.Message]:
         channel = await self.find_channel(guild_id, channel_id)
-        message = await channel.fetch_message(message_id)
-        return message
+        if channel is None:
+            return None
+        try:
+            return await channel.fetch_message(message_id)
+        except (discord.NotFound, discord.Forbidden):
+            return None
 
     def edited_embed(
-        self, before: str, after: str, author: str, url: str
+        self,
+        guild_settings: Mapping[str, Any],
+        before: str,
+        after: str,
+        author: str,
+        url: str
     ) -> discord.Embed:
-        title = 'A message has been edited'
-        color = discord.Color.yellow()
-        embed = discord.Embed(title=title, color=color)
+        return templates.render(
+            guild_settings, 'edited', before=before, after=after,
+            author=author, url=url
+        )
 
-        embed.add_field(name='Before', value=before, inline=False)
-        embed.add_field(name='After', value=after, inline=False)
-        embed.add_field(name='Author', value=author, inline=False)
-        embed.add_field(
-            name='Jump to message',
-            value=f'[[Click here]]({url})',
-            inline=False
+    def from_message(self, message: discord.Message) -> CachedMessage:
+        return CachedMessage(
+            message.id, message.channel.id, message.author.id, message.content
         )
 
-        return embed
+    def cached_message(
+        self,
+        guild_id: int,
+        message_id: int,
+        fallback: Optional[discord.Message]
+    ) -> Optional[CachedMessage]:
+        message = self.messages.get(guild_id, message_id)
+        if message is None and fallback is not None:
+            message = self.from_message(fallback)
+        return message
+
+    @commands.Cog.listener()
+    @metrics.instrument('logs')
+    async def on_message(self, message: discord.Message) -> None:
+        if message.guild is None:
+            return
+
+        guild_id = message.guild.id
+        guild_settings = await self.guild_settings(guild_id)
+        if not (guild_settings.get('edited') or guild_settings.get('deleted')):
+            return
+
+        self.messages.add(guild_id, self.from_message(message))
 
     @commands.Cog.listener()
+    @metrics.instrument('logs')
     async def on_raw_message_edit(
         self, payload: discord.RawMessageUpdateEvent
     ) -> None:
+        data = payload.data
+        if 'content' not in data:
+            # Embed and attachment updates do not change the content
+            return
+
         guild_id = payload.guild_id
-        channel_id = await self.get_logs_channel(guild_id, 'edited')
+        before_message = self.cached_message(
+            guild_id, payload.message_id, payload.cached_message
+        )
+        after = data['content']
+        self.messages.update(guild_id, payload.message_id, after)
+
+        guild_settings = await self.guild_settings(guild_id)
+        channel_id = guild_settings.get('edited')
 
         if not channel_id:
             return
 
-        before_message = payload.cached_message
-        after_message = await self.find_message(
-            guild_id, payload.channel_id, payload.message_id
-        )
-
-        try:
+        if before_message is not None:
             before = before_message.content
-        except Exception:
+        else:
             before = '`Message content not cached`'
-        after = after_message.content
 
         if before == after:
             return
 
-        author = after_message.author
+        if 'author' in data:
+            author_id = int(data['author']['id'])
+        elif before_message is not None:
+            author_id = before_message.author_id
+        else:
+            after_message = await self.find_message(
+                guild_id, payload.channel_id, payload.message_id
+            )
+            if after_message is None:
+                return
+            author_id = after_message.author.id
+
+        url = 'https://discord.com/channels/'\
+            f'{guild_id}/{payload.channel_id}/{payload.message_id}'
         channel = await self.find_channel(guild_id, channel_id)
+        if channel is None:
+            return
+
         embed = self.edited_embed(
-            before, after, author.mention, after_message.jump_url
+            guild_settings, before, after, f'<@{author_id}>', url
         )
-        await channel.send(embed=embed)
+        self.dispatcher.push(channel, embed)
 
     def deleted_embed(
-        self, content: str, author: str, channel_id: int
+        self,
+        guild_settings: Mapping[str, Any],
+        content: str,
+        author: str,
+        channel_id: int
     ) -> discord.Embed:
-        title = 'A message has been deleted'
-        color = discord.Color.brand_red()
-        embed = discord.Embed(title=title, color=color)
-
-        embed.add_field(name='Content', value=content, inline=False)
-        embed.add_field(name='Author', value=author, inline=False)
-        embed.add_field(name='Channel', value=f'<#{channel_id}>', inline=False)
-
-        return embed
+        return templates.render(
+            guild_settings, 'deleted', content=content, author=author,
+            channel=f'<#{channel_id}>'
+        )
 
     @commands.Cog.listener()
+    @metrics.instrument('logs')
     async def on_raw_message_delete(
         self, payload: discord.RawMessageDeleteEvent
     ) -> None:
         guild_id = payload.guild_id
-        channel_id = await self.get_logs_channel(guild_id, 'deleted')
+        guild_settings = await self.guild_settings(guild_id)
+        channel_id = guild_settings.get('deleted')
+
+        message = self.cached_message(
+            guild_id, payload.message_id, payload.cached_message
+        )
+        self.messages.pop(guild_id, payload.message_id)
 
         if not channel_id:
             return
 
-        try:
-            content = payload.cached_message.content
-        except Exception:
+        if message is not None:
+            content = message.content
+            author = f'<@{message.author_id}>'
+        else:
             content = '`Message content not cached`'
+            author = '`Unknown`'
 
-        author = payload.cached_message.author
         channel = await self.find_channel(guild_id, channel_id)
+        if channel is None:
+            return
+
         embed = self.deleted_embed(
-            content, author.mention, payload.channel_id
+            guild_settings, content, author, payload.channel_id
+        )
+        self.dispatcher.push(channel, embed)
+
+    def bulk_deleted_embed(
+        self,
+        guild_settings: Mapping[str, Any],
+        total: int,
+        uncached: int,
+        channel_id: int
+    ) -> discord.Embed:
+        return templates.render(
+            guild_settings, 'bulk_deleted', total=str(total),
+            uncached=str(uncached), channel=f'<#{channel_id}>'
+        )
+
+    @commands.Cog.listener()
+    @metrics.instrument('logs')
+    async def on_raw_bulk_message_delete(
+        self, payload: discord.RawBulkMessageDeleteEvent
+    ) -> None:
+        guild_id = payload.guild_id
+        guild_settings = await self.guild_settings(guild_id)
+        channel_id = guild_settings.get('deleted')
+
+        fallback = {m.id: m for m in payload.cached_messages}
+        deleted_messages = []
+        for message_id in payload.message_ids:
+            message = self.cached_message(
+                guild_id, message_id, fallback.get(message_id)
+            )
+            self.messages.pop(guild_id, message_id)
+            if message is not None:
+                deleted_messages.append(message)
+
+        if not channel_id:
+            return
+
+        channel = await self.find_channel(guild_id, channel_id)
+        if channel is None:
+            return
+
+        uncached = len(payload.message_ids) - len(deleted_messages)
+        embed = self.bulk_deleted_embed(
+            guild_settings, len(payload.message_ids), uncached,
+            payload.channel_id
         )
-        await channel.send(embed=embed)
+        self.dispatcher.push(channel, embed)
+
+        for message in deleted_messages:
+            embed = self.deleted_embed(
+                guild_settings,
+                message.content,
+                f'<@{message.author_id}>',
+                payload.channel_id
+            )
+            self.dispatcher.push(channel, embed)
 
 
 async def setup(bot: Bot) -> None:
@@ -1,19 +1,46 @@
+from typing import Optional
+
+import discord
 from discord.ext import commands
 import logging
 
+import config
 from bot import Bot
+from cogs.utils import metrics
+from cogs.utils.sync import CommandSync, SyncResult
 
 log = logging.getLogger(__name__)
 
+requirements = {
+    'intents': ['guild_messages', 'message_content']
+}
+
 
 class Owner(commands.Cog):
     def __init__(self, bot: Bot) -> None:
         self.bot = bot
         self.delay = 10  # Seconds to wait to delete a message
+        self.command_sync = CommandSync(
+            bot.tree,
+            concurrency=getattr(config, 'command_sync_concurrency', 4)
+        )
 
     async def cog_check(self, ctx: commands.Context) -> bool:
         return await self.bot.is_owner(ctx.author)
 
+    async def cog_load(self) -> None:
+        self.bot.cluster.register('update', self.update_extensions)
+        self.bot.cluster.register('load', self.load_extension)
+        self.bot.cluster.register('unload', self.unload_extension)
+        self.bot.cluster.register('reload', self.reload_extension)
+        self.bot.cluster.register('watch', self.watch_extensions)
+        self.bot.cluster.register('tap', self.gateway_tap)
+
+    async def cog_unload(self) -> None:
+        names = ('update', 'load', 'unload', 'reload', 'watch', 'tap')
+        for command in names:
+            self.bot.cluster.unregister(command)
+
     @commands.command(name='cogs', hidden=True)
     async def cogs(self, ctx: commands.Context) -> None:
         """Get the cog list"""
@@ -22,129 +49,244 @@ class Owner(commands.Cog):
         await ctx.send(content, delete_after=self.delay)
         await ctx.message.delete(delay=self.delay)
 
+    async def send_results(
+        self, ctx: commands.Context, results: list[dict]
+    ) -> None:
+        lines = []
+        for result in results:
+            output = result['result']
+            if isinstance(output, str):
+                output = [output]
+            for line in output:
+                if len(results) > 1:
+                    line = f'[Cluster {result["cluster"]}] {line}'
+                lines.append(line)
+
+        content = '\n'.join(lines) or 'Nothing to do'
+        await ctx.send(content[:2000], delete_after=self.delay)
+
+    async def update_extensions(self) -> list[str]:
+        output = await self.bot.reloader.reload()
+        return output or ['No extensions have changed.']
+
+    async def watch_extensions(self, enabled: bool) -> str:
+        if enabled:
+            self.bot.reloader.watch()
+            return 'Watching extensions for changes.'
+        self.bot.reloader.stop_watching()
+        return 'Stopped watching extensions.'
+
+    async def gateway_tap(
+        self, action: str, ratio: float, events: list[str]
+    ) -> list[str]:
+        tap = self.bot.gateway_tap
+        if action == 'on':
+            tap.start(ratio, events)
+            filters = ', '.join(sorted(tap.events)) if tap.events else 'all'
+            return [
+                f'Capturing {tap.ratio:.0%} of {filters} events '
+                f'to {tap.filename}.'
+            ]
+        if action == 'off':
+            tap.stop()
+
+        state = 'Running' if tap.running else 'Stopped'
+        lines = [f'{state}, captured {sum(tap.captured.values())} events.']
+        for event, count in tap.seen.most_common(10):
+            lines.append(
+                f'{event}: {count} seen, {tap.captured[event]} captured'
+            )
+        return lines
+
+    async def load_extension(self, extension: str) -> str:
+        try:
+            await self.bot.load_extension(f'cogs.{extension}')
+        except commands.ExtensionError as e:
+            log.exception(f'Failed to load extension {extension}')
+            return f'{e.__class__.__name__}: {e}'
+        log.info(f'Successfully loaded extension {extension}')
+        return f'Extension \'{extension}\' loaded.'
+
+    async def unload_extension(self, extension: str) -> str:
+        try:
+            await self.bot.unload_extension(f'cogs.{extension}')
+        except commands.ExtensionError as e:
+            log.exception(f'Failed to unload extension {extension}')
+            return f'{e.__class__.__name__}: {e}'
+        log.info(f'Successfully unloaded extension {extension}')
+        return f'Extension \'{extension}\' unloaded.'
+
+    async def reload_extension(self, extension: str) -> str:
+        try:
+            await self.bot.reload_extension(f'cogs.{extension}')
+        except commands.ExtensionError as e:
+            log.exception(f'Failed to reload extension {extension}')
+            return f'{e.__class__.__name__}: {e}'
+        log.info(f'Successfully reloaded extension {extension}')
+        return f'Extension \'{extension}\' reloaded.'
+
+    @commands.command(name='timings', hidden=True)
+    async def timings(self, ctx: commands.Context) -> None:
+        """Get how long each extension took to load"""
+        timings = sorted(
+            self.bot.extension_timings.items(),
+            key=lambda item: item[1],
+            reverse=True
+        )
+        content = '\n'.join(
+            f'{extension}: {elapsed * 1000:.1f} ms'
+            for extension, elapsed in timings
+        )
+        await ctx.send(
+            content or 'No extensions have been loaded',
+            delete_after=self.delay
+        )
+        await ctx.message.delete(delay=self.delay)
+
+    def summarize(self, histogram: metrics.Histogram, label: str) -> list:
+        lines = []
+        for labels in sorted(histogram.values):
+            values = dict(labels)
+            count = histogram.count(**values)
+            p99 = histogram.quantile(0.99, **values) * 1000
+            lines.append(f'{values[label]}: {count} calls, p99 <= {p99:g} ms')
+        return lines
+
+    @commands.command(name='metrics', hidden=True)
+    async def show_metrics(self, ctx: commands.Context) -> None:
+        """Get listener, database and HTTP statistics"""
+        lines = ['**Listeners**']
+        lines += self.summarize(metrics.listener_latency, 'listener')
+        errors = sum(metrics.listener_errors.values.values())
+        lines.append(f'errors: {errors:g}')
+
+        lines.append('**MongoDB**')
+        lines += self.summarize(metrics.mongo_latency, 'command')
+
+        requests = sum(metrics.http_requests.values.values())
+        ratelimited = metrics.http_ratelimited.values
+        lines.append('**HTTP**')
+        lines.append(f'requests: {requests:g}')
+        lines.append(f'rate limited: {sum(ratelimited.values()):g}')
+        worst = sorted(ratelimited.items(), key=lambda i: i[1], reverse=True)
+        for labels, count in worst[:5]:
+            lines.append(f'{dict(labels)["route"]}: {count:g} 429s')
+
+        await ctx.send('\n'.join(lines)[:2000], delete_after=self.delay)
+        await ctx.message.delete(delay=self.delay)
+
     @commands.command(name='update', hidden=True)
     async def update(self, ctx: commands.Context) -> None:
-        """Reload all extensions"""
-        cog_list = [c for c in self.bot.cogs]
-        for cog in cog_list:
-            extension = cog.lower()
-            try:
-                await self.bot.reload_extension(f'cogs.{extension}')
-            except Exception as e:
-                await ctx.send(
-                    f'{e.__class__.__name__}: {e}',
-                    delete_after=self.delay
-                )
-                log.exception(f'Failed to reload extension {extension}')
-            else:
-                await ctx.send(
-                    f'Extension \'{extension}\' reloaded.',
-                    delete_after=self.delay
-                )
-                log.info(f'Successfully reloaded extension {extension}')
+        """Reload the extensions that changed"""
+        results = await self.bot.cluster.broadcast('update')
+        await self.send_results(ctx, results)
+        await ctx.message.delete(delay=self.delay)
+
+    @commands.command(name='watch', hidden=True)
+    async def watch(self, ctx: commands.Context, enabled: bool) -> None:
+        """Reload changed extensions automatically"""
+        results = await self.bot.cluster.broadcast('watch', enabled=enabled)
+        await self.send_results(ctx, results)
+        await ctx.message.delete(delay=self.delay)
+
+    @commands.command(name='tap', hidden=True)
+    async def tap(
+        self,
+        ctx: commands.Context,
+        action: str = 'status',
+        ratio: float = 1.0,
+        *events: str
+    ) -> None:
+        """Capture gateway events: on [ratio] [events...], off or status"""
+        results = await self.bot.cluster.broadcast(
+            'tap', action=action, ratio=ratio, events=list(events)
+        )
+        await self.send_results(ctx, results)
         await ctx.message.delete(delay=self.delay)
 
     @commands.command(name='load', hidden=True)
     async def load(self, ctx: commands.Context, extension: str) -> None:
         """Loads a extension"""
-        try:
-            await self.bot.load_extension(f'cogs.{extension}')
-        except commands.ExtensionError as e:
-            await ctx.send(
-                f'{e.__class__.__name__}: {e}',
-                delete_after=self.delay
-            )
-            log.exception(f'Failed to load extension {extension}')
-        else:
-            await ctx.send(
-                f'Extension \'{extension}\' loaded.',
-                delete_after=self.delay
-            )
-            log.info(f'Successfully loaded extension {extension}')
+        results = await self.bot.cluster.broadcast(
+            'load', extension=extension
+        )
+        await self.send_results(ctx, results)
         await ctx.message.delete(delay=self.delay)
 
     @commands.command(name='unload', hidden=True)
     async def unload(self, ctx: commands.Context, extension: str) -> None:
         """Unloads a extension"""
-        try:
-            await self.bot.unload_extension(f'cogs.{extension}')
-        except commands.ExtensionError as e:
-            await ctx.send(
-                f'{e.__class__.__name__}: {e}',
-                delete_after=self.delay
-            )
-            log.exception(f'Failed to unload extension {extension}')
-        else:
-            await ctx.send(
-                f'Extension \'{extension}\' unloaded.',
-                delete_after=self.delay
-            )
-            log.info(f'Successfully unloaded extension {extension}')
+        results = await self.bot.cluster.broadcast(
+            'unload', extension=extension
+        )
+        await self.send_results(ctx, results)
         await ctx.message.delete(delay=self.delay)
 
     @commands.command(name='reload', hidden=True)
     async def reload(self, ctx: commands.Context, extension: str) -> None:
         """Reloads a extension"""
-        try:
-            await self.bot.reload_extension(f'cogs.{extension}')
-        except commands.ExtensionError as e:
-            await ctx.send(
-                f'{e.__class__.__name__}: {e}',
-                delete_after=self.delay
-            )
-            log.exception(f'Failed to reload extension {extension}')
-        else:
-            await ctx.send(
-                f'Extension \'{extension}\' reloaded.',
-                delete_after=self.delay
-            )
-            log.info(f'Successfully reloaded extension {extension}')
+        results = await self.bot.cluster.broadcast(
+            'reload', extension=extension
+        )
+        await self.send_results(ctx, results)
         await ctx.message.delete(delay=self.delay)
 
-    @commands.command(name='sync', hidden=True)
-    async def sync(self, ctx: commands.Context, target: str) -> None:
-        """Syncs the slash commands"""
+    def sync_targets(
+        self, ctx: commands.Context, target: str
+    ) -> Optional[list[Optional[discord.Object]]]:
         if target == 'global':
-            guild = None
-        elif target == 'guild':
-            guild = ctx.guild
-            self.bot.tree.copy_global_to(guild=guild)
+            return [None]
+        if target == 'guild':
+            guild_ids = [ctx.guild.id] if ctx.guild else []
         else:
+            guild_ids = [int(i) for i in target.split(',') if i.isdigit()]
+        if not guild_ids:
+            return None
+
+        guilds = [discord.Object(guild_id) for guild_id in guild_ids]
+        for guild in guilds:
+            self.bot.tree.copy_global_to(guild=guild)
+        return guilds
+
+    async def send_sync_results(
+        self, ctx: commands.Context, results: list[SyncResult]
+    ) -> None:
+        synced = sum(result.synced for result in results)
+        lines = [f'Synced {synced} of {len(results)} targets']
+        lines += [result.describe() for result in results]
+        await ctx.send('\n'.join(lines)[:2000], delete_after=self.delay)
+        await ctx.message.delete(delay=self.delay)
+
+    @commands.command(name='sync', hidden=True)
+    async def sync(
+        self, ctx: commands.Context, target: str, force: bool = False
+    ) -> None:
+        """Syncs the slash commands that changed: global, guild or IDs"""
+        guilds = self.sync_targets(ctx, target)
+        if guilds is None:
             return await ctx.send(
                 'You need to specify the sync target',
                 delete_after=self.delay
             )
 
-        commands_sync = await self.bot.tree.sync(guild=guild)
-        await ctx.send(
-            f'Successfully synced {len(commands_sync)} commands',
-            delete_after=self.delay
-        )
-        log.info(f'Successfully synced {len(commands_sync)} commands')
-        await ctx.message.delete(delay=self.delay)
+        results = await self.command_sync.sync_many(guilds, force=force)
+        await self.send_sync_results(ctx, results)
 
     @commands.command(name='clear', hidden=True)
     async def clear(self, ctx: commands.Context, target: str) -> None:
-        """Clears the slash commands"""
-        if target == 'global':
-            guild = None
-        elif target == 'guild':
-            guild = ctx.guild
-            self.bot.tree.copy_global_to(guild=guild)
-        else:
+        """Clears the slash commands: global, guild or IDs"""
+        guilds = self.sync_targets(ctx, target)
+        if guilds is None:
             return await ctx.send(
                 'You need to specify the clear target',
                 delete_after=self.delay
             )
 
-        self.bot.tree.clear_commands(guild=guild)
-        await self.bot.tree.sync(guild=guild)
-        await ctx.send(
-            'Successfully cleared commands',
-            delete_after=self.delay
-        )
-        log.info('Successfully cleared commands')
-        await ctx.message.delete(delay=self.delay)
+        for guild in guilds:
+            self.bot.tree.clear_commands(guild=guild)
+        # An empty tree matches targets that have no stored hashes
+        results = await self.command_sync.sync_many(guilds, force=True)
+        await self.send_sync_results(ctx, results)
 
 
 async def setup(bot: Bot) -> None:
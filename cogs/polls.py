@@ -1,11 +1,351 @@
+import asyncio
+import logging
+from collections import Counter
+from typing import Optional
+
+import discord
+from discord import ButtonStyle, Interaction, app_commands
 from discord.ext import commands
+from discord.ui import Button, View
+from pymongo import UpdateOne
 
+import config
 from bot import Bot
+from cogs.utils import metrics, mongo
+from cogs.utils.cache import SingleFlight
+
+log = logging.getLogger(__name__)
+
+max_options = 10
+
+
+def poll_embed(
+    question: str, options: list[str], counts: list[int], closed: bool
+) -> discord.Embed:
+    title = question
+    color = discord.Color.dark_grey() if closed else discord.Color.blurple()
+    embed = discord.Embed(title=title, color=color)
+
+    total = sum(counts)
+    for option, count in zip(options, counts):
+        share = count / total if total else 0
+        embed.add_field(
+            name=option, value=f'{count} votes ({share:.0%})', inline=False
+        )
+    footer = 'Poll closed' if closed else 'Click a button to vote'
+    embed.set_footer(text=f'{footer} · {total} votes')
+
+    return embed
+
+
+def poll_view(poll_id: int, options: list[str]) -> View:
+    view = View(timeout=None)
+    for index, option in enumerate(options):
+        view.add_item(Button(
+            style=ButtonStyle.secondary,
+            label=option[:80],
+            custom_id=f'poll:{poll_id}:{index}'
+        ))
+    # Clicks are handled by on_interaction, a stopped view is not kept in
+    # memory for every poll ever sent
+    view.stop()
+    return view
+
+
+class Poll:
+    """Votes seen by this process that are not in MongoDB yet"""
+
+    __slots__ = (
+        'id', 'channel_id', 'message_id', 'question', 'options', 'counts',
+        'voters', 'pending', 'closed'
+    )
 
+    def __init__(self, document: dict) -> None:
+        self.id = document['_id']
+        self.channel_id = document['channel']
+        self.message_id = document['message']
+        self.question = document['question']
+        self.options = document['options']
+        self.counts = list(document['counts'])
+        self.voters: set[int] = set()
+        self.pending: dict[int, int] = {}
+        self.closed = document['closed']
 
+
+@app_commands.guild_only()
+@app_commands.default_permissions(manage_guild=True)
 class Polls(commands.GroupCog, group_name='polls'):
     def __init__(self, bot: Bot) -> None:
         self.bot = bot
+        self.polls: dict[int, Poll] = {}
+        self.loads = SingleFlight()
+        self.flush_lock = asyncio.Lock()
+        self.flush_interval = getattr(config, 'polls_flush_interval', 2.0)
+        self.edit_window = getattr(config, 'polls_edit_window', 5.0)
+        self.edit_tasks: dict[int, asyncio.Task] = {}
+        self.flush_task: Optional[asyncio.Task] = None
+        self.flushed = 0
+        self.duplicates = 0
+
+    @property
+    def documents(self):
+        return mongo.db['polls']
+
+    @property
+    def votes(self):
+        return mongo.db['poll_votes']
+
+    async def cog_load(self) -> None:
+        await self.votes.create_index('poll')
+        self.flush_task = asyncio.create_task(self.flush_loop())
+        metrics.registry.register_collector('polls', self.collect_metrics)
+
+    async def cog_unload(self) -> None:
+        metrics.registry.unregister_collector('polls')
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        for task in self.edit_tasks.values():
+            task.cancel()
+        try:
+            await self.flush()
+        except Exception:
+            log.exception('Failed to flush poll votes on unload')
+
+    def collect_metrics(self) -> list[metrics.Sample]:
+        pending = sum(len(poll.pending) for poll in self.polls.values())
+        return [
+            ('bot_polls_loaded', {}, len(self.polls)),
+            ('bot_polls_pending_votes', {}, pending),
+            ('bot_polls_flushed_votes', {}, self.flushed),
+            ('bot_polls_duplicate_votes', {}, self.duplicates)
+        ]
+
+    async def get_poll(self, poll_id: int) -> Optional[Poll]:
+        poll = self.polls.get(poll_id)
+        if poll is not None:
+            return poll
+        return await self.loads.do(poll_id, self.load_poll, poll_id)
+
+    async def load_poll(self, poll_id: int) -> Optional[Poll]:
+        document = await self.documents.find_one({'_id': poll_id})
+        if document is None:
+            return None
+        poll = Poll(document)
+        if not poll.closed:
+            self.polls[poll_id] = poll
+        return poll
+
+    @commands.Cog.listener()
+    @metrics.instrument('polls')
+    async def on_interaction(self, interaction: Interaction) -> None:
+        if interaction.type is not discord.InteractionType.component:
+            return
+        custom_id = interaction.data.get('custom_id', '')
+        if not custom_id.startswith('poll:'):
+            return
+
+        _, poll_id, option = custom_id.split(':')
+        poll = await self.get_poll(int(poll_id))
+        if poll is None or poll.closed:
+            content = 'This poll is closed'
+        elif interaction.user.id in poll.voters:
+            content = 'You have already voted'
+        else:
+            self.vote(poll, interaction.user.id, int(option))
+            content = f'You voted for **{poll.options[int(option)]}**'
+        await interaction.response.send_message(content, ephemeral=True)
+
+    def vote(self, poll: Poll, user_id: int, option: int) -> None:
+        poll.voters.add(user_id)
+        poll.pending[user_id] = option
+        # Shown straight away, corrected if the flush finds an older vote
+        poll.counts[option] += 1
+        self.schedule_edit(poll)
+
+    def schedule_edit(self, poll: Poll) -> None:
+        if poll.id not in self.edit_tasks:
+            task = asyncio.create_task(self.edit_later(poll))
+            self.edit_tasks[poll.id] = task
+
+    async def edit_later(self, poll: Poll) -> None:
+        """Edit the tally once per window however many votes arrive"""
+        try:
+            await asyncio.sleep(self.edit_window)
+        finally:
+            self.edit_tasks.pop(poll.id, None)
+        await self.edit_message(poll)
+
+    async def edit_message(self, poll: Poll) -> None:
+        channel = self.bot.get_channel(poll.channel_id)
+        if channel is None:
+            return
+
+        message = channel.get_partial_message(poll.message_id)
+        embed = poll_embed(
+            poll.question, poll.options, poll.counts, poll.closed
+        )
+        view = None if poll.closed else poll_view(poll.id, poll.options)
+        try:
+            await message.edit(embed=embed, view=view)
+        except discord.HTTPException:
+            log.exception(f'Failed to edit poll {poll.id}')
+
+    async def flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                log.exception('Failed to flush poll votes')
+
+    async def flush(self, poll_ids: Optional[set[int]] = None) -> None:
+        """Write pending votes, then count the ones that were new.
+
+        Votes are upserted with `$setOnInsert`, so a vote already stored
+        is never counted twice. The counters are only a running tally,
+        closing a poll recounts the votes themselves.
+        """
+        async with self.flush_lock:
+            batches = {}
+            for poll in list(self.polls.values()):
+                if poll.pending and (poll_ids is None or poll.id in poll_ids):
+                    batches[poll.id] = poll.pending
+                    poll.pending = {}
+            if not batches:
+                return
+
+            requests = []
+            owners = []
+            for poll_id, votes in batches.items():
+                for user_id, option in votes.items():
+                    requests.append(UpdateOne(
+                        {'_id': {'poll': poll_id, 'user': user_id}},
+                        {'$setOnInsert': {'poll': poll_id, 'option': option}},
+                        upsert=True
+                    ))
+                    owners.append((poll_id, option))
+
+            try:
+                result = await self.votes.bulk_write(requests, ordered=False)
+            except Exception:
+                for poll_id, votes in batches.items():
+                    poll = self.polls.get(poll_id)
+                    if poll is not None:
+                        poll.pending = {**votes, **poll.pending}
+                raise
+
+            increments: dict[int, Counter] = {}
+            for index in result.upserted_ids:
+                poll_id, option = owners[index]
+                increments.setdefault(poll_id, Counter())[option] += 1
+
+            for index, (poll_id, option) in enumerate(owners):
+                if index in result.upserted_ids:
+                    continue
+                # The user voted before this process saw the poll
+                self.duplicates += 1
+                poll = self.polls.get(poll_id)
+                if poll is not None:
+                    poll.counts[option] -= 1
+                    self.schedule_edit(poll)
+
+            if increments:
+                await self.documents.bulk_write([
+                    UpdateOne({'_id': poll_id}, {'$inc': {
+                        f'counts.{option}': count
+                        for option, count in counter.items()
+                    }})
+                    for poll_id, counter in increments.items()
+                ], ordered=False)
+            self.flushed += len(result.upserted_ids)
+
+    async def count_votes(self, poll_id: int, options: int) -> list[int]:
+        counts = [0] * options
+        pipeline = [
+            {'$match': {'poll': poll_id}},
+            {'$group': {'_id': '$option', 'count': {'$sum': 1}}}
+        ]
+        async for group in self.votes.aggregate(pipeline):
+            counts[group['_id']] = group['count']
+        return counts
+
+    async def interaction_response(
+        self, interaction: Interaction, content: str
+    ) -> None:
+        await interaction.response.send_message(content, ephemeral=True)
+
+    @app_commands.command()
+    @app_commands.checks.has_permissions(manage_guild=True)
+    async def create(
+        self, interaction: Interaction, question: str, options: str
+    ) -> None:
+        """Create a poll, separate the options with a semicolon"""
+        choices = [o.strip() for o in options.split(';') if o.strip()]
+        if not 2 <= len(choices) <= max_options:
+            return await self.interaction_response(
+                interaction, f'A poll needs 2 to {max_options} options'
+            )
+
+        poll_id = interaction.id
+        counts = [0] * len(choices)
+        embed = poll_embed(question, choices, counts, closed=False)
+        view = poll_view(poll_id, choices)
+        message = await interaction.channel.send(embed=embed, view=view)
+
+        document = {
+            '_id': poll_id,
+            'guild': interaction.guild_id,
+            'channel': interaction.channel_id,
+            'message': message.id,
+            'question': question,
+            'options': choices,
+            'counts': counts,
+            'closed': False
+        }
+        await self.documents.insert_one(document)
+        self.polls[poll_id] = Poll(document)
+        await self.interaction_response(
+            interaction, f'Poll created, its ID is `{poll_id}`'
+        )
+
+    @app_commands.command()
+    @app_commands.checks.has_permissions(manage_guild=True)
+    async def close(self, interaction: Interaction, poll_id: str) -> None:
+        """Close a poll and publish the final results"""
+        if not poll_id.isdigit():
+            return await self.interaction_response(
+                interaction, 'The poll ID must be a number'
+            )
+
+        query = {'_id': int(poll_id), 'guild': interaction.guild_id}
+        document = await self.documents.find_one(query)
+        if document is None:
+            return await self.interaction_response(
+                interaction, 'There is no poll with that ID'
+            )
+
+        await interaction.response.defer(ephemeral=True)
+        poll = self.polls.get(document['_id'])
+        if poll is not None:
+            poll.closed = True
+            await self.flush({poll.id})
+            self.polls.pop(poll.id, None)
+            task = self.edit_tasks.pop(poll.id, None)
+            if task is not None:
+                task.cancel()
+
+        # Recounted from the votes, so a crash between writing votes and
+        # their counters never shows in the results. Closing twice gives
+        # the same totals
+        counts = await self.count_votes(
+            document['_id'], len(document['options'])
+        )
+        update = {'$set': {'counts': counts, 'closed': True}}
+        await self.documents.update_one({'_id': document['_id']}, update)
+
+        document.update(counts=counts, closed=True)
+        await self.edit_message(Poll(document))
+        await interaction.followup.send('Poll closed', ephemeral=True)
 
 
 async def setup(bot: Bot) -> None:
@@ -1,11 +1,178 @@
+import asyncio
+import logging
+import os
+from typing import Optional
+
+import discord
+from discord import Interaction, app_commands
 from discord.ext import commands
 
+import config
 from bot import Bot
+from cogs.utils import metrics
+from cogs.utils.transcripts import Exporter, TranscriptWriter
+
+log = logging.getLogger(__name__)
+
+requirements = {
+    'intents': ['guild_messages', 'message_content']
+}
+
+# Discord takes up to 10 attachments per message
+max_attachments = 10
+
 
+def can_read(member: discord.Member, channel: discord.TextChannel) -> bool:
+    permissions = channel.permissions_for(member)
+    return permissions.read_messages and permissions.read_message_history
 
+
+@app_commands.guild_only()
+@app_commands.default_permissions(manage_channels=True)
 class Tickets(commands.GroupCog, group_name='tickets'):
     def __init__(self, bot: Bot) -> None:
         self.bot = bot
+        self.exporter = Exporter(
+            directory=getattr(config, 'transcripts_directory', 'transcripts'),
+            concurrency=getattr(config, 'transcripts_concurrency', 2)
+        )
+
+    async def cog_load(self) -> None:
+        metrics.registry.register_collector('tickets', self.collect_metrics)
+
+    async def cog_unload(self) -> None:
+        metrics.registry.unregister_collector('tickets')
+        self.exporter.close()
+
+    def collect_metrics(self) -> list[metrics.Sample]:
+        return [
+            ('bot_transcripts_running', {}, self.exporter.running),
+            ('bot_transcripts_exported', {}, self.exporter.exported)
+        ]
+
+    def upload_batches(
+        self, guild: discord.Guild, writers: list[TranscriptWriter]
+    ) -> tuple[list[list[str]], list[TranscriptWriter]]:
+        """Transcript paths grouped into messages, and those too large"""
+        batches: list[list[str]] = []
+        too_large = []
+        size = 0
+        for writer in writers:
+            paths = [writer.html_path, writer.jsonl_path]
+            total = sum(os.path.getsize(path) for path in paths)
+            if total > guild.filesize_limit:
+                too_large.append(writer)
+                continue
+            if (
+                not batches
+                or len(batches[-1]) + len(paths) > max_attachments
+                or size + total > guild.filesize_limit
+            ):
+                batches.append([])
+                size = 0
+            batches[-1].extend(paths)
+            size += total
+        return batches, too_large
+
+    @app_commands.command()
+    @app_commands.checks.has_permissions(manage_channels=True)
+    async def transcript(
+        self,
+        interaction: Interaction,
+        channel: Optional[discord.TextChannel] = None
+    ) -> None:
+        """Export the messages of a ticket channel"""
+        channel = channel or interaction.channel
+        if not can_read(interaction.user, channel):
+            content = f'You cannot read the messages in {channel.mention}'
+            return await interaction.response.send_message(
+                content, ephemeral=True
+            )
+
+        await interaction.response.defer(ephemeral=True)
+        try:
+            writer = await self.exporter.export(channel)
+        except Exception:
+            log.exception(f'Failed to export channel {channel.id}')
+            return await interaction.followup.send(
+                f'Failed to export {channel.mention}', ephemeral=True
+            )
+        log.info(f'Exported {writer.count} messages from channel {channel.id}')
+
+        content = f'Exported {writer.count} messages from {channel.mention}'
+        batches, too_large = self.upload_batches(interaction.guild, [writer])
+        if too_large:
+            content += ', the transcript is too large to upload'
+        # Files are streamed from disk when uploaded, never read whole
+        files = [discord.File(path) for batch in batches for path in batch]
+        try:
+            await interaction.followup.send(
+                content, files=files, ephemeral=True
+            )
+        finally:
+            for file in files:
+                file.close()
+            writer.remove()
+
+    @app_commands.command()
+    @app_commands.checks.has_permissions(manage_channels=True)
+    async def export(
+        self, interaction: Interaction, category: discord.CategoryChannel
+    ) -> None:
+        """Export every ticket channel in a category"""
+        await interaction.response.defer(ephemeral=True)
+        channels = [
+            channel for channel in category.text_channels
+            if can_read(interaction.user, channel)
+        ]
+        hidden = len(category.text_channels) - len(channels)
+        results = await asyncio.gather(
+            *(self.exporter.export(channel) for channel in channels),
+            return_exceptions=True
+        )
+
+        exported = 0
+        failed = []
+        writers = []
+        for channel, result in zip(channels, results):
+            if isinstance(result, Exception):
+                log.error(
+                    f'Failed to export channel {channel.id}',
+                    exc_info=result
+                )
+                failed.append(channel.mention)
+            else:
+                exported += result.count
+                writers.append(result)
+
+        try:
+            batches, too_large = self.upload_batches(
+                interaction.guild, writers
+            )
+            content = (
+                f'Exported {exported} messages from '
+                f'{len(channels) - len(failed)} channels'
+            )
+            if failed:
+                content += f', failed: {", ".join(failed)}'
+            if hidden:
+                content += f', skipped {hidden} channels you cannot read'
+            if too_large:
+                content += f', {len(too_large)} too large to upload'
+            await interaction.followup.send(content[:2000], ephemeral=True)
+
+            for batch in batches:
+                files = [discord.File(path) for path in batch]
+                try:
+                    await interaction.followup.send(
+                        files=files, ephemeral=True
+                    )
+                finally:
+                    for file in files:
+                        file.close()
+        finally:
+            for writer in writers:
+                writer.remove()
 
 
 async def setup(bot: Bot) -> None:
@@ -1,11 +1,109 @@
+from typing import Optional
+
+import discord
+from discord import Interaction, app_commands
 from discord.ext import commands
 
+import config
 from bot import Bot
+from cogs.utils import metrics
+from cogs.utils.activity import ActivityEngine
+
+requirements = {
+    'intents': ['guild_messages']
+}
+
+
+def leaderboard_embed(
+    guild: discord.Guild, ranking: list[tuple[int, int]]
+) -> discord.Embed:
+    title = f'{guild.name} Leaderboard'
+    color = discord.Color.gold()
+    embed = discord.Embed(title=title, color=color)
+
+    lines = [
+        f'**{position}.** <@{user}> · {xp} XP'
+        for position, (user, xp) in enumerate(ranking, start=1)
+    ]
+    embed.description = '\n'.join(lines) or 'Nobody has earned XP yet'
+
+    return embed
+
+
+def rank_embed(
+    member: discord.Member, messages: int, xp: int
+) -> discord.Embed:
+    title = member.display_name
+    color = discord.Color.gold()
+    embed = discord.Embed(title=title, color=color)
 
+    embed.add_field(name='XP', value=str(xp))
+    embed.add_field(name='Messages', value=str(messages))
+    embed.set_thumbnail(url=member.display_avatar.url)
 
+    return embed
+
+
+@app_commands.guild_only()
 class Users(commands.GroupCog, group_name='users'):
     def __init__(self, bot: Bot) -> None:
         self.bot = bot
+        self.activity = ActivityEngine(
+            xp_per_message=getattr(config, 'users_xp_per_message', 10),
+            cooldown=getattr(config, 'users_xp_cooldown', 60.0),
+            interval=getattr(config, 'users_flush_interval', 10.0),
+            k=getattr(config, 'users_leaderboard_size', 100)
+        )
+
+    async def cog_load(self) -> None:
+        await self.activity.collection.create_index([('guild', 1), ('xp', -1)])
+        self.activity.start()
+        metrics.registry.register_collector('users', self.collect_metrics)
+
+    async def cog_unload(self) -> None:
+        metrics.registry.unregister_collector('users')
+        # Runs on shutdown too, before the database client is closed
+        await self.activity.stop()
+
+    def collect_metrics(self) -> list[metrics.Sample]:
+        return [
+            (f'bot_users_activity_{key}', {}, value)
+            for key, value in self.activity.stats().items()
+        ]
+
+    @commands.Cog.listener()
+    @metrics.instrument('users')
+    async def on_message(self, message: discord.Message) -> None:
+        if message.guild is None or message.author.bot:
+            return
+        self.activity.record(message.guild.id, message.author.id)
+
+    @app_commands.command()
+    async def rank(
+        self,
+        interaction: Interaction,
+        member: Optional[discord.Member] = None
+    ) -> None:
+        """Get the XP and message count of a member"""
+        member = member or interaction.user
+        query = {'_id': {'guild': interaction.guild_id, 'user': member.id}}
+        document = await self.activity.collection.find_one(query) or {}
+        messages, xp = self.activity.pending_for(
+            interaction.guild_id, member.id
+        )
+        embed = rank_embed(
+            member,
+            document.get('messages', 0) + messages,
+            document.get('xp', 0) + xp
+        )
+        await interaction.response.send_message(embed=embed)
+
+    @app_commands.command()
+    async def leaderboard(self, interaction: Interaction) -> None:
+        """Get the members with the most XP"""
+        leaderboard = await self.activity.leaderboard(interaction.guild_id)
+        embed = leaderboard_embed(interaction.guild, leaderboard.top(10))
+        await interaction.response.send_message(embed=embed)
 
 
 async def setup(bot: Bot) -> None:
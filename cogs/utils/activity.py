@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import time
+from typing import Iterable, Optional
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from cogs.utils import mongo
+
+log = logging.getLogger(__name__)
+
+
+class TopK:
+    """The `k` members with the most XP in a guild.
+
+    XP only ever grows, so a member outside the top can only get in by
+    earning XP, and every member who earned XP is passed to `update`
+    after a flush. Nothing outside the top has to be remembered.
+    """
+
+    def __init__(self, k: int) -> None:
+        self.k = k
+        self.members: dict[int, int] = {}
+        self.floor: Optional[tuple[int, int]] = None
+
+    def update(self, user: int, xp: int) -> None:
+        if user in self.members:
+            self.members[user] = xp
+            if self.floor is not None and self.floor[1] == user:
+                self.floor = None
+            return
+
+        if len(self.members) < self.k:
+            self.members[user] = xp
+            self.floor = None
+            return
+
+        if self.floor is None:
+            self.floor = min((x, u) for u, x in self.members.items())
+        if xp > self.floor[0]:
+            del self.members[self.floor[1]]
+            self.members[user] = xp
+            self.floor = None
+
+    def top(self, count: int) -> list[tuple[int, int]]:
+        ranked = sorted(
+            self.members.items(), key=lambda item: item[1], reverse=True
+        )
+        return ranked[:count]
+
+
+class ActivityEngine:
+    """Count messages and XP in memory and write them back in batches.
+
+    Counters are kept per guild and flushed every `interval` seconds as
+    a single unordered bulk write of `$inc` upserts. The totals of the
+    members touched by a flush are then read back with one `$in` query
+    to keep each guild's top-K current.
+    """
+
+    def __init__(
+        self,
+        collection_name: str = 'members',
+        xp_per_message: int = 10,
+        cooldown: float = 60.0,
+        interval: float = 10.0,
+        k: int = 100
+    ) -> None:
+        self.collection_name = collection_name
+        self.xp_per_message = xp_per_message
+        self.cooldown = cooldown
+        self.interval = interval
+        self.k = k
+        # guild -> user -> [messages, xp]
+        self.pending: dict[int, dict[int, list[int]]] = {}
+        self.last_xp: dict[tuple[int, int], float] = {}
+        self.leaderboards: dict[int, TopK] = {}
+        self.lock = asyncio.Lock()
+        self.task: Optional[asyncio.Task] = None
+        self.flushed = 0
+
+    @property
+    def collection(self):
+        return mongo.db[self.collection_name]
+
+    def start(self) -> None:
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                log.exception('Failed to flush member activity')
+
+    def record(self, guild: int, user: int) -> None:
+        counters = self.pending.setdefault(guild, {}).get(user)
+        if counters is None:
+            counters = self.pending[guild][user] = [0, 0]
+        counters[0] += 1
+
+        now = time.monotonic()
+        key = (guild, user)
+        if now - self.last_xp.get(key, -self.cooldown) >= self.cooldown:
+            self.last_xp[key] = now
+            counters[1] += self.xp_per_message
+
+    def pending_for(self, guild: int, user: int) -> tuple[int, int]:
+        messages, xp = self.pending.get(guild, {}).get(user, (0, 0))
+        return messages, xp
+
+    async def flush(self) -> None:
+        async with self.lock:
+            pending, self.pending = self.pending, {}
+            self.prune_cooldowns()
+            if not pending:
+                return
+
+            entries = [
+                (guild, user, messages, xp)
+                for guild, users in pending.items()
+                for user, (messages, xp) in users.items()
+            ]
+            requests = [
+                UpdateOne(
+                    {'_id': {'guild': guild, 'user': user}},
+                    {
+                        '$inc': {'messages': messages, 'xp': xp},
+                        '$setOnInsert': {'guild': guild, 'user': user}
+                    },
+                    upsert=True
+                )
+                for guild, user, messages, xp in entries
+            ]
+            try:
+                await self.collection.bulk_write(requests, ordered=False)
+            except BulkWriteError as e:
+                # Unordered writes apply everything else, so only the
+                # failed increments go back or the rest would count twice
+                failed = {error['index'] for error in e.details['writeErrors']}
+                self.restore_entries(entries[index] for index in failed)
+                raise
+            except Exception:
+                self.restore(pending)
+                raise
+            self.flushed += len(requests)
+
+            # Unseeded guilds read their totals when they are first shown
+            ids = [
+                {'guild': guild, 'user': user}
+                for guild, users in pending.items()
+                if guild in self.leaderboards
+                for user, (_, xp) in users.items() if xp
+            ]
+            if not ids:
+                return
+            query = {'_id': {'$in': ids}}
+            projection = {'guild': True, 'user': True, 'xp': True}
+            async for document in self.collection.find(query, projection):
+                leaderboard = self.leaderboards[document['guild']]
+                leaderboard.update(document['user'], document['xp'])
+
+    def restore(self, pending: dict[int, dict[int, list[int]]]) -> None:
+        self.restore_entries(
+            (guild, user, messages, xp)
+            for guild, users in pending.items()
+            for user, (messages, xp) in users.items()
+        )
+
+    def restore_entries(
+        self, entries: Iterable[tuple[int, int, int, int]]
+    ) -> None:
+        for guild, user, messages, xp in entries:
+            counters = self.pending.setdefault(guild, {}).setdefault(
+                user, [0, 0]
+            )
+            counters[0] += messages
+            counters[1] += xp
+
+    def prune_cooldowns(self) -> None:
+        cutoff = time.monotonic() - self.cooldown
+        expired = [k for k, last in self.last_xp.items() if last < cutoff]
+        for key in expired:
+            del self.last_xp[key]
+
+    async def leaderboard(self, guild: int) -> TopK:
+        leaderboard = self.leaderboards.get(guild)
+        if leaderboard is not None:
+            return leaderboard
+
+        # Seeding under the flush lock so no flush can slip in between
+        async with self.lock:
+            if guild not in self.leaderboards:
+                leaderboard = TopK(self.k)
+                cursor = self.collection.find(
+                    {'guild': guild}, {'user': True, 'xp': True}
+                ).sort('xp', -1).limit(self.k)
+                async for document in cursor:
+                    leaderboard.update(document['user'], document['xp'])
+                self.leaderboards[guild] = leaderboard
+            return self.leaderboards[guild]
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'pending_members': sum(len(u) for u in self.pending.values()),
+            'leaderboards': len(self.leaderboards),
+            'flushed': self.flushed
+        }
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import uuid
+from multiprocessing.connection import Connection
+from typing import (
+    Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Optional
+)
+
+import discord
+
+log = logging.getLogger(__name__)
+
+Handler = Callable[..., Awaitable[Any]]
+
+
+def split_shards(
+    shard_count: int, clusters: int
+) -> list[list[int]]:
+    """Spread shard ids over clusters as evenly as possible"""
+    size, extra = divmod(shard_count, clusters)
+    ranges = []
+    start = 0
+    for index in range(clusters):
+        end = start + size + (1 if index < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+async def owned(
+    client: discord.Client, documents: AsyncIterable[dict]
+) -> AsyncIterator[dict]:
+    """Documents of the guilds this cluster runs, by their `guild` field"""
+    async for document in documents:
+        if client.get_guild(document['guild']) is not None:
+            yield document
+
+
+class ClusterClient:
+    """Worker side of the launcher IPC channel.
+
+    Commands broadcast by one cluster are sent to the supervisor, which
+    runs them on every cluster and returns all the results. Without a
+    supervisor connection commands only run in this process.
+    """
+
+    def __init__(
+        self,
+        cluster_id: Optional[int] = None,
+        connection: Optional[Connection] = None,
+        timeout: float = 60.0
+    ) -> None:
+        self.cluster_id = cluster_id or 0
+        self.connection = connection
+        self.timeout = timeout
+        self.handlers: dict[str, Handler] = {}
+        self.waiters: dict[str, asyncio.Future] = {}
+
+    def register(self, command: str, handler: Handler) -> None:
+        self.handlers[command] = handler
+
+    def unregister(self, command: str) -> None:
+        self.handlers.pop(command, None)
+
+    def start(self) -> None:
+        if self.connection is None:
+            return
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self.connection.fileno(), self.on_readable)
+
+    def close(self) -> None:
+        if self.connection is None:
+            return
+        loop = asyncio.get_running_loop()
+        loop.remove_reader(self.connection.fileno())
+        for waiter in self.waiters.values():
+            waiter.cancel()
+
+    def on_readable(self) -> None:
+        try:
+            while self.connection.poll():
+                self.on_message(self.connection.recv())
+        except (EOFError, OSError):
+            log.warning('Lost the connection to the cluster supervisor')
+            asyncio.get_running_loop().remove_reader(
+                self.connection.fileno()
+            )
+
+    def on_message(self, message: dict) -> None:
+        if message['op'] == 'request':
+            asyncio.create_task(self.respond(message))
+        elif message['op'] == 'results':
+            waiter = self.waiters.pop(message['nonce'], None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(message['results'])
+
+    async def respond(self, message: dict) -> None:
+        result = await self.run(message['command'], message['args'])
+        self.connection.send({
+            'op': 'response', 'nonce': message['nonce'], 'result': result
+        })
+
+    async def run(self, command: str, args: dict) -> dict:
+        handler = self.handlers.get(command)
+        result = {'cluster': self.cluster_id, 'ok': True, 'result': None}
+        if handler is None:
+            result['ok'] = False
+            result['result'] = f'Unknown command {command}'
+            return result
+
+        try:
+            result['result'] = await handler(**args)
+        except Exception as e:
+            log.exception(f'Cluster command {command} failed')
+            result['ok'] = False
+            result['result'] = f'{e.__class__.__name__}: {e}'
+        return result
+
+    async def broadcast(self, command: str, **args) -> list[dict]:
+        if self.connection is None:
+            return [await self.run(command, args)]
+
+        nonce = uuid.uuid4().hex
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters[nonce] = waiter
+        self.connection.send({
+            'op': 'broadcast', 'nonce': nonce,
+            'command': command, 'args': args
+        })
+        try:
+            results = await asyncio.wait_for(waiter, self.timeout)
+        finally:
+            self.waiters.pop(nonce, None)
+        return sorted(results, key=lambda r: r['cluster'])
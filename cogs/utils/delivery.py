@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable
+
+import discord
+
+log = logging.getLogger(__name__)
+
+Sender = Callable[[discord.abc.Messageable, list[discord.Embed]], Awaitable]
+
+max_embeds = 10  # Embeds Discord accepts in a single message
+max_characters = 6000  # Combined length of those embeds
+
+
+async def channel_send(
+    channel: discord.abc.Messageable, embeds: list[discord.Embed]
+) -> None:
+    await channel.send(embeds=embeds)
+
+
+def dropped_embed(dropped: int) -> discord.Embed:
+    title = 'Some log entries were skipped'
+    description =\
+        f'{dropped} entries were dropped because this channel fell behind'
+    color = discord.Color.dark_grey()
+    return discord.Embed(title=title, description=description, color=color)
+
+
+class DeliveryQueue:
+    """Embeds waiting to be sent to one channel.
+
+    Entries are packed into messages of up to ten embeds after a short
+    flush window. When the queue is full the oldest entry is dropped and a
+    summary of how many were lost is sent with the next message.
+    """
+
+    def __init__(
+        self,
+        channel: discord.abc.Messageable,
+        sender: Sender,
+        max_size: int,
+        flush_window: float
+    ) -> None:
+        self.channel = channel
+        self.sender = sender
+        self.max_size = max_size
+        self.flush_window = flush_window
+        self.entries: deque[tuple[float, discord.Embed]] = deque()
+        self.task = None
+        self.wake = asyncio.Event()
+        self.pending_dropped = 0
+        self.dropped = 0
+        self.messages = 0
+        self.delivered = 0
+        self.failed = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+    def push(self, embed: discord.Embed) -> None:
+        if len(self.entries) >= self.max_size:
+            self.entries.popleft()
+            self.pending_dropped += 1
+            self.dropped += 1
+        self.entries.append((time.monotonic(), embed))
+
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def next_batch(self) -> tuple[float, list[discord.Embed]]:
+        embeds = []
+        size = 0
+        if self.pending_dropped:
+            embed = dropped_embed(self.pending_dropped)
+            self.pending_dropped = 0
+            embeds.append(embed)
+            size += len(embed)
+
+        oldest = self.entries[0][0] if self.entries else time.monotonic()
+        while self.entries and len(embeds) < max_embeds:
+            embed = self.entries[0][1]
+            if embeds and size + len(embed) > max_characters:
+                break
+            self.entries.popleft()
+            embeds.append(embed)
+            size += len(embed)
+        return oldest, embeds
+
+    async def run(self) -> None:
+        try:
+            try:
+                await asyncio.wait_for(self.wake.wait(), self.flush_window)
+            except asyncio.TimeoutError:
+                pass
+            while self.entries or self.pending_dropped:
+                await self.flush_once()
+        finally:
+            self.task = None
+            self.wake.clear()
+
+    async def flush_once(self) -> None:
+        oldest, embeds = self.next_batch()
+        try:
+            await self.sender(self.channel, embeds)
+        except Exception:
+            self.failed += len(embeds)
+            log.exception(f'Failed to deliver logs to {self.channel.id}')
+            return
+
+        latency = time.monotonic() - oldest
+        self.messages += 1
+        self.delivered += len(embeds)
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self.total_latency += latency
+
+    async def drain(self) -> None:
+        if self.task is not None:
+            self.wake.set()
+            await self.task
+        while self.entries or self.pending_dropped:
+            await self.flush_once()
+
+    def stats(self) -> dict:
+        average = self.total_latency / self.messages if self.messages else 0
+        return {
+            'depth': len(self.entries),
+            'messages': self.messages,
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'last_latency': self.last_latency,
+            'average_latency': average,
+            'max_latency': self.max_latency
+        }
+
+
+class Dispatcher:
+    """Per destination delivery queues sharing one sender"""
+
+    def __init__(
+        self,
+        sender: Sender = channel_send,
+        max_size: int = 250,
+        flush_window: float = 1.0
+    ) -> None:
+        self.sender = sender
+        self.max_size = max_size
+        self.flush_window = flush_window
+        self.queues: dict[int, DeliveryQueue] = {}
+
+    def push(
+        self, channel: discord.abc.Messageable, embed: discord.Embed
+    ) -> None:
+        queue = self.queues.get(channel.id)
+        if queue is None:
+            queue = DeliveryQueue(
+                channel, self.sender, self.max_size, self.flush_window
+            )
+            self.queues[channel.id] = queue
+        else:
+            queue.channel = channel
+        queue.push(embed)
+
+    async def close(self) -> None:
+        for queue in self.queues.values():
+            try:
+                await queue.drain()
+            except Exception:
+                log.exception(f'Failed to drain logs for {queue.channel.id}')
+
+    def stats(self) -> dict:
+        queues = {
+            channel_id: queue.stats()
+            for channel_id, queue in self.queues.items()
+        }
+        messages = sum(q['messages'] for q in queues.values())
+        latency = sum(q.total_latency for q in self.queues.values())
+        return {
+            'channels': len(queues),
+            'depth': sum(q['depth'] for q in queues.values()),
+            'max_depth': max((q['depth'] for q in queues.values()), default=0),
+            'messages': messages,
+            'delivered': sum(q['delivered'] for q in queues.values()),
+            'dropped': sum(q['dropped'] for q in queues.values()),
+            'failed': sum(q['failed'] for q in queues.values()),
+            'average_latency': latency / messages if messages else 0,
+            'max_latency': max(
+                (q['max_latency'] for q in queues.values()), default=0
+            ),
+            'queues': queues
+        }
@@ -0,0 +1,205 @@
+import asyncio
+import csv
+import datetime
+import io
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+
+log = logging.getLogger(__name__)
+
+# user id, name, account creation, event time
+Row = tuple[int, str, datetime.datetime, datetime.datetime]
+Sender = Callable[['Digest', list[Row], int, bool], Awaitable]
+
+
+def utcnow() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class RateCounter:
+    """Events in the last `window` seconds, estimated from two buckets.
+
+    The previous bucket is weighted by how much of it still overlaps the
+    window, which is close enough to a sliding window while taking
+    constant time and memory however many events arrive.
+    """
+
+    __slots__ = ('window', 'started', 'current', 'previous')
+
+    def __init__(self, window: float) -> None:
+        self.window = window
+        self.started = time.monotonic()
+        self.current = 0
+        self.previous = 0
+
+    def roll(self, now: float) -> None:
+        elapsed = now - self.started
+        if elapsed < self.window:
+            return
+        if elapsed < 2 * self.window:
+            self.previous = self.current
+            self.started += self.window
+        else:
+            self.previous = 0
+            self.started = now
+        self.current = 0
+
+    def add(self, now: float) -> None:
+        self.roll(now)
+        self.current += 1
+
+    def rate(self, now: float) -> float:
+        self.roll(now)
+        overlap = 1 - (now - self.started) / self.window
+        return self.previous * overlap + self.current
+
+
+class Digest:
+    """Events of one kind in one guild summarised while a flood lasts"""
+
+    __slots__ = (
+        'guild_id', 'kind', 'rate', 'active', 'rows', 'total', 'started',
+        'task'
+    )
+
+    def __init__(self, guild_id: int, kind: str, window: float) -> None:
+        self.guild_id = guild_id
+        self.kind = kind
+        self.rate = RateCounter(window)
+        self.active = False
+        self.rows: list[Row] = []
+        self.total = 0
+        self.started = utcnow()
+        self.task: Optional[asyncio.Task] = None
+
+    def take(self) -> tuple[list[Row], int]:
+        rows, total = self.rows, self.total
+        self.rows = []
+        self.total = 0
+        return rows, total
+
+
+def rows_csv(rows: list[Row]) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['user_id', 'name', 'account_created', 'time'])
+    for user_id, name, created_at, at in rows:
+        writer.writerow(
+            [user_id, name, created_at.isoformat(), at.isoformat()]
+        )
+    return buffer.getvalue().encode()
+
+
+class DigestManager:
+    """Switch noisy guilds from one log entry per event to digests.
+
+    A guild enters digest mode once more than `enter` events of a kind
+    arrive within `window` seconds, and leaves it when the rate drops
+    under `leave`. The gap between both thresholds keeps a guild near
+    the limit from flapping between modes. While in digest mode events
+    are only appended to a list, which `send` receives every `interval`
+    seconds; the last batch is flagged so the sender can say normal
+    logging is back.
+    """
+
+    def __init__(
+        self,
+        send: Sender,
+        window: float = 10.0,
+        enter: int = 10,
+        leave: int = 3,
+        interval: float = 30.0,
+        max_rows: int = 10_000
+    ) -> None:
+        self.send = send
+        self.window = window
+        self.enter = enter
+        self.leave = leave
+        self.interval = interval
+        self.max_rows = max_rows
+        self.digests: dict[tuple[int, str], Digest] = {}
+        self.prune_at = 1024
+        self.summarised = 0
+
+    def record(self, guild_id: int, kind: str, row: Row) -> bool:
+        """Count an event, True when it belongs to a digest"""
+        key = (guild_id, kind)
+        digest = self.digests.get(key)
+        if digest is None:
+            if len(self.digests) >= self.prune_at:
+                self.prune()
+                self.prune_at = max(1024, 2 * len(self.digests))
+            digest = self.digests[key] = Digest(guild_id, kind, self.window)
+
+        now = time.monotonic()
+        digest.rate.add(now)
+        if not digest.active:
+            if digest.rate.rate(now) <= self.enter:
+                return False
+            digest.active = True
+            digest.started = utcnow()
+            digest.task = asyncio.create_task(self.run(digest))
+            log.info(f'Guild {guild_id} switched {kind} logs to digests')
+
+        digest.total += 1
+        self.summarised += 1
+        # Past the limit members are only counted
+        if len(digest.rows) < self.max_rows:
+            digest.rows.append(row)
+        return True
+
+    async def run(self, digest: Digest) -> None:
+        try:
+            while digest.active:
+                await asyncio.sleep(self.interval)
+                if digest.rate.rate(time.monotonic()) < self.leave:
+                    digest.active = False
+                    log.info(
+                        f'Guild {digest.guild_id} switched {digest.kind} '
+                        'logs back to normal'
+                    )
+                await self.flush(digest)
+        finally:
+            digest.task = None
+
+    async def flush(self, digest: Digest) -> None:
+        rows, total = digest.take()
+        # The last digest is sent even if empty, to say logging is back
+        if not total and digest.active:
+            return
+        try:
+            await self.send(digest, rows, total, not digest.active)
+        except Exception:
+            log.exception(
+                f'Failed to send {digest.kind} digest to {digest.guild_id}'
+            )
+
+    def prune(self) -> None:
+        """Forget quiet guilds, their counters have nothing left to say"""
+        now = time.monotonic()
+        quiet = [
+            key for key, digest in self.digests.items()
+            if not digest.active and not digest.rate.rate(now)
+        ]
+        for key in quiet:
+            del self.digests[key]
+
+    async def close(self) -> None:
+        digests = list(self.digests.values())
+        self.digests.clear()
+        for digest in digests:
+            if digest.task is not None:
+                digest.task.cancel()
+            # Guilds that never switched to digests have nothing to say
+            if not digest.active and not digest.total:
+                continue
+            digest.active = False
+            await self.flush(digest)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'active': sum(d.active for d in self.digests.values()),
+            'tracked': len(self.digests),
+            'summarised': self.summarised
+        }
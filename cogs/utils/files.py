@@ -1,3 +1,4 @@
+import ast
 import os
 
 folder_path = os.getcwd()
@@ -10,3 +11,29 @@ def get_initial_extensions():
             name = extension[:-3]
             extensions_list.append(f'cogs.{name}')
     return extensions_list
+
+
+def get_extension_requirements(extensions: list[str]) -> dict[str, dict]:
+    """Read the module level `requirements` dict of every extension.
+
+    The source is parsed instead of imported so extensions are not executed
+    before the bot exists.
+    """
+    requirements = {}
+    for extension in extensions:
+        path = f'{folder_path}/{extension.replace(".", "/")}.py'
+        with open(path, encoding='utf-8') as f:
+            tree = ast.parse(f.read(), filename=path)
+
+        requirements[extension] = {}
+        for node in tree.body:
+            if (
+                isinstance(node, ast.Assign) and
+                any(
+                    isinstance(target, ast.Name) and
+                    target.id == 'requirements'
+                    for target in node.targets
+                )
+            ):
+                requirements[extension] = ast.literal_eval(node.value)
+    return requirements
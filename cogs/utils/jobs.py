@@ -0,0 +1,353 @@
+import asyncio
+import datetime
+import logging
+import time
+from typing import Optional
+
+import discord
+
+from cogs.utils import metrics, mongo
+
+log = logging.getLogger(__name__)
+
+routes = {
+    'ban': 'PUT /guilds/{id}/bans/{id}',
+    'kick': 'DELETE /guilds/{id}/members/{id}',
+    'member': 'GET /guilds/{id}/members/{id}',
+    'purge': 'POST /channels/{id}/messages/bulk-delete'
+}
+
+# Discord refuses to bulk delete anything older than this
+bulk_delete_age = datetime.timedelta(days=14, minutes=-5)
+
+
+class Job:
+    """A bulk moderation action and how far it has got"""
+
+    __slots__ = (
+        'id', 'guild_id', 'channel_id', 'message_id', 'action', 'targets',
+        'target_channel', 'user_id', 'limit', 'reason', 'started_by',
+        'checkpoint', 'cursor', 'done', 'failed', 'skipped', 'status',
+        'note', 'completed', 'task', 'progress_task'
+    )
+
+    def __init__(self, document: dict) -> None:
+        self.id = document['_id']
+        self.guild_id = document['guild']
+        self.channel_id = document['channel']
+        self.message_id = document.get('message')
+        self.action = document['action']
+        self.targets = document.get('targets', [])
+        self.target_channel = document.get('target_channel')
+        self.user_id = document.get('user')
+        self.limit = document.get('limit', len(self.targets))
+        self.reason = document.get('reason')
+        self.started_by = document.get('started_by')
+        # Targets before the checkpoint are all done, the rest are redone
+        # on resume, which bans and kicks tolerate
+        self.checkpoint = document.get('checkpoint', 0)
+        self.cursor = document.get('cursor')
+        self.done = document.get('done', 0)
+        self.failed = document.get('failed', 0)
+        self.skipped = document.get('skipped', 0)
+        self.status = document.get('status', 'running')
+        self.note = document.get('note')
+        self.completed: set[int] = set()
+        self.task: Optional[asyncio.Task] = None
+        self.progress_task: Optional[asyncio.Task] = None
+
+    @property
+    def total(self) -> int:
+        return self.limit
+
+    def state(self) -> dict:
+        return {
+            'message': self.message_id,
+            'checkpoint': self.checkpoint,
+            'cursor': self.cursor,
+            'done': self.done,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'status': self.status,
+            'note': self.note
+        }
+
+    def describe(self) -> str:
+        text = (
+            f'**{self.action.title()}** job `{self.id}`: '
+            f'{self.done}/{self.total} done'
+        )
+        if self.failed:
+            text += f', {self.failed} failed'
+        if self.skipped:
+            text += f', {self.skipped} skipped for their roles'
+        text += f' · {self.status}'
+        if self.note:
+            text += f'\n{self.note}'
+        return text
+
+
+class Executor:
+    """Run bulk moderation jobs without tripping Discord's rate limits.
+
+    Bans and kicks go through `workers` concurrent workers per job, each
+    one waiting whenever the bucket it is about to use has no requests
+    left. Purges delete up to 100 messages per request. Progress is
+    saved and shown in one message at most every `progress_interval`
+    seconds, so a cancelled or interrupted job resumes where it stopped.
+    """
+
+    def __init__(
+        self,
+        bot: discord.Client,
+        workers: int = 4,
+        progress_interval: float = 3.0
+    ) -> None:
+        self.bot = bot
+        self.workers = workers
+        self.progress_interval = progress_interval
+        self.jobs: dict[int, Job] = {}
+
+    @property
+    def collection(self):
+        return mongo.db['admin_jobs']
+
+    async def submit(self, document: dict) -> Job:
+        document.setdefault('status', 'running')
+        await self.collection.insert_one(document)
+        job = Job(document)
+        self.start(job)
+        return job
+
+    def start(self, job: Job) -> None:
+        job.status = 'running'
+        self.jobs[job.id] = job
+        job.task = asyncio.create_task(self.run(job))
+
+    async def resume(self, job_id: int, guild_id: int) -> Optional[Job]:
+        if job_id in self.jobs:
+            return self.jobs[job_id]
+        query = {
+            '_id': job_id,
+            'guild': guild_id,
+            'status': {'$in': ['running', 'cancelled']}
+        }
+        document = await self.collection.find_one(query)
+        if document is None:
+            return None
+        job = Job(document)
+        self.start(job)
+        return job
+
+    async def cancel(self, job_id: int) -> Optional[Job]:
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        job.status = 'cancelled'
+        job.task.cancel()
+        return job
+
+    async def close(self) -> None:
+        # Jobs stay marked as running and are resumed on the next start
+        tasks = [job.task for job in self.jobs.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def run(self, job: Job) -> None:
+        try:
+            if job.action == 'purge':
+                await self.purge(job)
+            else:
+                await self.moderate(job)
+            job.status = 'finished'
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            job.status = 'failed'
+            log.exception(f'Admin job {job.id} failed')
+        finally:
+            self.jobs.pop(job.id, None)
+            if job.progress_task is not None:
+                job.progress_task.cancel()
+            await asyncio.shield(self.report(job))
+
+    async def wait_for_bucket(self, action: str, major_id: int) -> None:
+        bucket = metrics.find_bucket(routes[action], major_id)
+        if bucket is None:
+            return
+        delay = bucket.reset_at - time.monotonic()
+        if delay <= 0:
+            return
+        if bucket.remaining <= 0:
+            await asyncio.sleep(delay)
+        else:
+            # Claimed before the request, so workers do not all take the
+            # last slot at once
+            bucket.remaining -= 1
+
+    async def find_member(
+        self, guild: discord.Guild, user_id: int
+    ) -> Optional[discord.Member]:
+        member = guild.get_member(user_id)
+        if member is not None:
+            return member
+        await self.wait_for_bucket('member', guild.id)
+        try:
+            return await guild.fetch_member(user_id)
+        except discord.NotFound:
+            return None
+
+    async def role_ceiling(self, guild: discord.Guild, user_id: int) -> int:
+        """Targets need a top role below this position"""
+        # Checked again on every run, the invoker may have lost their roles
+        invoker = await self.find_member(guild, user_id)
+        if invoker is None:
+            raise RuntimeError(f'User {user_id} left guild {guild.id}')
+        ceiling = guild.me.top_role.position
+        if invoker.id != guild.owner_id:
+            ceiling = min(ceiling, invoker.top_role.position)
+        return ceiling
+
+    async def moderate(self, job: Job) -> None:
+        guild = self.bot.get_guild(job.guild_id)
+        if guild is None:
+            raise RuntimeError(f'Guild {job.guild_id} is not available')
+        ceiling = await self.role_ceiling(guild, job.started_by)
+
+        queue: asyncio.Queue[int] = asyncio.Queue()
+        for index in range(job.checkpoint, len(job.targets)):
+            queue.put_nowait(index)
+        job.done = job.checkpoint
+        workers = [
+            asyncio.create_task(self.worker(job, guild, ceiling, queue))
+            for _ in range(min(self.workers, queue.qsize()))
+        ]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    async def worker(
+        self,
+        job: Job,
+        guild: discord.Guild,
+        ceiling: int,
+        queue: asyncio.Queue
+    ) -> None:
+        while not queue.empty():
+            index = queue.get_nowait()
+            try:
+                await self.apply(job, guild, ceiling, job.targets[index])
+            except discord.NotFound:
+                # Already gone, nothing left to do for this one
+                pass
+            except discord.HTTPException:
+                job.failed += 1
+
+            job.done += 1
+            job.completed.add(index)
+            while job.checkpoint in job.completed:
+                job.completed.discard(job.checkpoint)
+                job.checkpoint += 1
+            self.progress(job)
+
+    async def apply(
+        self, job: Job, guild: discord.Guild, ceiling: int, user_id: int
+    ) -> None:
+        if user_id == guild.owner_id:
+            job.skipped += 1
+            return
+        member = await self.find_member(guild, user_id)
+        if member is None:
+            if job.action == 'kick':
+                return
+        elif member.top_role.position >= ceiling:
+            job.skipped += 1
+            return
+
+        await self.wait_for_bucket(job.action, guild.id)
+        user = discord.Object(user_id)
+        if job.action == 'ban':
+            await guild.ban(user, reason=job.reason, delete_message_seconds=0)
+        else:
+            await guild.kick(user, reason=job.reason)
+
+    async def purge(self, job: Job) -> None:
+        channel = self.bot.get_channel(job.target_channel)
+        if channel is None:
+            raise RuntimeError(
+                f'Channel {job.target_channel} is not available'
+            )
+
+        cutoff = discord.utils.utcnow() - bulk_delete_age
+        before = discord.Object(job.cursor) if job.cursor else None
+        chunk: list[discord.Message] = []
+        async for message in channel.history(limit=None, before=before):
+            if message.created_at < cutoff:
+                job.note = 'Stopped at messages older than 14 days'
+                break
+            if job.user_id and message.author.id != job.user_id:
+                continue
+            chunk.append(message)
+            if len(chunk) == 100 or job.done + len(chunk) >= job.limit:
+                await self.delete_chunk(job, channel, chunk)
+                chunk = []
+                if job.done >= job.limit:
+                    return
+        if chunk:
+            await self.delete_chunk(job, channel, chunk)
+
+    async def delete_chunk(
+        self,
+        job: Job,
+        channel: discord.TextChannel,
+        chunk: list[discord.Message]
+    ) -> None:
+        await self.wait_for_bucket('purge', channel.id)
+        try:
+            await channel.delete_messages(chunk, reason=job.reason)
+        except discord.NotFound:
+            pass
+        except discord.HTTPException:
+            job.failed += len(chunk)
+        job.done += len(chunk)
+        job.cursor = chunk[-1].id
+        self.progress(job)
+
+    def progress(self, job: Job) -> None:
+        if job.progress_task is None:
+            job.progress_task = asyncio.create_task(self.report_later(job))
+
+    async def report_later(self, job: Job) -> None:
+        try:
+            await asyncio.sleep(self.progress_interval)
+        finally:
+            job.progress_task = None
+        await self.report(job)
+
+    async def report(self, job: Job) -> None:
+        """Save the job and edit its progress message"""
+        try:
+            await self.collection.update_one(
+                {'_id': job.id}, {'$set': job.state()}
+            )
+        except Exception:
+            log.exception(f'Failed to save admin job {job.id}')
+
+        channel = self.bot.get_channel(job.channel_id)
+        if channel is None:
+            return
+        try:
+            if job.message_id is None:
+                message = await channel.send(job.describe())
+                job.message_id = message.id
+                await self.collection.update_one(
+                    {'_id': job.id}, {'$set': {'message': message.id}}
+                )
+            else:
+                message = channel.get_partial_message(job.message_id)
+                await message.edit(content=job.describe())
+        except discord.HTTPException:
+            log.exception(f'Failed to report progress of admin job {job.id}')
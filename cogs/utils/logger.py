@@ -0,0 +1,100 @@
+import copy
+import datetime
+import json
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line, for log shippers"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        timestamp = datetime.datetime.fromtimestamp(
+            record.created, tz=datetime.timezone.utc
+        )
+        entry = {
+            'time': timestamp.isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'process': record.process,
+            'thread': record.threadName
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class BoundedQueueHandler(QueueHandler):
+    """Hand records to a background thread without ever blocking.
+
+    When the queue is full the record is dropped and counted, and the
+    next record that fits is preceded by a warning with the count.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        super().__init__(queue.Queue(max_size))
+        self.dropped = 0
+        self.unreported = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Arguments may change before the listener thread gets to them.
+        # The queue never leaves the process, so exc_info can stay as is
+        # for each formatter to render the traceback its own way
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            if self.unreported:
+                warning = logging.makeLogRecord({
+                    'name': __name__,
+                    'levelno': logging.WARNING,
+                    'levelname': 'WARNING',
+                    'msg': f'Dropped {self.unreported} log records'
+                })
+                self.queue.put_nowait(warning)
+                self.unreported = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self.unreported += 1
+
+
+class BlockingStopListener(QueueListener):
+    def enqueue_sentinel(self) -> None:
+        # The queue may be full on shutdown, wait for room instead of failing
+        self.queue.put(self._sentinel)
+
+
+def start_queue(
+    logger: logging.Logger, max_size: int
+) -> tuple[BoundedQueueHandler, QueueListener]:
+    """Move every handler of `logger` behind a queue and a thread"""
+    handlers = logger.handlers[:]
+    for handler in handlers:
+        logger.removeHandler(handler)
+
+    queue_handler = BoundedQueueHandler(max_size)
+    listener = BlockingStopListener(
+        queue_handler.queue, *handlers, respect_handler_level=True
+    )
+    logger.addHandler(queue_handler)
+    listener.start()
+    return queue_handler, listener
+
+
+def find_queue_handler(
+    logger: Optional[logging.Logger] = None
+) -> Optional[BoundedQueueHandler]:
+    logger = logger or logging.getLogger()
+    for handler in logger.handlers:
+        if isinstance(handler, BoundedQueueHandler):
+            return handler
+    return None
@@ -0,0 +1,111 @@
+from collections import OrderedDict
+from typing import Optional
+
+record_overhead = 120  # Rough bytes used by a record and its dict slot
+
+
+class CachedMessage:
+    __slots__ = ('id', 'channel_id', 'author_id', 'content')
+
+    def __init__(
+        self, id: int, channel_id: int, author_id: int, content: str
+    ) -> None:
+        self.id = id
+        self.channel_id = channel_id
+        self.author_id = author_id
+        self.content = content
+
+    @property
+    def size(self) -> int:
+        return record_overhead + len(self.content)
+
+
+class MessageCache:
+    """Message contents kept for edit and delete logs.
+
+    Every guild keeps its own LRU of at most `per_guild` messages, and all
+    of them share a budget of `max_bytes`. Once the budget is reached the
+    guild using more than its fair share gives up its oldest messages.
+    """
+
+    def __init__(self, per_guild: int, max_bytes: int) -> None:
+        self.per_guild = per_guild
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.evictions = 0
+        self.guilds: dict[int, OrderedDict[int, CachedMessage]] = {}
+        self.guild_sizes: dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return sum(len(messages) for messages in self.guilds.values())
+
+    def get(
+        self, guild_id: int, message_id: int
+    ) -> Optional[CachedMessage]:
+        messages = self.guilds.get(guild_id)
+        if messages is None:
+            return None
+        message = messages.get(message_id)
+        if message is not None:
+            messages.move_to_end(message_id)
+        return message
+
+    def add(self, guild_id: int, message: CachedMessage) -> None:
+        self.pop(guild_id, message.id)
+        messages = self.guilds.setdefault(guild_id, OrderedDict())
+        messages[message.id] = message
+        self.resize(guild_id, message.size)
+
+        if len(messages) > self.per_guild:
+            self.evict(guild_id)
+        while self.size > self.max_bytes:
+            self.evict(self.victim(guild_id))
+
+    def update(self, guild_id: int, message_id: int, content: str) -> None:
+        message = self.get(guild_id, message_id)
+        if message is None:
+            return
+        self.resize(guild_id, len(content) - len(message.content))
+        message.content = content
+
+    def pop(
+        self, guild_id: int, message_id: int
+    ) -> Optional[CachedMessage]:
+        messages = self.guilds.get(guild_id)
+        if messages is None:
+            return None
+        message = messages.pop(message_id, None)
+        if message is not None:
+            self.resize(guild_id, -message.size)
+        return message
+
+    def remove_guild(self, guild_id: int) -> None:
+        self.guilds.pop(guild_id, None)
+        self.size -= self.guild_sizes.pop(guild_id, 0)
+
+    def resize(self, guild_id: int, delta: int) -> None:
+        self.size += delta
+        self.guild_sizes[guild_id] = self.guild_sizes.get(guild_id, 0) + delta
+
+    def victim(self, guild_id: int) -> int:
+        fair_share = self.max_bytes / len(self.guilds)
+        if self.guild_sizes.get(guild_id, 0) > fair_share:
+            return guild_id
+        return max(self.guild_sizes, key=self.guild_sizes.__getitem__)
+
+    def evict(self, guild_id: int) -> None:
+        messages = self.guilds[guild_id]
+        _, message = messages.popitem(last=False)
+        self.resize(guild_id, -message.size)
+        self.evictions += 1
+        if not messages:
+            self.remove_guild(guild_id)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'guilds': len(self.guilds),
+            'messages': len(self),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'evictions': self.evictions
+        }
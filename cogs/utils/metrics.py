@@ -0,0 +1,424 @@
+import bisect
+import functools
+import re
+import threading
+import time
+from typing import Callable, Iterable, Optional
+
+import aiohttp
+from aiohttp import web
+from pymongo import monitoring
+
+from cogs.utils.cache import TTLCache
+
+Labels = tuple[tuple[str, str], ...]
+Sample = tuple[str, dict[str, str], float]
+
+latency_buckets = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+
+snowflake = re.compile(r'/\d{15,21}')
+major = re.compile(r'/(?:channels|guilds|webhooks)/(\d{15,21})')
+token = re.compile(r'(/(?:webhooks|interactions)/\{id\}/)[^/?]+')
+
+
+def as_labels(labels: dict[str, str]) -> Labels:
+    return tuple(sorted(labels.items()))
+
+
+def escape(value: str) -> str:
+    return (
+        str(value)
+        .replace('\\', '\\\\')
+        .replace('"', '\\"')
+        .replace('\n', '\\n')
+    )
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    pairs = ','.join(f'{key}="{escape(value)}"' for key, value in labels)
+    return '{' + pairs + '}'
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.values: dict[Labels, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = as_labels(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels: str) -> float:
+        return self.values.get(as_labels(labels), 0)
+
+    def render(self) -> list[str]:
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} counter'
+        ]
+        for labels, value in sorted(self.values.items()):
+            lines.append(f'{self.name}{format_labels(labels)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        buckets: tuple[float, ...] = latency_buckets
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        # Per label set: one count per bucket plus +Inf, then the sum
+        self.values: dict[Labels, list] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = as_labels(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def count(self, **labels: str) -> int:
+        entry = self.values.get(as_labels(labels))
+        return sum(entry[0]) if entry else 0
+
+    def quantile(self, quantile: float, **labels: str) -> float:
+        """Upper bound of the bucket holding the quantile"""
+        entry = self.values.get(as_labels(labels))
+        if not entry:
+            return 0.0
+        target = quantile * sum(entry[0])
+        seen = 0
+        for index, count in enumerate(entry[0]):
+            seen += count
+            if seen >= target and count:
+                if index < len(self.buckets):
+                    return self.buckets[index]
+                return float('inf')
+        return float('inf')
+
+    def render(self) -> list[str]:
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} histogram'
+        ]
+        for labels, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            bounds = [str(bucket) for bucket in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                bucket_labels = format_labels(labels + (('le', bound),))
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(labels)} {total}')
+            lines.append(
+                f'{self.name}_count{format_labels(labels)} {cumulative}'
+            )
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: dict[str, object] = {}
+        self.collectors: dict[str, Callable[[], Iterable[Sample]]] = {}
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        if name not in self.metrics:
+            self.metrics[name] = Counter(name, documentation)
+        return self.metrics[name]
+
+    def histogram(self, name: str, documentation: str) -> Histogram:
+        if name not in self.metrics:
+            self.metrics[name] = Histogram(name, documentation)
+        return self.metrics[name]
+
+    def register_collector(
+        self, name: str, collector: Callable[[], Iterable[Sample]]
+    ) -> None:
+        """Gauges read on every scrape, `name` replaces an older one"""
+        self.collectors[name] = collector
+
+    def unregister_collector(self, name: str) -> None:
+        self.collectors.pop(name, None)
+
+    def collect(self) -> list[Sample]:
+        samples = []
+        for collector in list(self.collectors.values()):
+            samples.extend(collector())
+        return samples
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+
+        gauges: dict[str, list[str]] = {}
+        for name, labels, value in self.collect():
+            gauges.setdefault(name, []).append(
+                f'{name}{format_labels(as_labels(labels))} {value}'
+            )
+        for name, samples in gauges.items():
+            lines.append(f'# TYPE {name} gauge')
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+
+# Kept across reloads of this module, collectors registered by the Bot
+# and by loaded cogs would be lost with a new registry. Metrics created
+# below are looked up by name, so they keep their values too
+try:
+    registry
+except NameError:
+    registry = Registry()
+
+listener_calls = registry.counter(
+    'bot_listener_calls_total', 'Events handled by cog listeners'
+)
+listener_errors = registry.counter(
+    'bot_listener_errors_total', 'Cog listener calls that raised'
+)
+listener_latency = registry.histogram(
+    'bot_listener_latency_seconds', 'Time spent in cog listeners'
+)
+mongo_latency = registry.histogram(
+    'bot_mongo_command_seconds', 'MongoDB command round trips'
+)
+mongo_failures = registry.counter(
+    'bot_mongo_command_failures_total', 'MongoDB commands that failed'
+)
+mongo_pool_wait = registry.histogram(
+    'bot_mongo_pool_wait_seconds', 'Time spent waiting for a connection'
+)
+mongo_pool_failures = registry.counter(
+    'bot_mongo_pool_checkout_failures_total',
+    'Connection checkouts that failed, by reason'
+)
+http_requests = registry.counter(
+    'bot_http_requests_total', 'Discord HTTP requests by route and status'
+)
+http_latency = registry.histogram(
+    'bot_http_request_seconds', 'Discord HTTP request round trips'
+)
+http_ratelimited = registry.counter(
+    'bot_http_ratelimited_total', 'Discord HTTP requests answered with 429'
+)
+
+
+def instrument(cog: str) -> Callable:
+    """Count and time every call of a listener coroutine"""
+
+    def decorator(func: Callable) -> Callable:
+        labels = {'cog': cog, 'listener': func.__name__}
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                listener_errors.inc(**labels)
+                raise
+            finally:
+                listener_calls.inc(**labels)
+                listener_latency.observe(
+                    time.perf_counter() - started, **labels
+                )
+
+        return wrapper
+
+    return decorator
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Time every command the driver sends, called from driver threads"""
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        pass
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        mongo_latency.observe(
+            event.duration_micros / 1_000_000, command=event.command_name
+        )
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        mongo_latency.observe(
+            event.duration_micros / 1_000_000, command=event.command_name
+        )
+        mongo_failures.inc(command=event.command_name)
+
+
+class MongoPoolListener(monitoring.ConnectionPoolListener):
+    """Track open and checked out connections per server"""
+
+    def __init__(self) -> None:
+        self.open: dict[str, int] = {}
+        self.checked_out: dict[str, int] = {}
+        self.lock = threading.Lock()
+        # Checkouts start and finish on the same driver thread
+        self.local = threading.local()
+
+    def add(self, counts: dict[str, int], address: tuple, amount: int):
+        key = f'{address[0]}:{address[1]}'
+        with self.lock:
+            counts[key] = counts.get(key, 0) + amount
+
+    def collect(self) -> list[Sample]:
+        samples = []
+        for name, counts in (
+            ('bot_mongo_pool_connections', self.open),
+            ('bot_mongo_pool_checked_out', self.checked_out)
+        ):
+            samples.extend(
+                (name, {'server': server}, count)
+                for server, count in list(counts.items())
+            )
+        return samples
+
+    def pool_created(self, event) -> None:
+        pass
+
+    def pool_ready(self, event) -> None:
+        pass
+
+    def pool_cleared(self, event) -> None:
+        pass
+
+    def pool_closed(self, event) -> None:
+        key = f'{event.address[0]}:{event.address[1]}'
+        with self.lock:
+            self.open.pop(key, None)
+            self.checked_out.pop(key, None)
+
+    def connection_created(self, event) -> None:
+        self.add(self.open, event.address, 1)
+
+    def connection_ready(self, event) -> None:
+        pass
+
+    def connection_closed(self, event) -> None:
+        self.add(self.open, event.address, -1)
+
+    def connection_check_out_started(self, event) -> None:
+        self.local.started = time.perf_counter()
+
+    def connection_check_out_failed(self, event) -> None:
+        self.observe_wait()
+        mongo_pool_failures.inc(reason=str(event.reason))
+
+    def connection_checked_out(self, event) -> None:
+        self.observe_wait()
+        self.add(self.checked_out, event.address, 1)
+
+    def connection_checked_in(self, event) -> None:
+        self.add(self.checked_out, event.address, -1)
+
+    def observe_wait(self) -> None:
+        started = getattr(self.local, 'started', None)
+        if started is not None:
+            mongo_pool_wait.observe(time.perf_counter() - started)
+            self.local.started = None
+
+
+def route_name(method: str, url: aiohttp.client.URL) -> str:
+    path = snowflake.sub('/{id}', url.path)
+    path = token.sub(r'\1{token}', path)
+    return f'{method} {path.removeprefix("/api/v10")}'
+
+
+class RatelimitBucket:
+    __slots__ = ('remaining', 'reset_at')
+
+    def __init__(self, remaining: int, reset_at: float) -> None:
+        self.remaining = remaining
+        self.reset_at = reset_at
+
+
+# Last rate limit headers seen, keyed by bucket_key. Every channel, guild
+# and webhook has its own, so only the most recently used are kept
+max_buckets = 10_000
+try:
+    ratelimits
+except NameError:
+    ratelimits = TTLCache(max_size=max_buckets)
+
+
+def bucket_key(route: str, url: aiohttp.client.URL) -> str:
+    """Discord keeps separate buckets per channel, guild and webhook"""
+    match = major.search(url.path)
+    return f'{route} {match.group(1)}' if match else route
+
+
+def find_bucket(route: str, major_id: int) -> Optional[RatelimitBucket]:
+    """Last known state of a bucket, e.g. `PUT /guilds/{id}/bans/{id}`"""
+    return ratelimits.get(f'{route} {major_id}', count=False)
+
+
+def http_trace() -> aiohttp.TraceConfig:
+    trace = aiohttp.TraceConfig()
+
+    async def on_request_start(session, context, params) -> None:
+        context.started = time.perf_counter()
+
+    async def on_request_end(session, context, params) -> None:
+        route = route_name(params.method, params.url)
+        status = params.response.status
+        http_requests.inc(route=route, status=str(status))
+        http_latency.observe(
+            time.perf_counter() - context.started, route=route
+        )
+        if status == 429:
+            http_ratelimited.inc(route=route)
+
+        headers = params.response.headers
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset_after = headers.get('X-RateLimit-Reset-After')
+        if remaining is not None and reset_after is not None:
+            ratelimits.set(bucket_key(route, params.url), RatelimitBucket(
+                int(remaining), time.monotonic() + float(reset_after)
+            ))
+
+    trace.on_request_start.append(on_request_start)
+    trace.on_request_end.append(on_request_end)
+    return trace
+
+
+class MetricsServer:
+    """Serve the registry in the Prometheus text format"""
+
+    def __init__(self, host: str, port: int) -> None:
+        self.host = host
+        self.port = port
+        self.runner: Optional[web.AppRunner] = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        return web.Response(
+            text=registry.render(),
+            content_type='text/plain',
+            headers={'X-Content-Type-Options': 'nosniff'}
+        )
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+
+    async def close(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
@@ -1,16 +1,104 @@
-from typing import Optional
+import asyncio
+import copy
+import logging
+from types import MappingProxyType
+from typing import Any, Iterable, Mapping, Optional
 
 import motor.motor_asyncio as motor
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure, PyMongoError
 
 import config
+from cogs.utils import metrics
+from cogs.utils.cache import TTLCache
 
-client = motor.AsyncIOMotorClient(config.client_uri)
-db = client['tools-by-bitacora']
+log = logging.getLogger(__name__)
+
+default_options = {
+    'maxPoolSize': 50,
+    'minPoolSize': 0,
+    'maxIdleTimeMS': 300_000,
+    'waitQueueTimeoutMS': 10_000,
+    'connectTimeoutMS': 10_000,
+    'serverSelectionTimeoutMS': 10_000,
+    'readPreference': 'primary',
+    'compressors': 'zlib'
+}
+
+# Owned by the Bot, which opens it in setup_hook and closes it on shutdown.
+# Kept across reloads of this module so they never open a second pool.
+# The settings cache too, the change stream started by the Bot keeps
+# updating the one it was started with
+try:
+    client
+except NameError:
+    client: Optional[motor.AsyncIOMotorClient] = None
+    db: Optional[motor.AsyncIOMotorDatabase] = None
+    pool = metrics.MongoPoolListener()
+    settings = TTLCache(
+        max_size=getattr(config, 'settings_cache_size', 10_000),
+        ttl=getattr(config, 'settings_cache_ttl', 300)
+    )
+    # Bumped whenever a guild's settings change, so a fetch that started
+    # before the change does not cache what it read. None counts changes
+    # to the whole collection
+    generations: dict[Optional[int], int] = {}
+
+metrics.registry.register_collector(
+    'settings_cache',
+    lambda: [
+        (f'bot_settings_cache_{key}', {}, value)
+        for key, value in settings.stats().items()
+    ]
+)
+metrics.registry.register_collector('mongo_pool', pool.collect)
+
+
+def connect() -> motor.AsyncIOMotorDatabase:
+    """Open the shared client once, with `config.mongo_options` applied"""
+    global client, db
+    if db is not None:
+        return db
+
+    options = dict(default_options, **getattr(config, 'mongo_options', {}))
+    client = motor.AsyncIOMotorClient(
+        config.client_uri,
+        event_listeners=[metrics.MongoCommandListener(), pool],
+        **options
+    )
+    db = client[getattr(config, 'mongo_database', 'tools-by-bitacora')]
+    return db
+
+
+def close() -> None:
+    global client, db
+    if client is not None:
+        client.close()
+    client = None
+    db = None
+
+
+def generation(guild: int) -> tuple[int, int]:
+    return generations.get(None, 0), generations.get(guild, 0)
+
+
+def changed(
+    guild: Optional[int], guild_settings: Optional[dict] = None
+) -> None:
+    generations[guild] = generations.get(guild, 0) + 1
+    if guild is None:
+        settings.clear()
+        return
+    if guild_settings is None:
+        settings.pop(guild)
+    else:
+        settings.set(guild, guild_settings)
 
 
 class Guild:
     def __init__(self, guild: int) -> None:
         self.guilds = db['guilds']
+        self.guild = guild
         self.query = {'_id': guild}
 
     async def new(self) -> None:
@@ -19,12 +107,110 @@ class Guild:
     async def find(self) -> Optional[dict]:
         return await self.guilds.find_one(self.query)
 
-    async def check(self) -> dict:
-        guild_settings = await self.find()
-        if not guild_settings:
-            await self.new()
+    async def check(self) -> Mapping[str, Any]:
+        """A read-only view of the cached settings, copy them to change"""
+        guild_settings = settings.get(self.guild)
+        if guild_settings is not None:
+            return MappingProxyType(guild_settings)
+
+        started = generation(self.guild)
+        query = {'$setOnInsert': self.query}
+        try:
+            guild_settings = await self.guilds.find_one_and_update(
+                self.query, query, upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # Two upserts for a new guild raced, the loser can just read
             guild_settings = await self.find()
-        return guild_settings
+        if generation(self.guild) == started:
+            settings.set(self.guild, guild_settings)
+        return MappingProxyType(guild_settings)
+
+    async def update(
+        self, query: dict, return_document: bool = False
+    ) -> Optional[dict]:
+        if not return_document:
+            await self.guilds.update_one(self.query, query, upsert=True)
+            changed(self.guild)
+            return None
+
+        guild_settings = await self.guilds.find_one_and_update(
+            self.query, query, upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        changed(self.guild, guild_settings)
+        return copy.deepcopy(guild_settings)
+
+
+async def preload(guild_ids: Iterable[int], batch_size: int = 500) -> int:
+    """Fill the settings cache for every guild in a single batched query"""
+    # Guilds changed during the query keep what they have cached
+    started = {guild: generation(guild) for guild in guild_ids}
+    missing = set(started)
+    # Room for every guild, plus some for those joined later
+    settings.max_size = max(settings.max_size, len(missing) * 5 // 4)
+    query = {'_id': {'$in': list(missing)}}
+    cursor = db['guilds'].find(query, batch_size=batch_size)
+
+    loaded = 0
+    async for guild_settings in cursor:
+        guild = guild_settings['_id']
+        if generation(guild) == started[guild]:
+            settings.set(guild, guild_settings)
+        missing.discard(guild)
+        loaded += 1
+
+    # Guilds without a document behave like a freshly created one
+    for guild in missing:
+        if generation(guild) == started[guild]:
+            settings.set(guild, {'_id': guild})
+    return loaded
+
+
+def apply_change(change: dict) -> None:
+    operation = change['operationType']
+    if operation in ('drop', 'rename', 'dropDatabase', 'invalidate'):
+        changed(None)
+        return
+
+    guild = change['documentKey']['_id']
+    document = change.get('fullDocument')
+    if operation == 'delete' or guild not in settings:
+        # Uncached guilds are left for check() to load
+        document = None
+    changed(guild, document)
+
+
+async def watch(retry_delay: float = 5.0) -> None:
+    """Keep cached settings current with changes made by other processes.
 
-    async def update(self, query: dict) -> None:
-        await self.guilds.update_one(self.query, query, upsert=True)
+    Change streams need a replica set, a standalone server makes this
+    return straight away and the cache falls back to its TTL. While the
+    stream is open every change reaches the cache, so entries are kept
+    until evicted instead.
+    """
+    resume_token = None
+    while True:
+        try:
+            stream = db['guilds'].watch(
+                full_document='updateLookup', resume_after=resume_token
+            )
+            async with stream:
+                settings.ttl = None
+                async for change in stream:
+                    resume_token = stream.resume_token
+                    apply_change(change)
+        except OperationFailure as e:
+            if e.code in (40573, 40324):
+                log.warning(f'Settings change stream unavailable: {e}')
+                return
+            log.exception('Settings change stream failed')
+            resume_token = None
+            changed(None)
+        except PyMongoError:
+            log.exception('Settings change stream interrupted')
+        finally:
+            # Changes are missed until the stream is back
+            settings.ttl = getattr(config, 'settings_cache_ttl', 300)
+        await asyncio.sleep(retry_delay)
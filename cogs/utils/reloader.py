@@ -0,0 +1,266 @@
+import ast
+import asyncio
+import hashlib
+import importlib
+import logging
+import os
+import sys
+from typing import Optional
+
+from discord.ext import commands
+
+from cogs.utils import files
+
+log = logging.getLogger(__name__)
+
+packages = ('cogs', 'cogs.utils')
+
+
+class Source:
+    __slots__ = ('mtime', 'size', 'digest', 'imports')
+
+    def __init__(
+        self, mtime: int, size: int, digest: str, imports: set[str]
+    ) -> None:
+        self.mtime = mtime
+        self.size = size
+        self.digest = digest
+        self.imports = imports
+
+
+def module_path(module: str) -> str:
+    return f'{files.folder_path}/{module.replace(".", "/")}.py'
+
+
+def parse_imports(source: bytes, known: set[str]) -> set[str]:
+    imports = set()
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            names = [node.module] + [
+                f'{node.module}.{alias.name}' for alias in node.names
+            ]
+        else:
+            continue
+        imports.update(name for name in names if name in known)
+    return imports
+
+
+class Reloader:
+    """Reload only the extensions whose source, or whose helpers, changed.
+
+    Files are compared by mtime and size first and hashed only when those
+    differ, so checking for changes costs one stat per file.
+    """
+
+    def __init__(self, bot: commands.Bot) -> None:
+        self.bot = bot
+        self.sources: dict[str, Source] = {}
+        # Digests that failed to load, which the watcher does not retry
+        self.failed: dict[str, str] = {}
+        self.watcher: Optional[asyncio.Task] = None
+
+    def scan(self) -> dict[str, os.stat_result]:
+        modules = {}
+        for package in packages:
+            folder = f'{files.folder_path}/{package.replace(".", "/")}'
+            for entry in os.scandir(folder):
+                if entry.name.endswith('.py') and entry.name != '__init__.py':
+                    modules[f'{package}.{entry.name[:-3]}'] = entry.stat()
+        return modules
+
+    def read(
+        self, module: str, stat: os.stat_result, known: set[str]
+    ) -> Source:
+        with open(module_path(module), 'rb') as f:
+            source = f.read()
+        return Source(
+            stat.st_mtime_ns,
+            stat.st_size,
+            hashlib.sha1(source).hexdigest(),
+            parse_imports(source, known)
+        )
+
+    def snapshot(self) -> None:
+        stats = self.scan()
+        known = set(stats)
+        self.sources = {
+            module: self.read(module, stat, known)
+            for module, stat in stats.items()
+        }
+
+    def changes(
+        self, retry_failed: bool = True
+    ) -> tuple[set[str], set[str], set[str], dict[str, Source]]:
+        """Changed, added and removed modules, and the changed sources.
+
+        Changed sources are only recorded by `reload` once they loaded, so
+        a file that failed to load is tried again on the next check.
+        """
+        stats = self.scan()
+        known = set(stats)
+        changed = set()
+        added = set()
+        pending = {}
+        for module, stat in stats.items():
+            previous = self.sources.get(module)
+            if (
+                previous is not None and
+                previous.mtime == stat.st_mtime_ns and
+                previous.size == stat.st_size
+            ):
+                continue
+            source = self.read(module, stat, known)
+            if previous is None:
+                added.add(module)
+            if previous is None or previous.digest != source.digest:
+                if not retry_failed and \
+                        self.failed.get(module) == source.digest:
+                    continue
+                changed.add(module)
+                pending[module] = source
+            else:
+                self.sources[module] = source
+
+        removed = set(self.sources) - known
+        for module in removed:
+            del self.sources[module]
+        return changed, added, removed, pending
+
+    def dependents(
+        self, modules: set[str], sources: dict[str, Source]
+    ) -> set[str]:
+        """Every module that imports one of `modules`, directly or not"""
+        closure = set(modules)
+        pending = list(modules)
+        while pending:
+            module = pending.pop()
+            for name, source in sources.items():
+                if module in source.imports and name not in closure:
+                    closure.add(name)
+                    pending.append(name)
+        return closure
+
+    def helper_order(
+        self, helpers: set[str], sources: dict[str, Source]
+    ) -> list[str]:
+        """Helpers sorted so every module comes after what it imports"""
+        ordered = []
+        visiting = set()
+
+        def visit(module: str) -> None:
+            if module in ordered or module in visiting:
+                return
+            visiting.add(module)
+            for dependency in sources[module].imports & helpers:
+                visit(dependency)
+            ordered.append(module)
+
+        for module in sorted(helpers):
+            visit(module)
+        return ordered
+
+    async def reload(self, retry_failed: bool = True) -> list[str]:
+        changed, added, removed, pending = self.changes(retry_failed)
+        if not changed and not removed:
+            return []
+
+        output = []
+        failed = set()
+        sources = dict(self.sources, **pending)
+        closure = self.dependents(changed, sources)
+        helpers = {m for m in closure if m.startswith('cogs.utils.')}
+        for module in self.helper_order(helpers, sources):
+            if module not in sys.modules:
+                continue
+            # Dependencies come first, so skipped ones are already known
+            if sources[module].imports & failed:
+                failed.add(module)
+                output.append(self.skipped('Module', module))
+                continue
+            try:
+                importlib.reload(sys.modules[module])
+            except Exception as e:
+                failed.add(module)
+                log.exception(f'Failed to reload module {module}')
+                output.append(f'{module}: {e.__class__.__name__}: {e}')
+            else:
+                log.info(f'Successfully reloaded module {module}')
+                output.append(f'Module \'{module}\' reloaded.')
+
+        loaded = set(self.bot.extensions)
+        extensions = {m for m in closure if m not in helpers}
+        broken = self.dependents(failed, sources)
+        jobs = []
+        for extension in sorted(extensions | removed):
+            if extension in removed:
+                if extension in loaded:
+                    jobs.append(('unloaded', extension))
+            elif extension in broken:
+                # Would run against a partly executed helper
+                failed.add(extension)
+                output.append(self.skipped('Extension', extension))
+            elif extension in loaded:
+                jobs.append(('reloaded', extension))
+            elif extension in added:
+                jobs.append(('loaded', extension))
+
+        results = await asyncio.gather(
+            *(self.apply(action, extension) for action, extension in jobs),
+            return_exceptions=True
+        )
+        for (action, extension), result in zip(jobs, results):
+            if isinstance(result, Exception):
+                failed.add(extension)
+                log.error(
+                    f'Failed to reload extension {extension}',
+                    exc_info=result
+                )
+                output.append(
+                    f'{extension}: {result.__class__.__name__}: {result}'
+                )
+            else:
+                log.info(f'Successfully {action} extension {extension}')
+                output.append(f'Extension \'{extension}\' {action}.')
+
+        for module, source in pending.items():
+            if module in failed:
+                self.failed[module] = source.digest
+            else:
+                self.failed.pop(module, None)
+                self.sources[module] = source
+        return output
+
+    def skipped(self, kind: str, name: str) -> str:
+        log.warning(f'Skipped reloading {name}, a module it imports failed')
+        return f'{kind} \'{name}\' skipped, a module it imports failed.'
+
+    async def apply(self, action: str, extension: str) -> None:
+        if action == 'unloaded':
+            await self.bot.unload_extension(extension)
+        elif action == 'loaded':
+            await self.bot.load_extension(extension)
+        else:
+            await self.bot.reload_extension(extension)
+
+    def watch(self, interval: float = 1.0) -> None:
+        if self.watcher is None or self.watcher.done():
+            self.watcher = asyncio.create_task(self.run_watcher(interval))
+
+    def stop_watching(self) -> None:
+        if self.watcher is not None:
+            self.watcher.cancel()
+            self.watcher = None
+
+    @property
+    def watching(self) -> bool:
+        return self.watcher is not None and not self.watcher.done()
+
+    async def run_watcher(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.reload(retry_failed=False)
+            except Exception:
+                log.exception('Automatic reload failed')
@@ -0,0 +1,139 @@
+import asyncio
+import importlib.util
+import logging
+import sys
+import threading
+import time
+import traceback
+from typing import Optional
+
+import discord
+
+from cogs.utils import metrics
+
+log = logging.getLogger(__name__)
+
+loop_lag = metrics.registry.histogram(
+    'bot_event_loop_lag_seconds', 'Delay before the event loop ran a timer'
+)
+loop_stalls = metrics.registry.counter(
+    'bot_event_loop_stalls_total', 'Times the event loop blocked too long'
+)
+
+
+def installed(module: str) -> bool:
+    return importlib.util.find_spec(module) is not None
+
+
+def apply_profile(profile: str) -> dict[str, bool]:
+    """Select the event loop implementation and report the fast paths.
+
+    The `fast` profile uses uvloop when it is installed. discord.py picks
+    orjson for gateway and HTTP payloads on its own once it is installed,
+    and aiohttp does the same with aiodns and Brotli.
+    """
+    report = {
+        'uvloop': False,
+        'orjson': discord.utils.HAS_ORJSON,
+        'aiodns': installed('aiodns'),
+        'brotli': installed('brotli') or installed('brotlicffi')
+    }
+    if profile == 'fast':
+        try:
+            import uvloop
+        except ImportError:
+            log.warning('The fast runtime profile wants uvloop installed')
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            report['uvloop'] = True
+
+    enabled = ', '.join(name for name, value in report.items() if value)
+    log.info(f'Runtime profile {profile}: {enabled or "no speedups"}')
+    return report
+
+
+def describe_task(task: Optional[asyncio.Task]) -> str:
+    if task is None:
+        return 'a callback outside any task'
+    coro = task.get_coro()
+    name = getattr(coro, '__qualname__', None) or repr(coro)
+    return f'{name} ({task.get_name()})'
+
+
+class LoopMonitor:
+    """Measure event loop lag and name whatever blocks the loop.
+
+    A timer task on the loop records how late it wakes up. A watchdog
+    thread checks that the timer keeps running, and when it stops for
+    longer than `threshold` logs the task and stack running on the loop.
+    """
+
+    def __init__(
+        self, interval: float = 0.5, threshold: float = 0.25
+    ) -> None:
+        self.interval = interval
+        self.threshold = threshold
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread: Optional[int] = None
+        self.task: Optional[asyncio.Task] = None
+        self.watchdog: Optional[threading.Thread] = None
+        self.stopped = threading.Event()
+        self.heartbeat = time.monotonic()
+        self.max_lag = 0.0
+
+    def start(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.stopped.clear()
+        self.task = asyncio.create_task(self.sample())
+        self.watchdog = threading.Thread(
+            target=self.watch, name='loop-watchdog', daemon=True
+        )
+        self.watchdog.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def sample(self) -> None:
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.heartbeat = now
+            lag = max(now - expected, 0.0)
+            self.max_lag = max(self.max_lag, lag)
+            loop_lag.observe(lag)
+            if lag > self.threshold:
+                log.warning(f'Event loop ran {lag * 1000:.0f} ms late')
+
+    def watch(self) -> None:
+        reported = None
+        while not self.stopped.wait(self.threshold / 2):
+            blocked = time.monotonic() - self.heartbeat - self.interval
+            if blocked <= self.threshold:
+                reported = None
+                continue
+            if reported == self.heartbeat:
+                continue
+
+            reported = self.heartbeat
+            loop_stalls.inc()
+            log.warning(
+                f'Event loop blocked for {blocked * 1000:.0f} ms by '
+                f'{self.blocking_task()}\n{self.blocking_stack()}'
+            )
+
+    def blocking_task(self) -> str:
+        # Read from another thread, good enough to name the culprit
+        current = getattr(asyncio.tasks, '_current_tasks', {})
+        return describe_task(current.get(self.loop))
+
+    def blocking_stack(self) -> str:
+        frame = sys._current_frames().get(self.loop_thread)
+        if frame is None:
+            return ''
+        return ''.join(traceback.format_stack(frame, limit=8))
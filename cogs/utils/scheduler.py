@@ -0,0 +1,155 @@
+import asyncio
+import datetime
+import heapq
+import logging
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+log = logging.getLogger(__name__)
+
+Callback = Callable[[list[Any]], Awaitable[None]]
+
+
+def timestamp(when: datetime.datetime) -> float:
+    if when.tzinfo is None:
+        # BSON dates come back naive but are always UTC
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return when.timestamp()
+
+
+class Scheduler:
+    """Fire deadlines from a single min-heap and a single timer task.
+
+    Deadlines live in MongoDB, the heap only holds `(when, key)` pairs so
+    each pending timer costs a tuple instead of a task. Due keys are handed to
+    `callback` in batches of at most `batch_size`, and a failed batch is
+    retried after `retry_delay` seconds. Deadlines that passed while the
+    bot was offline are due straight away once loaded.
+    """
+
+    def __init__(
+        self,
+        callback: Callback,
+        batch_size: int = 50,
+        retry_delay: float = 60.0
+    ) -> None:
+        self.callback = callback
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.heap: list[tuple[float, Any]] = []
+        # Current deadline per key, heap entries that disagree are stale
+        self.deadlines: dict[Any, float] = {}
+        self.wake = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.fired = 0
+        self.failed = 0
+
+    def __len__(self) -> int:
+        return len(self.deadlines)
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self.deadlines
+
+    def start(self) -> None:
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def load(
+        self, documents: Any, key: str = '_id', field: str = 'ends_at'
+    ) -> int:
+        """Schedule every document yielded by an async cursor"""
+        loaded = 0
+        async for document in documents:
+            self.schedule(document[key], document[field], wake=False)
+            loaded += 1
+        self.wake.set()
+        return loaded
+
+    def schedule(
+        self, key: Any, when: datetime.datetime, wake: bool = True
+    ) -> None:
+        deadline = timestamp(when)
+        self.deadlines[key] = deadline
+        heapq.heappush(self.heap, (deadline, key))
+        if wake and self.heap[0][1] == key:
+            self.wake.set()
+
+    def cancel(self, key: Any) -> None:
+        # The heap entry is skipped when it comes up
+        self.deadlines.pop(key, None)
+
+    def compact(self) -> None:
+        """Drop stale entries once they outnumber the live ones"""
+        if len(self.heap) > 2 * len(self.deadlines) + 1024:
+            self.heap = [(d, k) for k, d in self.deadlines.items()]
+            heapq.heapify(self.heap)
+
+    def due(self, now: float) -> list[Any]:
+        batch = []
+        while self.heap and len(batch) < self.batch_size:
+            deadline, key = self.heap[0]
+            if self.deadlines.get(key) != deadline:
+                heapq.heappop(self.heap)
+                continue
+            if deadline > now:
+                break
+            heapq.heappop(self.heap)
+            del self.deadlines[key]
+            batch.append(key)
+        return batch
+
+    def next_deadline(self) -> Optional[float]:
+        while self.heap:
+            deadline, key = self.heap[0]
+            if self.deadlines.get(key) == deadline:
+                return deadline
+            heapq.heappop(self.heap)
+        return None
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            self.wake.clear()
+            deadline = self.next_deadline()
+            now = time.time()
+            if deadline is None or deadline > now:
+                timeout = None if deadline is None else deadline - now
+                try:
+                    await asyncio.wait_for(self.wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            batch = self.due(now)
+            started = loop.time()
+            try:
+                await self.callback(batch)
+            except Exception:
+                self.failed += len(batch)
+                log.exception(f'Failed to fire {len(batch)} deadlines')
+                retry = datetime.datetime.fromtimestamp(
+                    now + self.retry_delay, tz=datetime.timezone.utc
+                )
+                for key in batch:
+                    if key not in self.deadlines:
+                        self.schedule(key, retry, wake=False)
+            else:
+                self.fired += len(batch)
+            elapsed = loop.time() - started
+            if elapsed > 1:
+                log.info(f'Fired {len(batch)} deadlines in {elapsed:.1f}s')
+            self.compact()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'pending': len(self.deadlines),
+            'heap': len(self.heap),
+            'fired': self.fired,
+            'failed': self.failed
+        }
+
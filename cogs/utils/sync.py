@@ -0,0 +1,146 @@
+import asyncio
+import hashlib
+import json
+import logging
+from typing import Iterable, Optional
+
+import discord
+from discord import app_commands
+
+from cogs.utils import mongo
+
+log = logging.getLogger(__name__)
+
+command_types = {1: 'slash', 2: 'user', 3: 'message'}
+
+
+def command_key(payload: dict) -> str:
+    # Names are only unique per command type
+    kind = command_types.get(payload.get('type', 1), 'slash')
+    return f'{kind} {payload["name"]}'
+
+
+def payload_hash(payload: dict) -> str:
+    data = json.dumps(payload, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class SyncResult:
+    """What changed between the local tree and the last synced state"""
+
+    __slots__ = ('target', 'added', 'changed', 'removed', 'synced', 'error')
+
+    def __init__(
+        self,
+        target: str,
+        added: list[str],
+        changed: list[str],
+        removed: list[str]
+    ) -> None:
+        self.target = target
+        self.added = added
+        self.changed = changed
+        self.removed = removed
+        self.synced = False
+        self.error: Optional[str] = None
+
+    @property
+    def differs(self) -> bool:
+        return bool(self.added or self.changed or self.removed)
+
+    def describe(self) -> str:
+        if self.error:
+            return f'{self.target}: failed, {self.error}'
+        if not self.synced:
+            return f'{self.target}: up to date'
+        parts = [
+            f'{label} {", ".join(names)}'
+            for label, names in (
+                ('added', self.added),
+                ('changed', self.changed),
+                ('removed', self.removed)
+            ) if names
+        ]
+        return f'{self.target}: synced, {"; ".join(parts) or "forced"}'
+
+
+class CommandSync:
+    """Sync application commands only when their payloads change.
+
+    The hash of every command's `to_dict()` is stored per target in
+    `collection_name` after a successful sync, so later syncs compare
+    hashes and skip the request when nothing differs. Guilds are synced
+    concurrently, at most `concurrency` at a time, since Discord limits
+    how often commands can be synced.
+    """
+
+    def __init__(
+        self,
+        tree: app_commands.CommandTree,
+        concurrency: int = 4,
+        collection_name: str = 'command_sync'
+    ) -> None:
+        self.tree = tree
+        self.collection_name = collection_name
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    @property
+    def collection(self):
+        return mongo.db[self.collection_name]
+
+    def hashes(self, guild: Optional[discord.abc.Snowflake]) -> dict:
+        commands = self.tree.get_commands(guild=guild)
+        payloads = (command.to_dict() for command in commands)
+        return {
+            command_key(payload): payload_hash(payload)
+            for payload in payloads
+        }
+
+    async def stored(self, key: str) -> dict:
+        document = await self.collection.find_one({'_id': key})
+        return document['commands'] if document else {}
+
+    async def sync(
+        self,
+        guild: Optional[discord.abc.Snowflake] = None,
+        force: bool = False
+    ) -> SyncResult:
+        key = str(guild.id) if guild else 'global'
+        target = f'Guild {guild.id}' if guild else 'Global'
+        local = self.hashes(guild)
+        remote = await self.stored(key)
+        result = SyncResult(
+            target,
+            added=sorted(local.keys() - remote.keys()),
+            changed=sorted(
+                name for name in local.keys() & remote.keys()
+                if local[name] != remote[name]
+            ),
+            removed=sorted(remote.keys() - local.keys())
+        )
+        if not result.differs and not force:
+            return result
+
+        async with self.semaphore:
+            try:
+                await self.tree.sync(guild=guild)
+            except discord.HTTPException as e:
+                result.error = str(e)
+                log.exception(f'Failed to sync commands for {target}')
+                return result
+
+        await self.collection.update_one(
+            {'_id': key}, {'$set': {'commands': local}}, upsert=True
+        )
+        result.synced = True
+        log.info(result.describe())
+        return result
+
+    async def sync_many(
+        self,
+        guilds: Iterable[discord.abc.Snowflake],
+        force: bool = False
+    ) -> list[SyncResult]:
+        return await asyncio.gather(
+            *(self.sync(guild, force) for guild in guilds)
+        )
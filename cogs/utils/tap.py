@@ -0,0 +1,107 @@
+import logging
+import random
+from collections import Counter
+from logging.handlers import QueueListener, RotatingFileHandler
+from typing import Any, Callable, Iterable, Optional
+
+import discord
+
+from cogs.utils import logger
+
+Parser = Callable[[dict], Any]
+
+
+class GatewayTap:
+    """Capture gateway dispatches to rotating JSONL files.
+
+    Every parser in the connection state is wrapped while the tap runs,
+    the gateway looks them up in that same dict. Each line holds the event
+    type and payload as `{"t": ..., "d": ...}`, ready for the benchmark
+    replay. Writes go through a queue and a thread of their own.
+    """
+
+    def __init__(
+        self,
+        state: Any,
+        filename: str = 'gateway-tap.jsonl',
+        max_bytes: int = 64 * 1024 * 1024,
+        backup_count: int = 5,
+        queue_size: int = 10_000
+    ) -> None:
+        self.state = state
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.queue_size = queue_size
+        self.ratio = 1.0
+        self.events: Optional[frozenset[str]] = None
+        self.seen: Counter = Counter()
+        self.captured: Counter = Counter()
+        self.originals: dict[str, Parser] = {}
+        self.log = logging.getLogger(__name__)
+        self.log.propagate = False
+        self.log.setLevel(logging.INFO)
+        self.listener: Optional[QueueListener] = None
+
+    @property
+    def running(self) -> bool:
+        return bool(self.originals)
+
+    def start(
+        self, ratio: float = 1.0, events: Iterable[str] = ()
+    ) -> None:
+        """Start capturing, or change what a running tap captures"""
+        self.ratio = min(max(ratio, 0.0), 1.0)
+        self.events = frozenset(e.upper() for e in events) or None
+        if self.listener is None:
+            self.open()
+
+        parsers = self.state.parsers
+        for name, parser in list(parsers.items()):
+            if name not in self.originals:
+                self.originals[name] = parser
+                parsers[name] = self.wrap(name, parser)
+
+    def stop(self) -> None:
+        self.state.parsers.update(self.originals)
+        self.originals.clear()
+        if self.listener is not None:
+            self.listener.stop()
+            for handler in self.log.handlers + list(self.listener.handlers):
+                handler.close()
+                self.log.removeHandler(handler)
+            self.listener = None
+
+    def open(self) -> None:
+        handler = RotatingFileHandler(
+            filename=self.filename,
+            encoding='utf-8',
+            maxBytes=self.max_bytes,
+            backupCount=self.backup_count
+        )
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self.log.addHandler(handler)
+        _, self.listener = logger.start_queue(self.log, self.queue_size)
+
+    def wrap(self, name: str, parser: Parser) -> Parser:
+        def tapped(data: dict) -> Any:
+            self.seen[name] += 1
+            if (
+                (self.events is None or name in self.events) and
+                (self.ratio >= 1.0 or random.random() < self.ratio)
+            ):
+                # Serialized before the parser gets a chance to change it
+                self.captured[name] += 1
+                self.log.info(discord.utils._to_json({'t': name, 'd': data}))
+            return parser(data)
+
+        return tapped
+
+    def stats(self) -> dict:
+        return {
+            'running': self.running,
+            'ratio': self.ratio,
+            'events': sorted(self.events) if self.events else None,
+            'seen': dict(self.seen),
+            'captured': dict(self.captured)
+        }
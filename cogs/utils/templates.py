@@ -0,0 +1,281 @@
+import logging
+import re
+from typing import Any, Callable, Mapping, Union
+
+import discord
+
+import config
+from cogs.utils.cache import TTLCache
+
+log = logging.getLogger(__name__)
+
+placeholder = re.compile(r'\{(\w+)(?::(\d+))?\}')
+
+# Discord's embed limits
+limits = {
+    'title': 256,
+    'description': 4096,
+    'field_name': 256,
+    'field_value': 1024,
+    'footer': 2048,
+    'author': 256,
+    'thumbnail': 2048
+}
+total_limit = 6000
+max_fields = 25
+
+# Longest value each placeholder can take, per template
+variables = {
+    'joined': {'name': 32, 'mention': 22, 'created': 20, 'avatar': 512},
+    'left': {'name': 32, 'mention': 22, 'joined': 20, 'avatar': 512},
+    'edited': {'before': 4000, 'after': 4000, 'author': 22, 'url': 100},
+    'deleted': {'content': 4000, 'author': 22, 'channel': 22},
+    'bulk_deleted': {'total': 10, 'uncached': 10, 'channel': 22},
+    'custom': {'server': 100, 'channel': 100, 'user': 32}
+}
+
+defaults = {
+    'joined': {
+        'title': 'A user has joined the server!',
+        'color': 0x57F287,
+        'thumbnail': '{avatar}',
+        'fields': [
+            {'name': 'Account Name', 'value': '{name}'},
+            {'name': 'Account Creation', 'value': '{created}'}
+        ]
+    },
+    'left': {
+        'title': 'A user has left the server',
+        'color': 0xED4245,
+        'thumbnail': '{avatar}',
+        'fields': [
+            {'name': 'Account Name', 'value': '{name}'},
+            {'name': 'Joined Server', 'value': '{joined}'}
+        ]
+    },
+    'edited': {
+        'title': 'A message has been edited',
+        'color': 0xFEE75C,
+        'fields': [
+            {'name': 'Before', 'value': '{before:1024}'},
+            {'name': 'After', 'value': '{after:1024}'},
+            {'name': 'Author', 'value': '{author}'},
+            {'name': 'Jump to message', 'value': '[[Click here]]({url})'}
+        ]
+    },
+    'deleted': {
+        'title': 'A message has been deleted',
+        'color': 0xED4245,
+        'fields': [
+            {'name': 'Content', 'value': '{content:1024}'},
+            {'name': 'Author', 'value': '{author}'},
+            {'name': 'Channel', 'value': '{channel}'}
+        ]
+    },
+    'bulk_deleted': {
+        'title': 'Messages have been bulk deleted',
+        'color': 0xED4245,
+        'fields': [
+            {'name': 'Messages', 'value': '{total}'},
+            {'name': 'Not cached', 'value': '{uncached}'},
+            {'name': 'Channel', 'value': '{channel}'}
+        ]
+    }
+}
+
+Part = Union[str, tuple[str, int]]
+Renderer = Callable[[dict[str, Any]], str]
+
+
+class TemplateError(Exception):
+    pass
+
+
+def render_parts(parts: list[Part], values: dict[str, Any]) -> str:
+    output = []
+    for part in parts:
+        if isinstance(part, str):
+            output.append(part)
+            continue
+        name, size = part
+        value = str(values.get(name, ''))
+        if len(value) > size:
+            value = value[:size - 1] + '\N{HORIZONTAL ELLIPSIS}'
+        output.append(value)
+    return ''.join(output)
+
+
+def compile_text(
+    text: str, allowed: dict[str, int], limit: int, where: str
+) -> tuple[Renderer, int]:
+    """Split `text` into literals and placeholders once.
+
+    Returns the render function and the longest string it can produce,
+    which has to fit `limit` whatever the values are.
+    """
+    if not isinstance(text, str):
+        raise TemplateError(f'{where} must be text')
+
+    parts: list[Part] = []
+    size = 0
+    position = 0
+    for match in placeholder.finditer(text):
+        literal = text[position:match.start()]
+        if literal:
+            parts.append(literal)
+            size += len(literal)
+        name, cap = match.group(1), match.group(2)
+        if name not in allowed:
+            names = ', '.join(f'{{{n}}}' for n in allowed)
+            raise TemplateError(
+                f'Unknown placeholder {{{name}}} in {where}, use {names}'
+            )
+        cap = min(int(cap), allowed[name]) if cap else allowed[name]
+        if cap < 1:
+            raise TemplateError(f'{{{name}:0}} in {where} is always empty')
+        parts.append((name, cap))
+        size += cap
+        position = match.end()
+
+    if text[position:]:
+        parts.append(text[position:])
+        size += len(text) - position
+
+    if size > limit:
+        raise TemplateError(
+            f'{where} can reach {size} characters but the limit is {limit}, '
+            'shorten the text or cap placeholders like {content:500}'
+        )
+    if all(isinstance(part, str) for part in parts):
+        return (lambda values, text=text: text), size
+    return (lambda values: render_parts(parts, values)), size
+
+
+class Template:
+    """A validated embed definition compiled into render functions"""
+
+    def __init__(self, kind: str, definition: dict) -> None:
+        if not isinstance(definition, dict):
+            raise TemplateError('A template must be a JSON object')
+        unknown = set(definition) - {
+            'title', 'description', 'color', 'thumbnail', 'footer',
+            'author', 'fields'
+        }
+        if unknown:
+            raise TemplateError(f'Unknown keys: {", ".join(sorted(unknown))}')
+
+        allowed = variables[kind]
+        self.kind = kind
+        self.definition = definition
+        self.color = definition.get('color')
+        if self.color is not None and not (
+            isinstance(self.color, int) and 0 <= self.color <= 0xFFFFFF
+        ):
+            raise TemplateError('color must be a number up to 0xFFFFFF')
+
+        self.slots: dict[str, Renderer] = {}
+        total = 0
+        for key in ('title', 'description', 'footer', 'author', 'thumbnail'):
+            if definition.get(key) is None:
+                continue
+            render, size = compile_text(
+                definition[key], allowed, limits[key], key
+            )
+            self.slots[key] = render
+            if key != 'thumbnail':
+                total += size
+
+        fields = definition.get('fields', [])
+        if not isinstance(fields, list) or len(fields) > max_fields:
+            raise TemplateError(f'fields must be a list of up to {max_fields}')
+        self.fields: list[tuple[Renderer, Renderer, bool]] = []
+        for index, field in enumerate(fields, start=1):
+            if not isinstance(field, dict) or 'name' not in field:
+                raise TemplateError(f'Field {index} needs a name and value')
+            name, name_size = compile_text(
+                field['name'], allowed, limits['field_name'],
+                f'field {index} name'
+            )
+            value, value_size = compile_text(
+                field.get('value', ''), allowed, limits['field_value'],
+                f'field {index} value'
+            )
+            self.fields.append((name, value, bool(field.get('inline', False))))
+            total += name_size + value_size
+
+        if not self.slots.keys() - {'thumbnail'} and not self.fields:
+            raise TemplateError('A template needs some text')
+        if total > total_limit:
+            raise TemplateError(
+                f'The embed can reach {total} characters but the limit is '
+                f'{total_limit}'
+            )
+        self.size = total
+
+    def render(self, values: dict[str, Any]) -> discord.Embed:
+        slots = self.slots
+        embed = discord.Embed(color=self.color)
+        if 'title' in slots:
+            embed.title = slots['title'](values)
+        if 'description' in slots:
+            embed.description = slots['description'](values)
+        if 'author' in slots:
+            embed.set_author(name=slots['author'](values))
+        if 'footer' in slots:
+            embed.set_footer(text=slots['footer'](values))
+        if 'thumbnail' in slots:
+            embed.set_thumbnail(url=slots['thumbnail'](values) or None)
+        for name, value, inline in self.fields:
+            # Discord rejects empty field values
+            embed.add_field(
+                name=name(values) or '\u200b',
+                value=value(values) or '\u200b',
+                inline=inline
+            )
+        return embed
+
+
+compiled_defaults = {
+    kind: Template(kind, definition) for kind, definition in defaults.items()
+}
+
+# (guild, name) -> (definition, template), for definitions set by guilds
+cache = TTLCache(max_size=getattr(config, 'embed_template_cache_size', 2_000))
+
+
+def kind_of(name: str) -> str:
+    return name if name in defaults else 'custom'
+
+
+def get(guild_settings: Mapping[str, Any], name: str) -> Template:
+    definition = guild_settings.get('templates', {}).get(name)
+    if definition is None:
+        if name not in compiled_defaults:
+            raise TemplateError(f'There is no template called {name}')
+        return compiled_defaults[name]
+
+    key = (guild_settings['_id'], name)
+    cached = cache.get(key)
+    # The cached settings document is shared, so this is usually the
+    # same object and only compared in full after it changed
+    if cached is not None and (
+        cached[0] is definition or cached[0] == definition
+    ):
+        return cached[1]
+
+    try:
+        template = Template(kind_of(name), definition)
+    except TemplateError:
+        if name not in compiled_defaults:
+            raise
+        # Stored before a limit changed, keep logging with the default
+        log.warning(f'Invalid {name} template in guild {key[0]}')
+        template = compiled_defaults[name]
+    cache.set(key, (definition, template))
+    return template
+
+
+def render(
+    guild_settings: Mapping[str, Any], name: str, **values: Any
+) -> discord.Embed:
+    return get(guild_settings, name).render(values)
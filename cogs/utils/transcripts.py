@@ -0,0 +1,197 @@
+import asyncio
+import gzip
+import html
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Optional
+
+import discord
+
+header = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{ font-family: sans-serif; background: #313338; color: #dbdee1; }}
+.message {{ margin: 0 0 12px; }}
+.author {{ font-weight: bold; color: #f2f3f5; }}
+.time {{ color: #949ba4; font-size: 12px; margin-left: 6px; }}
+.content {{ white-space: pre-wrap; }}
+a {{ color: #00a8fc; }}
+</style>
+</head>
+<body>
+<h1>{title}</h1>
+"""
+
+footer = """<p>{count} messages</p>
+</body>
+</html>
+"""
+
+
+def message_record(message: discord.Message) -> dict:
+    """What a transcript keeps of a message, attachments only by URL"""
+    return {
+        'id': message.id,
+        'author_id': message.author.id,
+        'author': str(message.author),
+        'created_at': message.created_at.isoformat(),
+        'content': message.content,
+        'attachments': [
+            {
+                'filename': attachment.filename,
+                'url': attachment.url,
+                'size': attachment.size
+            }
+            for attachment in message.attachments
+        ],
+        'embeds': len(message.embeds)
+    }
+
+
+def render_record(record: dict) -> str:
+    links = ''.join(
+        f'<div><a href="{html.escape(a["url"])}">'
+        f'{html.escape(a["filename"])}</a> ({a["size"]} bytes)</div>'
+        for a in record['attachments']
+    )
+    embeds = ''
+    if record['embeds']:
+        embeds = f'<div>{record["embeds"]} embeds</div>'
+    return (
+        '<div class="message">'
+        f'<span class="author">{html.escape(record["author"])}</span>'
+        f'<span class="time">{record["created_at"]}</span>'
+        f'<div class="content">{html.escape(record["content"])}</div>'
+        f'{links}{embeds}</div>\n'
+    )
+
+
+async def history(
+    channel: discord.abc.Messageable, page_size: int = 100
+) -> AsyncIterator[list[dict]]:
+    """Pages of message records, oldest first, one page in memory"""
+    page = []
+    async for message in channel.history(limit=None, oldest_first=True):
+        page.append(message_record(message))
+        if len(page) >= page_size:
+            yield page
+            page = []
+    if page:
+        yield page
+
+
+class TranscriptWriter:
+    """Gzip compressed HTML and JSONL files, written on a worker thread"""
+
+    def __init__(self, path: str, title: str) -> None:
+        self.html_path = f'{path}.html.gz'
+        self.jsonl_path = f'{path}.jsonl.gz'
+        self.title = title
+        self.count = 0
+        self.html = None
+        self.jsonl = None
+
+    def open(self) -> None:
+        self.html = gzip.open(self.html_path, 'wt', encoding='utf-8')
+        self.jsonl = gzip.open(self.jsonl_path, 'wt', encoding='utf-8')
+        self.html.write(header.format(title=html.escape(self.title)))
+
+    def write(self, records: list[dict]) -> None:
+        for record in records:
+            self.html.write(render_record(record))
+            self.jsonl.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.count += len(records)
+
+    def close(self) -> None:
+        if self.html is not None:
+            self.html.write(footer.format(count=self.count))
+            self.html.close()
+        if self.jsonl is not None:
+            self.jsonl.close()
+
+    def remove(self) -> None:
+        for path in (self.html_path, self.jsonl_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class Exporter:
+    """Export channels with at most `concurrency` running at once.
+
+    Fetching history goes through the bot's HTTP client and its rate
+    limits, the bound keeps a bulk export from starving everything else.
+    Rendering and compression run on a thread pool of the same size.
+    """
+
+    def __init__(self, directory: str, concurrency: int = 2) -> None:
+        self.directory = directory
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix='transcripts'
+        )
+        self.running = 0
+        self.exported = 0
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def export(
+        self, channel: discord.TextChannel, name: Optional[str] = None
+    ) -> TranscriptWriter:
+        async with self.semaphore:
+            self.running += 1
+            try:
+                return await self.write(channel, name)
+            finally:
+                self.running -= 1
+
+    async def write(
+        self, channel: discord.TextChannel, name: Optional[str]
+    ) -> TranscriptWriter:
+        loop = asyncio.get_running_loop()
+        os.makedirs(self.directory, exist_ok=True)
+        if name is None:
+            timestamp = int(discord.utils.utcnow().timestamp())
+            name = f'{channel.id}-{timestamp}'
+        writer = TranscriptWriter(
+            os.path.join(self.directory, name), f'#{channel.name}'
+        )
+        try:
+            await loop.run_in_executor(self.executor, writer.open)
+            await self.write_pages(loop, channel, writer)
+        except BaseException:
+            # Partial transcripts are of no use to anyone
+            writer.remove()
+            raise
+        self.exported += 1
+        return writer
+
+    async def write_pages(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        channel: discord.TextChannel,
+        writer: TranscriptWriter
+    ) -> None:
+        # The next page is fetched while the previous one is written
+        pending = None
+        try:
+            async for page in history(channel):
+                if pending is not None:
+                    await pending
+                pending = loop.run_in_executor(
+                    self.executor, writer.write, page
+                )
+            # Awaited here so a failed last page fails the export
+            if pending is not None:
+                await pending
+        finally:
+            # Never close the files under a write that is still running
+            if pending is not None and not pending.done():
+                await asyncio.wait([pending])
+            await loop.run_in_executor(self.executor, writer.close)
@@ -0,0 +1,92 @@
+import logging
+
+import aiohttp
+import discord
+
+from cogs.utils import metrics, mongo
+
+log = logging.getLogger(__name__)
+
+
+class WebhookSender:
+    """Deliver log embeds through a managed webhook per channel.
+
+    Webhook requests go through their own aiohttp session, so they do not
+    use the rate limit budget of the bot's own HTTP client.
+    """
+
+    def __init__(self, bot: discord.Client, name: str = 'Logs') -> None:
+        self.bot = bot
+        self.name = name
+        self.session = None
+        self.webhooks: dict[int, discord.Webhook] = {}
+
+    async def start(self) -> None:
+        self.session = aiohttp.ClientSession(
+            trace_configs=[metrics.http_trace()]
+        )
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def partial(self, webhook_id: int, token: str) -> discord.Webhook:
+        return discord.Webhook.partial(
+            webhook_id, token, session=self.session
+        )
+
+    async def create(self, channel: discord.TextChannel) -> discord.Webhook:
+        webhook = await channel.create_webhook(name=self.name)
+        guild = mongo.Guild(channel.guild.id)
+        stored = {'id': webhook.id, 'token': webhook.token}
+        query = {'$set': {f'webhooks.{channel.id}': stored}}
+        await guild.update(query)
+        log.info(f'Created logs webhook for channel {channel.id}')
+        return self.partial(webhook.id, webhook.token)
+
+    async def get_webhook(
+        self, channel: discord.TextChannel
+    ) -> discord.Webhook:
+        webhook = self.webhooks.get(channel.id)
+        if webhook is not None:
+            return webhook
+
+        guild = mongo.Guild(channel.guild.id)
+        guild_settings = await guild.check()
+        stored = guild_settings.get('webhooks', {}).get(str(channel.id))
+        if stored:
+            webhook = self.partial(stored['id'], stored['token'])
+        else:
+            webhook = await self.create(channel)
+        self.webhooks[channel.id] = webhook
+        return webhook
+
+    async def send(
+        self, webhook: discord.Webhook, embeds: list[discord.Embed]
+    ) -> None:
+        user = self.bot.user
+        await webhook.send(
+            embeds=embeds,
+            username=user.name,
+            avatar_url=user.display_avatar.url
+        )
+
+    async def __call__(
+        self, channel: discord.TextChannel, embeds: list[discord.Embed]
+    ) -> None:
+        try:
+            webhook = await self.get_webhook(channel)
+        except discord.Forbidden:
+            # Without Manage Webhooks the bot can still post by itself
+            await channel.send(embeds=embeds)
+            return
+
+        try:
+            await self.send(webhook, embeds)
+        except discord.NotFound:
+            log.info(f'Logs webhook for channel {channel.id} was deleted')
+            self.webhooks.pop(channel.id, None)
+            webhook = await self.create(channel)
+            self.webhooks[channel.id] = webhook
+            await self.send(webhook, embeds)
@@ -1,9 +1,18 @@
+import sys
+import time
+import signal
 import logging
 import asyncio
+import argparse
 import discord
 import contextlib
+import multiprocessing
+from multiprocessing.connection import Connection, wait
+from typing import Optional
 
+import config
 from bot import Bot
+from cogs.utils import cluster, logger, runtime
 
 from setproctitle import setproctitle
 from logging.handlers import RotatingFileHandler
@@ -11,6 +20,8 @@ from logging.handlers import RotatingFileHandler
 
 setproctitle('discord-bot-template')
 
+log = logging.getLogger(__name__)
+
 
 class RemoveNoise(logging.Filter):
     def __init__(self):
@@ -26,8 +37,9 @@ class RemoveNoise(logging.Filter):
 
 
 @contextlib.contextmanager
-def setup_logging():
+def setup_logging(filename: str = 'discord.log', mode: str = 'w'):
     log = logging.getLogger()
+    listener = None
 
     try:
         discord.utils.setup_logging()
@@ -38,9 +50,9 @@ def setup_logging():
 
         log.setLevel(logging.INFO)
         handler = RotatingFileHandler(
-            filename='discord.log',
+            filename=filename,
             encoding='utf-8',
-            mode='w',
+            mode=mode,
             maxBytes=max_bytes,
             backupCount=5
         )
@@ -50,25 +62,296 @@ def setup_logging():
             datefmt=dt_fmt,
             style='{'
         )
+        if getattr(config, 'log_format', 'text') == 'json':
+            fmt = logger.JSONFormatter()
         handler.setFormatter(fmt)
         log.addHandler(handler)
 
+        # Disk writes and rotation happen on a background thread so a slow
+        # disk never stalls the event loop
+        queue_size = getattr(config, 'log_queue_size', 10_000)
+        if queue_size:
+            _, listener = logger.start_queue(log, queue_size)
+
         yield
     finally:
         handlers = log.handlers[:]
+        if listener is not None:
+            listener.stop()
+            handlers += listener.handlers
         for hdlr in handlers:
             hdlr.close()
             log.removeHandler(hdlr)
 
 
-async def run_bot() -> None:
-    async with Bot() as bot:
+async def run_bot(
+    cluster_id: Optional[int] = None,
+    shard_ids: Optional[list[int]] = None,
+    shard_count: Optional[int] = None,
+    connection: Optional[Connection] = None
+) -> None:
+    async with Bot(
+        cluster_id=cluster_id,
+        shard_ids=shard_ids,
+        shard_count=shard_count,
+        connection=connection
+    ) as bot:
         await bot.start()
 
 
+def run_worker(
+    cluster_id: int,
+    shard_ids: list[int],
+    shard_count: int,
+    connection: Connection,
+    profile: str = 'default'
+) -> None:
+    setproctitle(f'discord-bot-template-cluster-{cluster_id}')
+    # Appended to, a restarted worker keeps the traceback of its crash
+    with setup_logging(f'discord-cluster-{cluster_id}.log', mode='a'):
+        # Spawned workers start with a fresh loop policy
+        runtime.apply_profile(profile)
+        asyncio.run(
+            run_bot(cluster_id, shard_ids, shard_count, connection)
+        )
+
+
+class Worker:
+    def __init__(
+        self,
+        cluster_id: int,
+        shard_ids: list[int],
+        shard_count: int,
+        profile: str = 'default'
+    ) -> None:
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.profile = profile
+        self.process = None
+        self.connection = None
+        self.restarts = 0
+        self.started_at = 0.0
+        self.restart_at = 0.0
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def start(self, context: multiprocessing.context.BaseContext) -> None:
+        self.connection, child = context.Pipe()
+        self.process = context.Process(
+            target=run_worker,
+            args=(
+                self.cluster_id,
+                self.shard_ids,
+                self.shard_count,
+                child,
+                self.profile
+            ),
+            name=f'cluster-{self.cluster_id}'
+        )
+        self.process.start()
+        child.close()
+        self.started_at = time.monotonic()
+        log.info(
+            f'Started cluster {self.cluster_id} (PID {self.process.pid}) '
+            f'with shards {self.shard_ids[0]}-{self.shard_ids[-1]}'
+        )
+
+    def stop(self) -> None:
+        if self.alive:
+            self.process.terminate()
+            self.process.join(10)
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class Supervisor:
+    """Run clusters of shards in worker processes.
+
+    Workers that exit are restarted with an exponential backoff, and
+    broadcasts from any cluster are relayed to every running cluster.
+    """
+
+    broadcast_timeout = 60.0
+    max_backoff = 300.0
+
+    def __init__(self, workers: list[Worker]) -> None:
+        self.context = multiprocessing.get_context('spawn')
+        self.workers = workers
+        self.broadcasts: dict[str, dict] = {}
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        for worker in self.workers:
+            worker.start(self.context)
+
+        try:
+            while True:
+                self.poll()
+        except KeyboardInterrupt:
+            log.info('Stopping clusters')
+        finally:
+            for worker in self.workers:
+                worker.stop()
+
+    def poll(self) -> None:
+        connections = {
+            worker.connection: worker for worker in self.workers
+            if worker.alive and worker.connection is not None
+        }
+        for connection in wait(list(connections), timeout=1.0):
+            worker = connections[connection]
+            try:
+                message = connection.recv()
+            except (EOFError, OSError):
+                continue
+            self.handle(worker, message)
+
+        self.expire_broadcasts()
+        for worker in self.workers:
+            self.supervise(worker)
+
+    def supervise(self, worker: Worker) -> None:
+        now = time.monotonic()
+        if worker.alive:
+            if worker.restarts and now - worker.started_at > 600:
+                worker.restarts = 0
+            return
+
+        if not worker.restart_at:
+            backoff = min(2 ** worker.restarts, self.max_backoff)
+            worker.restart_at = now + backoff
+            log.warning(
+                f'Cluster {worker.cluster_id} exited with code '
+                f'{worker.process.exitcode}, restarting in {backoff}s'
+            )
+        elif now >= worker.restart_at:
+            worker.stop()
+            worker.restarts += 1
+            worker.restart_at = 0.0
+            worker.start(self.context)
+
+    def handle(self, worker: Worker, message: dict) -> None:
+        if message['op'] == 'broadcast':
+            targets = [w for w in self.workers if w.alive]
+            self.broadcasts[message['nonce']] = {
+                'origin': worker,
+                'waiting': {w.cluster_id for w in targets},
+                'results': [],
+                'deadline': time.monotonic() + self.broadcast_timeout
+            }
+            request = dict(message, op='request')
+            for target in targets:
+                try:
+                    target.connection.send(request)
+                except OSError:
+                    # Died since it was polled, the restart picks it up
+                    self.no_response(message['nonce'], target.cluster_id)
+        elif message['op'] == 'response':
+            broadcast = self.broadcasts.get(message['nonce'])
+            if broadcast is None:
+                return
+            broadcast['waiting'].discard(worker.cluster_id)
+            broadcast['results'].append(message['result'])
+            if not broadcast['waiting']:
+                self.finish(message['nonce'])
+
+    def no_response(self, nonce: str, cluster_id: int) -> None:
+        broadcast = self.broadcasts.get(nonce)
+        if broadcast is None:
+            return
+        broadcast['waiting'].discard(cluster_id)
+        broadcast['results'].append({
+            'cluster': cluster_id, 'ok': False, 'result': 'No response'
+        })
+        if not broadcast['waiting']:
+            self.finish(nonce)
+
+    def expire_broadcasts(self) -> None:
+        now = time.monotonic()
+        for nonce, broadcast in list(self.broadcasts.items()):
+            if now >= broadcast['deadline']:
+                self.finish(nonce)
+
+    def finish(self, nonce: str) -> None:
+        broadcast = self.broadcasts.pop(nonce)
+        results = broadcast['results']
+        for cluster_id in broadcast['waiting']:
+            results.append({
+                'cluster': cluster_id, 'ok': False, 'result': 'No response'
+            })
+
+        origin = broadcast['origin']
+        if not origin.alive:
+            return
+        try:
+            origin.connection.send({
+                'op': 'results', 'nonce': nonce, 'results': results
+            })
+        except OSError:
+            log.warning(
+                f'Cluster {origin.cluster_id} stopped before its broadcast '
+                'finished'
+            )
+
+
+def run_clusters(
+    shard_count: int,
+    processes: int,
+    hosts: int,
+    host_index: int,
+    profile: str = 'default'
+) -> None:
+    total = processes * hosts
+    ranges = cluster.split_shards(shard_count, total)
+    first = host_index * processes
+    workers = [
+        Worker(cluster_id, ranges[cluster_id], shard_count, profile)
+        for cluster_id in range(first, first + processes)
+        if ranges[cluster_id]
+    ]
+    Supervisor(workers).run()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Run the Discord bot')
+    parser.add_argument(
+        '--cluster', action='store_true',
+        help='run shards in supervised worker processes'
+    )
+    parser.add_argument('--shard-count', type=int, default=1)
+    parser.add_argument(
+        '--processes', type=int, default=1, help='processes per host'
+    )
+    parser.add_argument('--hosts', type=int, default=1)
+    parser.add_argument('--host-index', type=int, default=0)
+    parser.add_argument(
+        '--profile', choices=('default', 'fast'),
+        default=getattr(config, 'runtime_profile', 'default'),
+        help='fast uses uvloop when it is installed'
+    )
+    return parser.parse_args()
+
+
 def main() -> None:
-    with setup_logging():
-        asyncio.run(run_bot())
+    args = parse_args()
+    if not args.cluster:
+        with setup_logging():
+            runtime.apply_profile(args.profile)
+            asyncio.run(run_bot())
+        return
+
+    with setup_logging('discord-supervisor.log'):
+        run_clusters(
+            args.shard_count,
+            args.processes,
+            args.hosts,
+            args.host_index,
+            args.profile
+        )
 
 
 if __name__ == '__main__':